@@ -0,0 +1,158 @@
+"""
+micro-benchmark for common.encrypt.Encrypter.
+
+compares the buffer-reusing implementation against the previous
+read()/slice/join implementation (kept below as LegacyEncrypter) on:
+- encrypt_file over many 2 MiB video-chunk sized files
+- encrypt_file over one large file (memory-mapped path)
+- encrypt() over in-memory 2 MiB buffers
+
+every variant runs in a fresh process so that ru_maxrss is its own peak RSS.
+ciphertexts from both implementations are checked to be byte-for-byte identical.
+
+usage: python benchmarks/bench_encrypt.py [--chunks 200] [--large-mb 256]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.encrypt import Encrypter
+
+KEY = bytes(range(32))
+IV = bytes(range(16))
+
+class LegacyEncrypter(Encrypter):
+    """
+    The Encrypter file and buffer paths as they were before the zero-copy rewrite.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(chunk_size=1024, **kwargs)
+
+    def _crypt_file(self, *, src_file, dest_file, chunk_size, cipher):
+        if not chunk_size:
+            chunk_size = self.chunk_size
+
+        with open(src_file, 'rb') as infile, open(dest_file, 'wb') as outfile:
+            while chunk := infile.read(chunk_size):
+                outfile.write(cipher.update(chunk))
+            outfile.write(cipher.finalize())
+
+    def _encdec(self, data, chunk_size, cipher_context):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        if not chunk_size:
+            chunk_size = self.chunk_size
+
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size]
+            yield cipher_context.update(chunk)
+
+        yield cipher_context.finalize()
+
+    def encrypt(self, data, iv=None, chunk_size=None):
+        return b''.join(list(self.encrypt_chunks(data, iv=iv, chunk_size=chunk_size)))
+
+IMPLEMENTATIONS = {
+    'legacy': LegacyEncrypter,
+    'current': Encrypter,
+}
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run(impl, workload, src_files, out_dir, result_queue):
+    encrypter = IMPLEMENTATIONS[impl](key=KEY, iv=IV)
+    nbytes = 0
+
+    start = time.perf_counter()
+    if workload == 'buffers':
+        with open(src_files[0], 'rb') as infile:
+            data = infile.read()
+        for _ in range(len(src_files)):
+            nbytes += len(encrypter.encrypt(data))
+    else:
+        for i, src_file in enumerate(src_files):
+            encrypter.encrypt_file(src_file=src_file, dest_file=os.path.join(out_dir, f'{i:05d}'))
+            nbytes += os.path.getsize(src_file)
+    seconds = time.perf_counter() - start
+
+    result_queue.put({
+        'implementation': impl,
+        'workload': workload,
+        'mb_per_s': nbytes / 1024 / 1024 / seconds,
+        'seconds': seconds,
+        'peak_rss_mb': _peak_rss_mb(),
+    })
+
+def _measure(impl, workload, src_files, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(impl, workload, src_files, out_dir, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+def _assert_identical(dir_a, dir_b):
+    for name in sorted(os.listdir(dir_a)):
+        with open(os.path.join(dir_a, name), 'rb') as a, open(os.path.join(dir_b, name), 'rb') as b:
+            if a.read() != b.read():
+                raise AssertionError(f'ciphertext mismatch for {name}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=200, help='number of 2 MiB files')
+    parser.add_argument('--large-mb', type=int, default=256, help='size of the large file in MiB')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('spawn')
+    work_dir = tempfile.mkdtemp(prefix='bench_encrypt_')
+    try:
+        chunk_files = []
+        for i in range(args.chunks):
+            chunk_files.append(os.path.join(work_dir, f'chunk_{i:05d}.webm'))
+            with open(chunk_files[-1], 'wb') as outfile:
+                outfile.write(os.urandom(2 * 1024 * 1024))
+
+        large_file = os.path.join(work_dir, 'large.webm')
+        with open(large_file, 'wb') as outfile:
+            for _ in range(args.large_mb):
+                outfile.write(os.urandom(1024 * 1024))
+
+        workloads = {
+            'chunk_files': chunk_files,
+            'large_file': [large_file],
+            'buffers': chunk_files,
+        }
+
+        results = []
+        for workload, src_files in workloads.items():
+            for impl in IMPLEMENTATIONS:
+                results.append(_measure(impl, workload, src_files, os.path.join(work_dir, workload, impl)))
+            if workload != 'buffers':
+                _assert_identical(*(os.path.join(work_dir, workload, impl) for impl in IMPLEMENTATIONS))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'workload':<12} {'impl':<8} {'MB/s':>10} {'peak RSS MB':>12}")
+    for result in results:
+        print(f"{result['workload']:<12} {result['implementation']:<8} {result['mb_per_s']:>10.1f} {result['peak_rss_mb']:>12.1f}")
+
+if __name__ == '__main__':
+    main()
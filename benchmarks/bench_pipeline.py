@@ -0,0 +1,278 @@
+"""
+offline benchmarks of the ingest and serving hot paths, over the synthetic corpus
+from benchmarks/corpus.py.
+
+- encrypt_file / decrypt_chunks: Encrypter throughput over the corpus files
+- thumbnail_image / thumbnail_video: ObjectProcess.create_thumbnail
+- heic_decode: the heic sanitizer's decode (only if the corpus has heic files)
+- preview: derive (draft decode plus resize) and the jpeg encode the uploader does
+- chunk: chunker.chunk_video (over a random blob if the corpus has no webm)
+- ui_thumbnails: paging through /thumbnails with the flask test client
+- ui_stream_cold / ui_stream_warm: /stream of remote objects through tools/fake_megatools,
+  first fetch and cached
+- ui_stream_preview: ranged /stream of a first video chunk from the previews directory
+
+every benchmark reports files (requests), bytes, wall time, throughput and per-item
+latency percentiles.  results are written as json, and --compare prints the change
+against a previous result file.
+
+usage: python benchmarks/bench_pipeline.py [--output results.json] [--compare baseline.json]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in (REPO, os.path.join(REPO, 'uploader'), os.path.join(REPO, 'uploader', 'sanitizer')):
+    sys.path.insert(0, directory)
+
+
+import corpus
+from common.encrypt import Encrypter
+from common.schema import migrate, insert_files
+from common.thumbstore import ThumbnailStore
+from metrics import StageMetrics
+from chunker import chunk_video
+from thumbnail_generator import derive, PREVIEW
+from thumbnail_generator.object_process_factory import ObjectProcessFactory
+
+KEY = bytes(range(32))
+IV = bytes(range(16))
+THUMB_SIZE = (128*2, 96*2)
+
+def bench_encrypt(metrics, files, work_dir):
+    encrypter = Encrypter(key=KEY, iv=IV)
+    out_dir = os.path.join(work_dir, 'encrypted')
+    os.makedirs(out_dir, exist_ok=True)
+
+    encrypted = []
+    for i, filepath in enumerate(files['jpeg'] + files['webm']):
+        encrypted.append(os.path.join(out_dir, f'{i:05d}'))
+        with metrics.stage('encrypt_file', os.path.getsize(filepath)):
+            encrypter.encrypt_file(src_file=filepath, dest_file=encrypted[-1])
+
+    # separate loop, so each stage's wall time is only its own work
+    for filepath in encrypted:
+        with open(filepath, 'rb') as f:
+            ciphertext = f.read()
+        with metrics.stage('decrypt_chunks', len(ciphertext)):
+            for _ in encrypter.decrypt_chunks(ciphertext):
+                pass
+
+def bench_thumbnails(metrics, files, work_dir):
+    factory = ObjectProcessFactory()
+    for kind, stage in (('jpeg', 'thumbnail_image'), ('webm', 'thumbnail_video')):
+        for filepath in files[kind]:
+            with metrics.stage(stage, os.path.getsize(filepath)):
+                factory.create(filepath).create_thumbnail(THUMB_SIZE)
+
+def bench_heic(metrics, files, work_dir):
+    if not files['heic']:
+        return
+
+    from image.heic import Heic
+    for filepath in files['heic']:
+        with metrics.stage('heic_decode', os.path.getsize(filepath)):
+            Heic(filepath).load_image().load()
+
+def bench_preview(metrics, files, work_dir):
+    for filepath in files['jpeg']:
+        with metrics.stage('preview', os.path.getsize(filepath)):
+            output = io.BytesIO()
+            derive(filepath, [PREVIEW])[PREVIEW.name].save(output, 'JPEG', quality=PREVIEW.quality, optimize=True)
+
+def bench_chunk(metrics, files, work_dir):
+    videos = files['webm']
+    if not videos:
+        # chunking doesn't look at the content
+        videos = [os.path.join(work_dir, '20240301_120000_blob.webm')]
+        with open(videos[0], 'wb') as f:
+            f.write(random.Random(0).randbytes(64 * 1024 * 1024))
+
+    out_dir = os.path.join(work_dir, 'chunks')
+    os.makedirs(out_dir, exist_ok=True)
+    random.seed(0)
+    for filepath in videos:
+        with metrics.stage('chunk', os.path.getsize(filepath)):
+            chunk_video(filepath, out_dir)
+
+def bench_ui(metrics, files, work_dir, *, timeline_rows=5000, stream_objects=20):
+    mega_root = os.path.join(work_dir, 'ui')
+    static_dir = os.path.join(mega_root, 'static')
+    remote_dir = os.path.join(mega_root, 'remote')
+    os.makedirs(os.path.join(static_dir, 'previews'), exist_ok=True)
+
+    encrypter = Encrypter(key=KEY, iv=IV)
+    email = 'bench@example.com'
+    os.makedirs(os.path.join(remote_dir, email))
+
+    # the tables the uploader expects to exist, then the migrations on top
+    conn = sqlite3.connect(os.path.join(mega_root, 'database.db'))
+    conn.executescript("""
+        create table servers (email text primary key, mega_pw blob, dek blob);
+        create table files (filename text, unix_timestamp integer, email text, dek blob);
+    """)
+    migrate(conn)
+
+    server_dek = Encrypter.generate_iv()
+    conn.execute('insert into servers values (?, ?, ?)', (email, encrypter.encrypt(b'password', iv=server_dek), encrypter.encrypt(server_dek)))
+
+    # a timeline of timeline_rows images, all sharing the corpus thumbnails
+    thumbnails = []
+    for filepath in files['jpeg']:
+        output = io.BytesIO()
+        ObjectProcessFactory().create(filepath).create_thumbnail(THUMB_SIZE).save(output, 'JPEG', quality=40)
+        thumbnails.append(output.getvalue())
+
+    store = ThumbnailStore(os.path.join(static_dir, 'thumbnails'))
+    cursor = conn.cursor()
+    rows = []
+    for i in range(timeline_rows):
+        filename = f'timeline_{i:06d}.jpg'
+        rows.append({'filename': filename, 'unix_timestamp': 1577836800 + i * 600, 'email': email, 'dek': encrypter.encrypt(IV)})
+        store.add(cursor, filename, thumbnails[i % len(thumbnails)])
+    insert_files(cursor, rows)
+
+    # remote objects for /stream, encrypted as the uploader would
+    stream_files = []
+    for i in range(stream_objects):
+        filepath = files['jpeg'][i % len(files['jpeg'])]
+        filename = f'stream_{i:04d}.jpg'
+        dek = Encrypter.generate_iv()
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        with open(os.path.join(remote_dir, email, encrypter.hash(filename, iv=dek)), 'wb') as f:
+            f.write(encrypter.encrypt(data, iv=dek))
+        insert_files(cursor, [{'filename': filename, 'unix_timestamp': 0, 'email': email, 'dek': encrypter.encrypt(dek)}])
+        # they show up at the end of the timeline too
+        store.add(cursor, filename, thumbnails[0])
+        stream_files.append(filename)
+    conn.commit()
+    conn.close()
+    store.close()
+
+    preview = os.path.join(static_dir, 'previews', '20240301_120000_0000.webm')
+    with open(preview, 'wb') as f:
+        f.write(random.Random(0).randbytes(2 * 1024 * 1024))
+
+    os.environ.update({
+        'mega_root': mega_root,
+        'static_dir': static_dir,
+        'key': base64.b64encode(KEY).decode(),
+        'iv': base64.b64encode(IV).decode(),
+        'megatools_bin': os.path.join(REPO, 'tools', 'fake_megatools'),
+        'fake_megatools_root': remote_dir,
+        'fake_megatools_bps': str(1024 ** 3),
+        'prefetch_depth': '0',
+    })
+    sys.path.insert(0, os.path.join(REPO, 'ui'))
+    from app import app
+    client = app.test_client()
+
+    def timed(stage, url, headers=None):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        data = response.get_data()
+        metrics.record(stage, nbytes=len(data), seconds=time.perf_counter() - start)
+        assert response.status_code in (200, 206), (url, response.status_code)
+        return response
+
+    # walk the whole timeline with keyset pagination
+    cursor_args = ''
+    while True:
+        page = timed('ui_thumbnails', f'/thumbnails?limit=100{cursor_args}').get_json()
+        if not page:
+            break
+        filename, _, timestamp = page[-1]
+        cursor_args = f'&cursorTimestamp={timestamp}&cursorFilename={filename}'
+
+    for stage in ('ui_stream_cold', 'ui_stream_warm'):
+        for filename in stream_files:
+            timed(stage, f'/stream?filename={filename}')
+
+    for i in range(100):
+        start = i * 16 * 1024
+        timed('ui_stream_preview', '/stream?filename=20240301_120000.webm&chunkIndex=0', {'Range': f'bytes={start}-{start + 256 * 1024 - 1}'})
+
+BENCHMARKS = {
+    'encrypt': bench_encrypt,
+    'thumbnails': bench_thumbnails,
+    'heic': bench_heic,
+    'preview': bench_preview,
+    'chunk': bench_chunk,
+    'ui': bench_ui,
+}
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _compare(results, baseline):
+    print(f"{'benchmark':<20} {'files/s':>10} {'was':>10} {'change':>8} {'p50 ms':>9} {'was':>9}")
+    for name, stage in results['stages'].items():
+        old = baseline['stages'].get(name)
+        if not old:
+            print(f"{name:<20} {stage['files_per_sec']:>10.1f} {'-':>10}")
+            continue
+        change = stage['files_per_sec'] / old['files_per_sec'] - 1 if old['files_per_sec'] else 0.0
+        print(
+            f"{name:<20} {stage['files_per_sec']:>10.1f} {old['files_per_sec']:>10.1f} {change:>+8.1%} "
+            f"{stage['latency_seconds']['p50'] * 1000:>9.2f} {old['latency_seconds']['p50'] * 1000:>9.2f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'megabuse_bench_corpus'),
+                        help='where the corpus is generated, reused between runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--images-per-size', type=int, default=5)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='benchmarks to run, default is all')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='a previous results file to compare against')
+    args = parser.parse_args()
+
+    files = corpus.generate(args.corpus_dir, seed=args.seed, images_per_size=args.images_per_size)
+    metrics = StageMetrics()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        for name in args.only or BENCHMARKS:
+            print(f'running {name}...', file=sys.stderr)
+            BENCHMARKS[name](metrics, files, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    results = {
+        **metrics.summary(),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus': {kind: len(paths) for kind, paths in files.items()},
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            _compare(results, json.load(f))
+    elif not args.output:
+        print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+reproducible synthetic media corpus for the benchmarks.
+
+- jpeg: gradient backgrounds with random shapes, at several resolutions
+- heic: the same images re-encoded as heic, only if pyheif (to read them) and
+  pillow_heif or heif-enc (to write them) are available
+- webm: short vp9 clips of ffmpeg's testsrc2 pattern, only if ffmpeg is available
+
+the same seed and parameters always produce the same corpus; a corpus directory
+is reused as long as it was generated with the same parameters.
+
+usage: python benchmarks/corpus.py DEST_DIR [--seed 0]
+"""
+
+import os
+import sys
+import json
+import shutil
+import random
+import argparse
+import subprocess
+import importlib.util
+from PIL import Image, ImageDraw
+
+JPEG_SIZES = ((640, 480), (1920, 1080), (4032, 3024))
+VIDEO_CLIPS = (((1280, 720), 5), ((1920, 1080), 10))
+
+def _image(size, rng):
+    width, height = size
+    start, end = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(2)]
+    # vertical gradient, one row at a time
+    image = Image.new('RGB', size)
+    draw = ImageDraw.Draw(image)
+    for y in range(height):
+        draw.line(
+            [(0, y), (width, y)],
+            fill=tuple(a + (b - a) * y // max(height - 1, 1) for a, b in zip(start, end))
+        )
+
+    # enough detail that the jpeg isn't trivially small
+    for _ in range(60):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4 + 1), y0 + rng.randrange(height // 4 + 1)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape([x0, y0, x1, y1], fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image
+
+def _heic_writer():
+    if importlib.util.find_spec('pyheif') is None:
+        return None
+    if importlib.util.find_spec('pillow_heif') is not None:
+        def write(image, filepath):
+            import pillow_heif
+            pillow_heif.from_pillow(image).save(filepath, quality=90)
+        return write
+    if shutil.which('heif-enc'):
+        def write(image, filepath):
+            jpeg = f'{filepath}.jpg'
+            image.save(jpeg, 'JPEG', quality=95)
+            subprocess.run(['heif-enc', '-q', '90', '-o', filepath, jpeg], check=True, capture_output=True)
+            os.remove(jpeg)
+        return write
+    return None
+
+def _webm(filepath, size, seconds):
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={size[0]}x{size[1]}:rate=30:duration={seconds}',
+        '-c:v', 'libvpx-vp9', '-b:v', '2M', '-deadline', 'realtime', '-cpu-used', '8',
+        '-g', '60', '-an', '-fflags', '+bitexact',
+        filepath
+    ], check=True)
+
+def generate(dest_dir: str, *, seed: int=0, images_per_size: int=5) -> dict:
+    """
+    Generate the corpus, or reuse dest_dir if it already holds the same one.
+
+    Args:
+    dest_dir (str): Where to put the corpus.
+    seed (int): Seed for the image content, default is 0.
+    images_per_size (int): JPEGs (and HEICs) per resolution, default is 5.
+
+    Returns:
+    dict: Lists of file paths keyed by 'jpeg', 'heic' and 'webm'.
+    """
+    heic_writer = _heic_writer()
+    params = {
+        'seed': seed,
+        'images_per_size': images_per_size,
+        'jpeg_sizes': JPEG_SIZES,
+        'video_clips': VIDEO_CLIPS,
+        'heic': heic_writer is not None,
+        'webm': shutil.which('ffmpeg') is not None,
+    }
+
+    index_file = os.path.join(dest_dir, 'corpus.json')
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index['params'] == json.loads(json.dumps(params)):
+            return index['files']
+        shutil.rmtree(dest_dir)
+
+    os.makedirs(dest_dir, exist_ok=True)
+    rng = random.Random(seed)
+    files = {'jpeg': [], 'heic': [], 'webm': []}
+
+    for size_index, (width, height) in enumerate(JPEG_SIZES):
+        for i in range(images_per_size):
+            image = _image((width, height), rng)
+            # named like camera output so unix_timestamp() can parse them
+            name = f'202401{1 + i % 28:02d}_{size_index:02d}{i % 60:02d}00_{width}x{height}'
+
+            files['jpeg'].append(os.path.join(dest_dir, f'{name}.jpg'))
+            image.save(files['jpeg'][-1], 'JPEG', quality=90)
+
+            if heic_writer:
+                files['heic'].append(os.path.join(dest_dir, f'{name}.heic'))
+                heic_writer(image, files['heic'][-1])
+
+    if params['webm']:
+        for i, (size, seconds) in enumerate(VIDEO_CLIPS):
+            files['webm'].append(os.path.join(dest_dir, f'20240301_1200{i:02d}_{size[0]}x{size[1]}.webm'))
+            _webm(files['webm'][-1], size, seconds)
+    else:
+        print('ffmpeg not found, no webm clips in the corpus', file=sys.stderr)
+
+    with open(index_file, 'w') as f:
+        json.dump({'params': params, 'files': files}, f, indent=2)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dest_dir')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--images-per-size', type=int, default=5)
+    args = parser.parse_args()
+
+    for kind, paths in generate(args.dest_dir, seed=args.seed, images_per_size=args.images_per_size).items():
+        print(f'{kind}: {len(paths)} files')
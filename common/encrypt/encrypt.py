@@ -1,9 +1,13 @@
 import os
+import mmap
 import base64
 import hashlib
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
-from typing import Generator
+from typing import BinaryIO, Generator
+
+# AES block size in bytes
+BLOCK_SIZE = algorithms.AES.block_size // 8
 
 class Encrypter:
     def __init__(
@@ -11,11 +15,14 @@ class Encrypter:
         *,
         key: bytes,
         iv: bytes=None,
-        chunk_size: int=1024
+        chunk_size: int=64 * 1024,
+        mmap_threshold: int=8 * 1024 * 1024
     ):
         self.key = key
         self.iv = iv
         self.chunk_size = chunk_size
+        # files at least this big are memory-mapped rather than read into a buffer
+        self.mmap_threshold = mmap_threshold
     
     def cipher(self, iv: bytes=None) -> Cipher:
         return Cipher(
@@ -23,6 +30,16 @@ class Encrypter:
             modes.CTR(iv or self.iv)
         )
     
+    def range_cipher(self, offset: int, iv: bytes=None) -> Cipher:
+        # CTR treats the iv as a 128 bit big-endian counter that is incremented
+        # once per block, so the keystream at any block can be produced directly.
+        block = offset // BLOCK_SIZE
+        counter = (int.from_bytes(iv or self.iv, 'big') + block) % (1 << 128)
+        return Cipher(
+            algorithms.AES(self.key), 
+            modes.CTR(counter.to_bytes(16, 'big'))
+        )
+
     def encrypt_file(
         self, 
         *, 
@@ -64,9 +81,32 @@ class Encrypter:
         if not chunk_size:
             chunk_size = self.chunk_size
         
+        # update_into needs (block size - 1) bytes of headroom in the output buffer
+        out = bytearray(chunk_size + 15)
+        out_view = memoryview(out)
+
         with open(src_file, 'rb') as infile, open(dest_file, 'wb') as outfile:
-            while chunk := infile.read(chunk_size):
-                outfile.write(cipher.update(chunk))
+            if os.fstat(infile.fileno()).st_size >= self.mmap_threshold:
+                with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+                        memoryview(mapped) as view:
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    released = 0
+                    for i in range(0, len(view), chunk_size):
+                        written = cipher.update_into(view[i:i + chunk_size], out)
+                        outfile.write(out_view[:written])
+
+                        # drop the pages behind us so resident memory stays bounded
+                        done = min(i + chunk_size, len(view))
+                        if done - released >= self.mmap_threshold:
+                            boundary = done - done % mmap.PAGESIZE
+                            mapped.madvise(mmap.MADV_DONTNEED, released, boundary - released)
+                            released = boundary
+            else:
+                buffer = bytearray(chunk_size)
+                view = memoryview(buffer)
+                while read := infile.readinto(buffer):
+                    written = cipher.update_into(view[:read], out)
+                    outfile.write(out_view[:written])
             outfile.write(cipher.finalize())
 
     def encrypt_chunks(
@@ -87,7 +127,9 @@ class Encrypter:
         iv: bytes=None,
         chunk_size: int | None=None
     ) -> bytes:
-        return b''.join(list(self.encrypt_chunks(data, iv=iv, chunk_size=chunk_size)))
+        # chunk_size is accepted for symmetry with encrypt_chunks, the whole buffer
+        # goes through the cipher in one call.
+        return self._crypt(data, self.cipher(iv).encryptor())
 
     def encrypt_b32(self, data: str, iv: bytes=None) -> str:
         return base64.b32encode(
@@ -112,7 +154,17 @@ class Encrypter:
         iv: bytes=None,
         chunk_size: int | None=None
     ) -> bytes:
-        return b''.join(list(self.decrypt_chunks(data, iv=iv, chunk_size=chunk_size)))
+        return self._crypt(data, self.cipher(iv).decryptor())
+
+    def _crypt(
+        self, 
+        data: str | bytes, 
+        cipher_context: Cipher
+    ) -> bytes:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        return cipher_context.update(memoryview(data)) + cipher_context.finalize()
 
     def _encdec(
         self, 
@@ -126,9 +178,9 @@ class Encrypter:
         if not chunk_size:
             chunk_size = self.chunk_size
 
-        for i in range(0, len(data), chunk_size):
-            chunk = data[i:i + chunk_size]
-            yield cipher_context.update(chunk)
+        view = memoryview(data)
+        for i in range(0, len(view), chunk_size):
+            yield cipher_context.update(view[i:i + chunk_size])
 
         # Ensure the finalization of the encryption
         yield cipher_context.finalize()
@@ -139,6 +191,49 @@ class Encrypter:
             iv
         ).decode('utf-8')
 
+    def decrypt_range(
+        self, 
+        src: str | BinaryIO, 
+        offset: int, 
+        length: int | None=None, 
+        iv: bytes=None,
+        chunk_size: int | None=None
+    ) -> Generator[bytes, None, None]:
+        if isinstance(src, str):
+            with open(src, 'rb') as infile:
+                yield from self.decrypt_range(infile, offset, length, iv=iv, chunk_size=chunk_size)
+            return
+
+        if not chunk_size:
+            chunk_size = self.chunk_size
+
+        # start decrypting at the block holding offset, src is expected to be
+        # positioned at the start of the object
+        block_start = offset - offset % BLOCK_SIZE
+        if src.seekable():
+            src.seek(block_start, os.SEEK_CUR)
+        else:
+            skip_buffer = bytearray(min(chunk_size, block_start) or 1)
+            skipped = 0
+            while skipped < block_start:
+                read = src.readinto(memoryview(skip_buffer)[:block_start - skipped])
+                if not read:
+                    return
+                skipped += read
+
+        decryptor = self.range_cipher(offset, iv).decryptor()
+        decryptor.update(src.read(offset - block_start))
+
+        while length is None or length > 0:
+            chunk = src.read(chunk_size if length is None else min(chunk_size, length))
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield decryptor.update(chunk)
+
+        yield decryptor.finalize()
+
     @staticmethod
     def hash(data: str, iv: bytes=None):
         salt = iv.hex() if iv else ''
@@ -0,0 +1 @@
+from .latency import LatencyHistogram
\ No newline at end of file
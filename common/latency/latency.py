@@ -0,0 +1,33 @@
+import bisect
+
+class LatencyHistogram:
+    """
+    Cumulative latency histogram with fixed millisecond buckets.
+
+    Methods:
+        __init__(buckets_ms): Initialize with the bucket upper bounds, BUCKETS_MS by default.
+        observe(seconds): Count one observation.
+        snapshot(): Bucket counts, total count and summed latency.
+    """
+    BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, buckets_ms: tuple=None):
+        self.buckets_ms = buckets_ms or self.BUCKETS_MS
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets_ms, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def snapshot(self):
+        return {
+            'buckets_ms': {
+                **{str(bound): count for bound, count in zip(self.buckets_ms, self.counts)},
+                '+Inf': self.counts[-1],
+            },
+            'count': self.count,
+            'sum_ms': self.total * 1000,
+        }
@@ -0,0 +1,4 @@
+from .schema import (
+    migrate, wait_for_schema, insert_files, insert_seek_index, is_timeline_file,
+    LOCAL_DATE, TIMELINE_FILTER, SCHEMA_VERSION
+)
\ No newline at end of file
@@ -0,0 +1,190 @@
+import json
+import time
+import logging
+import sqlite3
+
+logger = logging.getLogger('schema')
+
+# the calendar day a file is listed under in the ui timeline
+LOCAL_DATE = "strftime('%Y-%m-%d', {}, 'unixepoch', 'localtime', '+9 hours')"
+
+# the files that make up the ui timeline: images, and the first chunk of each video
+TIMELINE_FILTER = r"(filename like '%.jpg' or filename like '%\_0000.webm' escape '\')"
+
+INSERT_FILE = f"""
+    insert into files (filename, unix_timestamp, email, dek, local_date)
+    values (:filename, :unix_timestamp, :email, :dek, {LOCAL_DATE.format(':unix_timestamp')})
+    on conflict (filename) do nothing
+"""
+
+# seq is a change counter, readers pick up the days whose seq is past the last one they saw
+COUNT_FILE = f"""
+    insert into daily_counts (local_date, count, seq)
+    values ({LOCAL_DATE.format(':unix_timestamp')}, 1, (select coalesce(max(seq), 0) + 1 from daily_counts))
+    on conflict (local_date) do update set count = count + 1, seq = excluded.seq
+"""
+
+# applied in order, PRAGMA user_version records how many have been applied
+MIGRATIONS = [
+    # (segment, offset, length) of each thumbnail in the packed thumbnail store,
+    # keyed by the timeline filename (name.webm for a video's name_0000.webm)
+    """
+    create table if not exists thumbnails (
+        filename text primary key,
+        segment integer not null,
+        offset integer not null,
+        length integer not null
+    );
+    """,
+
+    # precomputed timeline date, and a covering index over just the timeline
+    # rows so /thumbnails can seek straight to a (unix_timestamp, filename) cursor
+    f"""
+    alter table files add column local_date text;
+    update files set local_date = {LOCAL_DATE.format('unix_timestamp')};
+    create index files_timeline on files (unix_timestamp desc, filename desc, local_date)
+        where {TIMELINE_FILTER};
+    """,
+
+    # number of timeline files per day, kept up to date by insert_files
+    f"""
+    create table daily_counts (
+        local_date text primary key,
+        count integer not null,
+        seq integer not null
+    );
+    create index daily_counts_seq on daily_counts (seq);
+    insert into daily_counts
+        select local_date, count(*), 0 from files where {TIMELINE_FILTER} group by local_date;
+    """,
+
+    # ingest stages each sanitized file (or video chunk) has completed, by content hash.
+    # detail holds the server a file was encrypted for.
+    """
+    create table manifest (
+        hash text not null,
+        stage text not null,
+        filename text not null,
+        detail text,
+        completed_at integer not null,
+        primary key (hash, stage)
+    );
+    create index manifest_detail on manifest (stage, detail);
+    """,
+
+    # seek index of chunked videos: the time (ms from the start) each chunk starts playing at.
+    # filename is the video's name, e.g. name.webm for name_0000.webm, name_0001.webm, ...
+    """
+    create table video_chunks (
+        filename text not null,
+        chunk integer not null,
+        start_ms integer not null,
+        primary key (filename, chunk)
+    ) without rowid;
+    """,
+
+    # a file uploaded again (e.g. by a rerun after a crash) used to get a second files row,
+    # which the timeline showed twice and daily_counts counted twice.  of each file's rows keep
+    # the one the manifest has as uploaded to that row's server, otherwise the latest (an
+    # earlier row can be from a run that crashed before its object was uploaded), recount
+    # the days and make filename unique so it can't happen again.
+    # the recounted days get a new seq so running uis pick the new counts up
+    f"""
+    delete from files where rowid in (
+        select rowid from (
+            select rowid, row_number() over (
+                partition by filename
+                order by exists (
+                    select 1 from manifest
+                    where stage = 'uploaded' and manifest.filename = files.filename
+                        and ',' || manifest.detail || ',' like '%,' || files.email || ',%'
+                ) desc, rowid desc
+            ) as rank
+            from files
+        )
+        where rank > 1
+    );
+    create unique index files_filename on files (filename);
+    create temp table recount (seq integer);
+    insert into recount select coalesce(max(seq), 0) + 1 from daily_counts;
+    delete from daily_counts;
+    insert into daily_counts
+        select local_date, count(*), (select seq from recount)
+        from files where {TIMELINE_FILTER} group by local_date;
+    drop table recount;
+    """,
+]
+
+# the user_version of a database migrated as far as this code goes
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def is_timeline_file(filename: str) -> bool:
+    # python side of TIMELINE_FILTER
+    return filename.endswith('.jpg') or filename.endswith('_0000.webm')
+
+def insert_files(cursor: sqlite3.Cursor, rows: list[dict]) -> None:
+    """
+    Insert files rows and bump the daily counts in the caller's transaction.
+    A file that already has a row is skipped and not counted again.
+
+    Args:
+    cursor (sqlite3.Cursor): The cursor to write with, the caller commits.
+    rows (list[dict]): filename, unix_timestamp, email and dek of each file.
+    """
+    # INSERT_FILE leaves files that already have a row alone, so find them up front
+    # (one lookup on files_filename) rather than inserting row by row to see which went in
+    existing = {filename for filename, in cursor.execute(
+        'select filename from files where filename in (select value from json_each(?))',
+        (json.dumps([row['filename'] for row in rows]),)
+    )}
+    new = {}
+    for row in rows:
+        if row['filename'] not in existing:
+            new.setdefault(row['filename'], row)
+
+    cursor.executemany(INSERT_FILE, new.values())
+    cursor.executemany(COUNT_FILE, [row for row in new.values() if is_timeline_file(row['filename'])])
+
+def insert_seek_index(cursor: sqlite3.Cursor, rows: list[dict]) -> None:
+    """
+    Record where each chunk of a video starts, in the caller's transaction.
+
+    Args:
+    cursor (sqlite3.Cursor): The cursor to write with, the caller commits.
+    rows (list[dict]): filename, chunk and start_ms of each chunk.
+    """
+    cursor.executemany(
+        'insert or replace into video_chunks (filename, chunk, start_ms) values (:filename, :chunk, :start_ms)',
+        rows
+    )
+
+def wait_for_schema(db_file: str, *, timeout: float=0.0, poll_interval: float=5.0) -> None:
+    """
+    Wait for the writer (the uploader) to migrate the database, without writing to it.
+
+    Args:
+    db_file (str): The database, opened read-only.
+    timeout (float): Seconds to wait for it, default is 0, check once.
+    poll_interval (float): Seconds between checks, default is 5.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+        try:
+            version = conn.execute('pragma user_version').fetchone()[0]
+        finally:
+            conn.close()
+        if version >= SCHEMA_VERSION:
+            return
+        if time.monotonic() >= deadline:
+            raise RuntimeError(
+                f'{db_file} is at schema version {version}, {SCHEMA_VERSION} is needed: run the uploader to migrate it'
+            )
+        logger.info(f'waiting for {db_file} to be migrated from schema version {version} to {SCHEMA_VERSION}')
+        time.sleep(poll_interval)
+
+def migrate(conn: sqlite3.Connection) -> None:
+    version = conn.execute('pragma user_version').fetchone()[0]
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f'applying migration {number}')
+        conn.executescript(f'begin; {script} pragma user_version = {number}; commit;')
@@ -0,0 +1,3 @@
+from .backend import StorageBackend, StorageError
+from .local import LocalBackend
+from .megatools import MegatoolsBackend, parse_progress
\ No newline at end of file
@@ -0,0 +1,101 @@
+import time
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Collection, Iterator
+
+from common.latency import LatencyHistogram
+
+class StorageError(Exception):
+    """
+    Raised when a storage operation fails.
+    """
+
+class StorageBackend(ABC):
+    """
+    Object storage split into accounts, each holding a flat namespace of encrypted objects.
+
+    Every operation's latency is recorded per operation name; get_stream is
+    recorded once the stream has been read to the end.
+
+    Methods:
+        put_many(account, filepaths, progress, replace): Upload local files, named after their basename,
+            skipping any that already exist unless they're to be replaced.
+        get_stream(account, name): Yield the object's bytes as they arrive.
+        get_stream_async(account, name, chunk_size): get_stream for asyncio callers.
+        exists(account, name): Whether the object exists.
+        stats(): Latency histograms keyed by operation.
+    """
+    # storage round trips run from milliseconds to minutes
+    BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    @abstractmethod
+    def put_many(
+        self,
+        account: str,
+        filepaths: list[str],
+        progress: Callable[[dict], None]=None,
+        *,
+        replace: Collection[str]=()
+    ) -> None:
+        """
+        Args:
+        account (str): The account to upload to.
+        filepaths (list[str]): The files to upload.
+        progress (callable): Called with file, done, total and speed (bytes/sec or None)
+            as the upload progresses.
+        replace (Collection[str]): Names uploaded over an existing object rather than skipped,
+            for the few objects that aren't named after their content.
+        """
+
+    @abstractmethod
+    def get_stream(self, account: str, name: str) -> Iterator[bytes]:
+        pass
+
+    async def get_stream_async(self, account: str, name: str, *, chunk_size: int | None=None) -> AsyncIterator[bytes]:
+        """
+        Yield the object's bytes as they arrive, without blocking the event loop.
+
+        By default get_stream is stepped through in the loop's executor; backends with
+        a native asyncio transport override this.  Close the iterator (contextlib.aclosing)
+        to stop a download early.
+
+        Args:
+        account (str): The account holding the object.
+        name (str): The object.
+        chunk_size (int): The most bytes per chunk, where the backend lets the caller choose.
+        """
+        loop = asyncio.get_running_loop()
+        stream = self.get_stream(account, name)
+        try:
+            while chunk := await loop.run_in_executor(None, next, stream, b''):
+                yield chunk
+        finally:
+            stream.close()
+
+    @abstractmethod
+    def exists(self, account: str, name: str) -> bool:
+        pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {operation: histogram.snapshot() for operation, histogram in self.histograms.items()}
+
+    @contextmanager
+    def _timed(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe(operation, time.perf_counter() - start)
+
+    def _observe(self, operation, seconds):
+        with self.lock:
+            if operation not in self.histograms:
+                self.histograms[operation] = LatencyHistogram(self.BUCKETS_MS)
+            self.histograms[operation].observe(seconds)
@@ -0,0 +1,60 @@
+import os
+import shutil
+from typing import Callable, Collection, Iterator
+
+from .backend import StorageBackend, StorageError
+
+class LocalBackend(StorageBackend):
+    """
+    Storage in a local directory, one subdirectory per account.
+
+    For tests and on-prem mirrors.  Writes go through a temporary file so a
+    reader never sees a partial object.
+
+    Methods:
+        __init__(root, chunk_size): Initialize with the directory holding the accounts.
+    """
+    def __init__(self, root: str, *, chunk_size: int=1024 * 1024):
+        super().__init__()
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def _path(self, account, name=''):
+        return os.path.join(self.root, account, name)
+
+    def put_many(
+        self,
+        account: str,
+        filepaths: list[str],
+        progress: Callable[[dict], None]=None,
+        *,
+        replace: Collection[str]=()
+    ) -> None:
+        with self._timed('put_many'):
+            os.makedirs(self._path(account), exist_ok=True)
+            for filepath in filepaths:
+                name = os.path.basename(filepath)
+                size = os.path.getsize(filepath)
+                # os.replace swaps a replaced object in whole
+                if name in replace or not self.exists(account, name):
+                    try:
+                        shutil.copyfile(filepath, f'{self._path(account, name)}.tmp')
+                        os.replace(f'{self._path(account, name)}.tmp', self._path(account, name))
+                    except OSError as e:
+                        raise StorageError(f'put of {name} to {account} failed') from e
+
+                if progress:
+                    progress({'file': filepath, 'done': size, 'total': size, 'speed': None})
+
+    def get_stream(self, account: str, name: str) -> Iterator[bytes]:
+        with self._timed('get'):
+            try:
+                with open(self._path(account, name), 'rb') as f:
+                    while chunk := f.read(self.chunk_size):
+                        yield chunk
+            except OSError as e:
+                raise StorageError(f'get of {name} from {account} failed') from e
+
+    def exists(self, account: str, name: str) -> bool:
+        with self._timed('exists'):
+            return os.path.exists(self._path(account, name))
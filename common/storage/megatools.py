@@ -0,0 +1,257 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import tempfile
+import threading
+import subprocess
+from typing import AsyncIterator, Callable, Collection, Iterator
+
+from .backend import StorageBackend, StorageError
+
+logger = logging.getLogger('storage')
+
+UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4}
+
+# megatools put/copy progress, e.g.
+# /work/a@x/3f2a...: 45.51% - 1.1 MiB (1193984 bytes) of 2.4 MiB (526.1 KiB/s)
+PROGRESS = re.compile(
+    r'^(?P<file>.+?): (?P<percent>[\d.]+)% - .*?\((?P<done>\d+) bytes\) of '
+    r'(?P<total>[\d.]+) (?P<total_unit>[KMGT]?i?B)'
+    r'(?: \((?P<speed>[\d.]+) (?P<speed_unit>[KMGT]?i?B)/s\))?'
+)
+
+def parse_progress(line):
+    """
+    Parse one megatools progress line.
+
+    Returns:
+    dict | None: file, done and total bytes and bytes/sec (None if not reported),
+        or None if the line isn't a progress line.
+    """
+    match = PROGRESS.match(line.strip())
+    if not match:
+        return None
+
+    return {
+        'file': match['file'],
+        'done': int(match['done']),
+        'total': int(float(match['total']) * UNITS.get(match['total_unit'], 1)),
+        'speed': float(match['speed']) * UNITS.get(match['speed_unit'], 1) if match['speed'] else None,
+    }
+
+class MegatoolsBackend(StorageBackend):
+    """
+    MEGA storage through the megatools cli, with a bounded pool of workers per account.
+
+    megatools has no daemon mode, so every operation is still a process, but an
+    account's state is kept for the life of the backend instead of being rebuilt
+    per request: the password is decrypted once and written to a private config
+    file (so it is no longer on the command line either), megatools' own session
+    and filesystem cache is left to be reused between calls, the remote listing is
+    cached so exists() and skipping already-uploaded files cost no round trip, and
+    at most workers_per_account processes run against an account at once.
+
+    Methods:
+        __init__(credentials, binary, workers_per_account, remote_root, listing_ttl, chunk_size):
+            Initialize with a callable mapping an account to its password.
+        close(): Remove the config files.
+    """
+    # megatools put takes many files at once, within reason for the command line
+    PUT_BATCH = 256
+
+    def __init__(
+        self,
+        credentials: Callable[[str], str],
+        *,
+        binary: str='megatools',
+        workers_per_account: int=2,
+        remote_root: str='/Root',
+        listing_ttl: float=60.0,
+        chunk_size: int=64 * 1024
+    ):
+        super().__init__()
+        self.credentials = credentials
+        self.binary = binary
+        self.workers_per_account = workers_per_account
+        self.remote_root = remote_root
+        self.listing_ttl = listing_ttl
+        self.chunk_size = chunk_size
+
+        self.config_dir = tempfile.TemporaryDirectory(prefix='megatools_')
+        self.accounts = {}
+
+    def _account(self, account):
+        with self.lock:
+            if account not in self.accounts:
+                config_file = os.path.join(self.config_dir.name, f'{len(self.accounts)}.megarc')
+                descriptor = os.open(config_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(descriptor, 'w') as f:
+                    f.write(f'[Login]\nUsername = {account}\nPassword = {self.credentials(account)}\n')
+
+                self.accounts[account] = {
+                    'config': config_file,
+                    'workers': threading.BoundedSemaphore(self.workers_per_account),
+                    'names': None,
+                    'listed_at': 0.0,
+                    'lock': threading.Lock(),
+                }
+            return self.accounts[account]
+
+    def _command(self, state, operation, *args):
+        return [self.binary, operation, '--config', state['config'], *args]
+
+    def _names(self, account, state, *, refresh=False):
+        with state['lock']:
+            if refresh or state['names'] is None or time.monotonic() - state['listed_at'] > self.listing_ttl:
+                with self._timed('list'), state['workers']:
+                    result = subprocess.run(
+                        self._command(state, 'ls', self.remote_root),
+                        capture_output=True,
+                        universal_newlines=True
+                    )
+                if result.returncode != 0:
+                    raise StorageError(f'listing {account} failed: {result.stderr.strip()}')
+
+                prefix = self.remote_root.rstrip('/') + '/'
+                state['names'] = {line[len(prefix):] for line in result.stdout.splitlines() if line.startswith(prefix)}
+                state['listed_at'] = time.monotonic()
+            return state['names']
+
+    def exists(self, account: str, name: str) -> bool:
+        with self._timed('exists'):
+            state = self._account(account)
+            if name in self._names(account, state):
+                return True
+            # the cached listing may predate the object
+            return name in self._names(account, state, refresh=True)
+
+    def put_many(
+        self,
+        account: str,
+        filepaths: list[str],
+        progress: Callable[[dict], None]=None,
+        *,
+        replace: Collection[str]=()
+    ) -> None:
+        with self._timed('put_many'):
+            state = self._account(account)
+            existing = self._names(account, state, refresh=True)
+
+            # megatools put won't overwrite, so replaced objects are removed first
+            # (which also drops them from existing, the cached listing)
+            stale = [name for name in map(os.path.basename, filepaths) if name in replace and name in existing]
+            if stale:
+                with state['workers']:
+                    self._remove(account, state, stale)
+
+            pending = []
+            for filepath in filepaths:
+                if os.path.basename(filepath) in existing:
+                    if progress:
+                        size = os.path.getsize(filepath)
+                        progress({'file': filepath, 'done': size, 'total': size, 'speed': None})
+                else:
+                    pending.append(filepath)
+
+            for i in range(0, len(pending), self.PUT_BATCH):
+                batch = pending[i:i + self.PUT_BATCH]
+                with state['workers']:
+                    self._put(account, state, batch, progress)
+                with state['lock']:
+                    state['names'].update(os.path.basename(filepath) for filepath in batch)
+
+    def _remove(self, account, state, names):
+        result = subprocess.run(
+            self._command(state, 'rm', *(f'{self.remote_root}/{name}' for name in names)),
+            capture_output=True,
+            universal_newlines=True
+        )
+        with state['lock']:
+            # whatever happened, the listing can't be trusted for these any more
+            state['names'].difference_update(names)
+        if result.returncode != 0:
+            raise StorageError(f'removing {len(names)} objects from {account} failed: {result.stderr.strip()}')
+
+    def _put(self, account, state, filepaths, progress):
+        process = subprocess.Popen(
+            self._command(state, 'put', '--path', self.remote_root, *filepaths),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True
+        )
+
+        # megatools redraws progress with carriage returns
+        for line in process.stdout:
+            for part in line.split('\r'):
+                if not part.strip():
+                    continue
+                if parsed := parse_progress(part):
+                    if progress:
+                        progress(parsed)
+                else:
+                    logger.debug(f'{account}: {part.strip()}')
+
+        if process.wait() != 0:
+            raise StorageError(f'put to {account} exited with {process.returncode}')
+
+    def get_stream(self, account: str, name: str) -> Iterator[bytes]:
+        state = self._account(account)
+        start = time.perf_counter()
+        with state['workers']:
+            process = subprocess.Popen(
+                self._command(state, 'get', '--no-progress', '--path', '-', f'{self.remote_root}/{name}'),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            try:
+                while chunk := process.stdout.read(self.chunk_size):
+                    yield chunk
+                if process.wait() != 0:
+                    raise StorageError(f'get of {name} from {account} failed: {process.stderr.read().decode().strip()}')
+            finally:
+                # the reader may have stopped early
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+                process.stderr.close()
+        self._observe('get', time.perf_counter() - start)
+
+    async def get_stream_async(self, account: str, name: str, *, chunk_size: int | None=None) -> AsyncIterator[bytes]:
+        chunk_size = chunk_size or self.chunk_size
+        state = self._account(account)
+        start = time.perf_counter()
+
+        # the account's worker limit is shared with the threaded callers, poll for a slot
+        # rather than parking an executor thread on the semaphore
+        while not state['workers'].acquire(blocking=False):
+            await asyncio.sleep(0.05)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self._command(state, 'get', '--no-progress', '--path', '-', f'{self.remote_root}/{name}'),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                # the pipe stops being read once this much is buffered, so a slow
+                # consumer stalls megatools instead of growing the buffer
+                limit=chunk_size
+            )
+            try:
+                while chunk := await process.stdout.read(chunk_size):
+                    yield chunk
+                if await process.wait() != 0:
+                    stderr = await process.stderr.read()
+                    raise StorageError(f'get of {name} from {account} failed: {stderr.decode().strip()}')
+            finally:
+                # the reader may have stopped early.  wait() only returns once the pipes
+                # are closed, so whatever is left in them is read off too
+                if process.returncode is None:
+                    process.kill()
+                    await process.communicate()
+        finally:
+            state['workers'].release()
+        self._observe('get', time.perf_counter() - start)
+
+    def close(self) -> None:
+        self.config_dir.cleanup()
@@ -0,0 +1 @@
+from .thumbstore import ThumbnailStore
\ No newline at end of file
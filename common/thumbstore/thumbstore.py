@@ -0,0 +1,89 @@
+import os
+import mmap
+import glob
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger('thumbstore')
+
+class ThumbnailStore:
+    """
+    Thumbnails packed back to back into append-only segment files.
+
+    The uploader appends each thumbnail to the newest segment and records its
+    (segment, offset, length) in the thumbnails table; the ui memory-maps the
+    segments and serves each thumbnail as a single slice.
+
+    Methods:
+        __init__(directory, segment_bytes): Initialize with the directory holding the segments.
+        add(cursor, filename, data): Append a thumbnail and index it under filename.
+        sync(): fsync what's been appended, before the index rows are committed.
+        read(segment, offset, length): Return the bytes of one thumbnail.
+        close(): Close the open segment and every mapping.
+    """
+    def __init__(self, directory: str, segment_bytes: int=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.writer = None
+        self.writer_segment = None
+        self.maps = {}
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'segment_{segment:05d}.pack')
+
+    def add(self, cursor: sqlite3.Cursor, filename: str, data: bytes) -> None:
+        segment, offset = self._append(data)
+        cursor.execute('insert or replace into thumbnails values (?, ?, ?, ?)', [
+            filename,
+            segment,
+            offset,
+            len(data)
+        ])
+
+    def sync(self) -> None:
+        # once this returns the appended thumbnails survive a crash, so their index rows
+        # can be committed and the source files removed
+        if self.writer:
+            os.fsync(self.writer.fileno())
+
+    def read(self, segment: int, offset: int, length: int) -> bytes:
+        with self.lock:
+            mapped = self.maps.get(segment)
+            if mapped is None or offset + length > len(mapped):
+                # not mapped yet, or the segment has grown since it was mapped
+                if mapped is not None:
+                    mapped.close()
+                with open(self.segment_path(segment), 'rb') as f:
+                    mapped = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapped[offset:offset + length]
+
+    def close(self) -> None:
+        with self.lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
+
+    def _append(self, data):
+        if self.writer is None:
+            os.makedirs(self.directory, exist_ok=True)
+            segments = sorted(glob.glob(os.path.join(self.directory, 'segment_*.pack')))
+            self.writer_segment = int(os.path.basename(segments[-1])[8:13]) if segments else 0
+            self.writer = open(self.segment_path(self.writer_segment), 'ab')
+
+        if self.writer.tell() and self.writer.tell() + len(data) > self.segment_bytes:
+            # sync() only sees the open segment
+            os.fsync(self.writer.fileno())
+            self.writer.close()
+            self.writer_segment += 1
+            self.writer = open(self.segment_path(self.writer_segment), 'ab')
+
+        offset = self.writer.tell()
+        self.writer.write(data)
+        # readers map the file, so the bytes must be in it before the index row is
+        self.writer.flush()
+        return self.writer_segment, offset
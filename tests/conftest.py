@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the uploader and ui import their own modules flat (they're run from their own
+# directories), and both import common from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'uploader'), os.path.join(ROOT, 'ui')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,52 @@
+import os
+
+from chunker import (
+    plan_chunks, parse_clusters, seek_index,
+    EBML, SEGMENT, INFO, TIMECODE_SCALE, TRACKS, TRACK_ENTRY, TRACK_NUMBER, TRACK_TYPE, CLUSTER, TIMECODE, SIMPLE_BLOCK
+)
+
+MiB = 1024 * 1024
+
+def element(element_id, data):
+    # every size as an 8 byte vint
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + (1 << 56 | len(data)).to_bytes(8, 'big') + data
+
+def webm(filepath, clusters):
+    # a minimal webm with one video track and a cluster per (timecode, keyframe, size)
+    body = element(INFO, element(TIMECODE_SCALE, (1_000_000).to_bytes(3, 'big')))
+    body += element(TRACKS, element(TRACK_ENTRY, element(TRACK_NUMBER, b'\x01') + element(TRACK_TYPE, b'\x01')))
+    for timecode, keyframe, size in clusters:
+        block = b'\x81\x00\x00' + (b'\x80' if keyframe else b'\x00') + bytes(size)
+        body += element(CLUSTER, element(TIMECODE, timecode.to_bytes(4, 'big')) + element(SIMPLE_BLOCK, block))
+    with open(filepath, 'wb') as f:
+        f.write(element(EBML, b'') + element(SEGMENT, body))
+
+def test_sparse_keyframes_are_cut_at_cluster_boundaries(tmp_path):
+    # a keyframe at the start and another 30 seconds in, with 9MiB of frames before it
+    filepath = tmp_path / 'static.webm'
+    webm(filepath, [(second * 1000, second in (0, 30), 300 * 1024) for second in range(40)])
+    clusters, _ = parse_clusters(str(filepath))
+    keyframes = {cluster.offset: cluster.timecode for cluster in clusters if cluster.keyframe}
+
+    for _ in range(20):
+        plan = plan_chunks(str(filepath))
+        assert plan[0].offset == 0
+        assert sum(chunk.length for chunk in plan) == os.path.getsize(filepath)
+        assert all(chunk.length <= 4 * MiB for chunk in plan)
+        for chunk in plan[1:]:
+            assert chunk.offset in {cluster.offset for cluster in clusters}
+            # only chunks starting on a keyframe can be seeked to
+            assert chunk.start_ms == keyframes.get(chunk.offset)
+
+        index = seek_index('static.webm', plan)
+        assert index[0] == {'filename': 'static.webm', 'chunk': 0, 'start_ms': 0}
+        assert all(row['start_ms'] in keyframes.values() for row in index)
+
+def test_dense_keyframes_cut_on_keyframes_within_the_target(tmp_path):
+    filepath = tmp_path / 'moving.webm'
+    webm(filepath, [(second * 1000, True, 300 * 1024) for second in range(40)])
+
+    plan = plan_chunks(str(filepath))
+    assert all(chunk.start_ms is not None for chunk in plan)
+    # cut at the first keyframe past a target of at most 2MiB
+    assert all(chunk.length <= 2 * MiB + 300 * 1024 + 64 for chunk in plan)
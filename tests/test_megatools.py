@@ -0,0 +1,124 @@
+import os
+import stat
+
+import pytest
+
+from common.storage import MegatoolsBackend, StorageError
+from upload import upload_all
+
+TOOLS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools')
+EMAIL = 'a@example.com'
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    # megatools is tools/fake_megatools, found on PATH like the real one
+    monkeypatch.setenv('PATH', f"{TOOLS}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('fake_megatools_root', str(tmp_path / 'remote'))
+    # slow enough that each file is reported a few times before it's done
+    monkeypatch.setenv('fake_megatools_bps', str(1024 * 1024))
+    monkeypatch.delenv('fake_megatools_fail', raising=False)
+    return tmp_path / 'remote' / EMAIL
+
+@pytest.fixture
+def passwords():
+    # the accounts whose password was asked for
+    return []
+
+@pytest.fixture
+def backend(passwords):
+    backend = MegatoolsBackend(lambda account: passwords.append(account) or 'password', binary='fake_megatools')
+    yield backend
+    backend.close()
+
+@pytest.fixture
+def staging(tmp_path):
+    directory = tmp_path / 'staging'
+    directory.mkdir()
+    for i in range(3):
+        (directory / f'object{i}').write_bytes(os.urandom(256 * 1024 + i))
+    return directory
+
+def filepaths(directory):
+    return sorted(str(path) for path in directory.iterdir())
+
+def test_logs_in_with_a_private_config_file(remote, backend, passwords, staging):
+    backend.put_many(EMAIL, filepaths(staging)[:1])
+    backend.put_many(EMAIL, filepaths(staging)[1:])
+
+    # fake_megatools only knows the account from the config file
+    assert sorted(os.listdir(remote)) == ['.attempts', 'object0', 'object1', 'object2']
+    # the password is decrypted once per account
+    assert passwords == [EMAIL]
+    config = backend.accounts[EMAIL]['config']
+    assert stat.S_IMODE(os.stat(config).st_mode) == 0o600
+    assert 'Password = password' in open(config).read()
+
+def test_exists_uses_the_cached_listing(remote, backend, staging):
+    backend.put_many(EMAIL, filepaths(staging))
+    os.remove(remote / 'object0')
+    # still listed from the upload, no round trip
+    assert backend.exists(EMAIL, 'object0')
+
+    # a name missing from the cached listing is looked up again
+    (remote / 'elsewhere').write_bytes(b'x')
+    assert backend.exists(EMAIL, 'elsewhere')
+    assert not backend.exists(EMAIL, 'missing')
+
+def test_put_many_batches_and_reports_progress(remote, backend, staging, monkeypatch):
+    batches = []
+    put = backend._put
+    def record_put(account, state, batch, progress):
+        batches.append([os.path.basename(filepath) for filepath in batch])
+        put(account, state, batch, progress)
+    monkeypatch.setattr(backend, '_put', record_put)
+    monkeypatch.setattr(backend, 'PUT_BATCH', 2)
+
+    reports = []
+    backend.put_many(EMAIL, filepaths(staging), progress=reports.append)
+
+    assert batches == [['object0', 'object1'], ['object2']]
+    for filepath in filepaths(staging):
+        done = [report['done'] for report in reports if report['file'] == filepath]
+        assert len(done) > 1
+        assert done == sorted(done)
+        assert done[-1] == os.path.getsize(filepath)
+    assert all(report['speed'] == 1024 * 1024 for report in reports)
+
+    # a rerun skips what is already uploaded, reporting it as done
+    reports.clear()
+    backend.put_many(EMAIL, filepaths(staging), progress=reports.append)
+    assert len(batches) == 2
+    assert [report['done'] for report in reports] == [os.path.getsize(filepath) for filepath in filepaths(staging)]
+
+def test_put_many_replaces_only_the_named_objects(remote, backend, staging):
+    backend.put_many(EMAIL, filepaths(staging))
+    originals = {name: (remote / name).read_bytes() for name in ('object0', 'object1')}
+    for name in originals:
+        (staging / name).write_bytes(b'changed')
+
+    backend.put_many(EMAIL, filepaths(staging), replace={'object0'})
+    assert (remote / 'object0').read_bytes() == b'changed'
+    assert (remote / 'object1').read_bytes() == originals['object1']
+    assert backend.exists(EMAIL, 'object0')
+
+def test_failed_put_raises(remote, backend, staging, monkeypatch):
+    monkeypatch.setenv('fake_megatools_fail', '1')
+    with pytest.raises(StorageError):
+        backend.put_many(EMAIL, filepaths(staging))
+    assert not (remote / 'object0').exists()
+
+@pytest.mark.parametrize('failures, ok, attempts', [(1, True, 2), (5, False, 3)])
+def test_upload_all_retries_and_summarizes(remote, backend, staging, monkeypatch, failures, ok, attempts):
+    monkeypatch.setenv('fake_megatools_fail', str(failures))
+    summaries = upload_all(
+        [{'email': EMAIL}], storage=backend, local_dir=lambda server: str(staging), retries=2, backoff=0
+    )
+
+    total = sum(os.path.getsize(filepath) for filepath in filepaths(staging))
+    assert len(summaries) == 1
+    summary = summaries[0]
+    assert (summary['email'], summary['ok'], summary['attempts'], summary['bytes']) == (EMAIL, ok, attempts, total)
+    assert (summary['bytes_per_sec'] > 0) == ok
+    assert sorted(name for name in os.listdir(remote) if not name.startswith('.')) == (
+        ['object0', 'object1', 'object2'] if ok else []
+    )
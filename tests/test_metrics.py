@@ -0,0 +1,19 @@
+import json
+
+from metrics import StageMetrics
+
+def test_latency_sample_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(StageMetrics, 'RESERVOIR', 100)
+    metrics = StageMetrics()
+    for i in range(10000):
+        metrics.record('sanitize', nbytes=1, seconds=i / 10000)
+
+    assert len(metrics.stages['sanitize']['latencies']) == 100
+    summary = metrics.summary()['stages']['sanitize']
+    assert summary['files'] == 10000
+    assert summary['latency_seconds']['max'] == 0.9999
+    # a uniform sample keeps the percentiles close
+    assert abs(summary['latency_seconds']['p50'] - 0.5) < 0.2
+
+    metrics.write_json(tmp_path / 'metrics.json')
+    assert json.loads((tmp_path / 'metrics.json').read_text())['stages']['sanitize']['files'] == 10000
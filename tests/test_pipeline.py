@@ -0,0 +1,110 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+
+import pytest
+
+pytest.importorskip('PIL')
+pytest.importorskip('magic')
+pytest.importorskip('pyheif')
+
+from PIL import Image
+
+from common.encrypt import Encrypter
+from pipeline import Pipeline
+
+KEY = bytes(range(32))
+IV = bytes(range(16))
+EMAIL = 'a@example.com'
+
+@pytest.fixture
+def mega_root(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    encrypter = Encrypter(key=KEY, iv=IV)
+    server_dek = os.urandom(16)
+    with sqlite3.connect(root / 'database.db') as conn:
+        conn.executescript("""
+            create table servers (email text primary key, mega_pw blob, dek blob);
+            create table files (filename text, unix_timestamp integer, email text, dek blob);
+        """)
+        conn.execute(
+            'insert into servers values (?, ?, ?)',
+            (EMAIL, encrypter.encrypt(b'password', iv=server_dek), encrypter.encrypt(server_dek))
+        )
+
+    sanitized = root / 'sanitized'
+    sanitized.mkdir()
+    for i in range(5):
+        Image.new('RGB', (640, 480 + i), 'green').save(sanitized / f'2024010{i + 1}_101010.jpg')
+    return root
+
+def run_pipeline(tmp_path, mega_root, pipeline_mode):
+    # one run over whatever is in sanitized/, returns the number of files rows
+    pipeline = Pipeline(
+        str(mega_root),
+        key=KEY,
+        iv=IV,
+        ui_static_dir=str(tmp_path / 'static'),
+        pipeline_mode=pipeline_mode,
+        storage_backend='local',
+        storage_dir=str(tmp_path / 'storage'),
+        thumbnail_workers=1
+    )
+    try:
+        pipeline.run()
+        with sqlite3.connect(mega_root / 'database.db') as conn:
+            return conn.execute('select count(*) from files').fetchone()[0]
+    finally:
+        pipeline.close()
+
+def remote_backup_counts(tmp_path):
+    # files and thumbnails rows in the backup uploaded to storage
+    encrypter = Encrypter(key=KEY, iv=IV)
+    restored = tmp_path / 'restored.db'
+    encrypter.decrypt_file(
+        src_file=str(tmp_path / 'storage' / EMAIL / encrypter.hash(EMAIL)),
+        dest_file=str(restored)
+    )
+    with sqlite3.connect(restored) as conn:
+        return (
+            conn.execute('select count(*) from files').fetchone()[0],
+            conn.execute('select count(*) from thumbnails').fetchone()[0]
+        )
+
+@pytest.mark.parametrize('pipeline_mode', ['batch', 'streaming'])
+def test_uploaded_backup_holds_every_row(tmp_path, mega_root, pipeline_mode):
+    live = run_pipeline(tmp_path, mega_root, pipeline_mode)
+    assert live == 5
+    assert remote_backup_counts(tmp_path) == (live, live)
+
+def test_uploaded_backup_is_replaced_by_later_runs(tmp_path, mega_root):
+    run_pipeline(tmp_path, mega_root, 'batch')
+    Image.new('RGB', (640, 480), 'blue').save(mega_root / 'sanitized' / '20240106_101010.jpg')
+    live = run_pipeline(tmp_path, mega_root, 'batch')
+    assert live == 6
+    assert remote_backup_counts(tmp_path) == (live, live)
+
+def make_video(filepath):
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=2:size=160x120:rate=10',
+        '-c:v', 'libvpx', '-b:v', '200k', str(filepath)
+    ], check=True)
+
+@pytest.mark.skipif(not (shutil.which('ffmpeg') and shutil.which('ffprobe')), reason='needs ffmpeg and ffprobe')
+@pytest.mark.parametrize('pipeline_mode', ['batch', 'streaming'])
+def test_rerun_publishes_only_new_previews(tmp_path, mega_root, pipeline_mode):
+    make_video(mega_root / 'sanitized' / '20240201_101010.webm')
+    first = run_pipeline(tmp_path, mega_root, pipeline_mode)
+
+    # the second run finds the first one's video already done, next to a new one
+    make_video(mega_root / 'sanitized' / '20240202_101010.webm')
+    assert run_pipeline(tmp_path, mega_root, pipeline_mode) > first
+
+    previews = tmp_path / 'static' / 'previews'
+    assert sorted(os.listdir(previews)) == sorted(
+        [f'2024010{i + 1}_101010.jpg' for i in range(5)] + ['20240201_101010_0000.webm', '20240202_101010_0000.webm']
+    )
+    assert os.listdir(mega_root / 'previews') == []
+    assert os.listdir(mega_root / 'video_chunks') == []
@@ -0,0 +1,26 @@
+import threading
+
+from prefetch import Prefetcher
+
+def test_idle_viewers_expire_when_work_is_scheduled(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('prefetch.time.monotonic', lambda: now[0])
+    # every load blocks, so the queued chunks are still pending when their viewer expires
+    release = threading.Event()
+    prefetcher = Prefetcher(depth=2, max_concurrent=1, idle_timeout=60)
+    try:
+        prefetcher.schedule('closed tab', 'a.webm', 0, lambda index: release.wait())
+        now[0] += 30
+        prefetcher.schedule('watching', 'b.webm', 0, lambda index: release.wait())
+        assert prefetcher.stats()['viewers'] == 2
+
+        now[0] += 45
+        prefetcher.schedule('watching', 'b.webm', 1, lambda index: release.wait())
+        stats = prefetcher.stats()
+        assert list(prefetcher.viewers) == ['watching']
+        assert stats['expired'] == 1
+        # the closed tab's chunk that hadn't started was dropped with it
+        assert stats['cancelled'] == 1
+    finally:
+        release.set()
+        prefetcher.executor.shutdown(wait=True)
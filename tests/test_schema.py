@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+
+import pytest
+
+from common.schema import migrate, wait_for_schema, insert_files
+from common.schema.schema import MIGRATIONS
+
+def row(filename, unix_timestamp, *, email='a@example.com', dek=b'dek'):
+    return {'filename': filename, 'unix_timestamp': unix_timestamp, 'email': email, 'dek': dek}
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table files (filename text, unix_timestamp integer, email text, dek blob)')
+    yield conn
+    conn.close()
+
+def daily_counts(conn):
+    return dict(conn.execute('select local_date, count from daily_counts'))
+
+def test_migration_drops_duplicate_files_and_recounts(conn):
+    # up to the migration before the de-duplication, with files uploaded twice
+    conn.executemany(
+        'insert into files values (:filename, :unix_timestamp, :email, :dek)',
+        [row('a.jpg', 1700000000, email='s1', dek=b'crashed'), row('a.jpg', 1700000000, email='s2', dek=b'uploaded'),
+         row('b_0000.webm', 1700000100, dek=b'old'), row('b_0000.webm', 1700000100, dek=b'new'),
+         row('b_0001.webm', 1700000100),
+         row('c.jpg', 1700000200, email='s1', dek=b'uploaded'), row('c.jpg', 1700000200, email='s2', dek=b'crashed')]
+    )
+    for number, script in enumerate(MIGRATIONS[:-1], start=1):
+        conn.executescript(f'begin; {script} pragma user_version = {number}; commit;')
+    conn.executemany("insert into manifest values (?, 'uploaded', ?, ?, 0)", [
+        ('hash a', 'a.jpg', 's2'), ('hash c', 'c.jpg', 's1,s3')
+    ])
+    assert sum(daily_counts(conn).values()) == 6
+    seq = conn.execute('select max(seq) from daily_counts').fetchone()[0]
+
+    migrate(conn)
+    assert conn.execute('select filename, dek from files order by filename').fetchall() == [
+        # the row uploaded to its server, otherwise the latest
+        ('a.jpg', b'uploaded'), ('b_0000.webm', b'new'), ('b_0001.webm', b'dek'), ('c.jpg', b'uploaded')
+    ]
+    assert sum(daily_counts(conn).values()) == 3
+    # running uis only re-read days whose seq moved on
+    assert conn.execute('select min(seq) from daily_counts').fetchone()[0] > seq
+
+def test_insert_files_skips_and_does_not_count_existing_files(conn):
+    migrate(conn)
+    cursor = conn.cursor()
+    insert_files(cursor, [row('a.jpg', 1700000000), row('b_0000.webm', 1700000100)])
+    insert_files(cursor, [row('a.jpg', 1700000000), row('c.jpg', 1700000200), row('c.jpg', 1700000200)])
+
+    assert conn.execute('select count(*) from files').fetchone()[0] == 3
+    assert sum(daily_counts(conn).values()) == 3
+
+def test_wait_for_schema_refuses_an_old_database_without_touching_it(tmp_path):
+    db_file = tmp_path / 'database.db'
+    with sqlite3.connect(db_file) as conn:
+        conn.execute('create table files (filename text, unix_timestamp integer, email text, dek blob)')
+    with pytest.raises(RuntimeError):
+        wait_for_schema(str(db_file), timeout=0.1, poll_interval=0.05)
+    with sqlite3.connect(db_file) as conn:
+        assert conn.execute('pragma user_version').fetchone()[0] == 0
+
+def test_wait_for_schema_waits_for_the_writer(tmp_path):
+    db_file = tmp_path / 'database.db'
+    with sqlite3.connect(db_file) as conn:
+        conn.execute('create table files (filename text, unix_timestamp integer, email text, dek blob)')
+
+    def writer():
+        with sqlite3.connect(db_file) as conn:
+            migrate(conn)
+    timer = threading.Timer(0.2, writer)
+    timer.start()
+    try:
+        wait_for_schema(str(db_file), timeout=5, poll_interval=0.05)
+    finally:
+        timer.join()
@@ -0,0 +1,120 @@
+import os
+import time
+import base64
+import asyncio
+import sqlite3
+import importlib
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_cors')
+pytest.importorskip('dotenv')
+
+from common.encrypt import Encrypter
+from common.schema import migrate, insert_files
+
+KEY = bytes(range(32))
+IV = bytes(range(16))
+EMAIL = 'a@example.com'
+PLAINTEXT = os.urandom(300 * 1024 + 5)
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    # the ui is configured from the environment when it's imported
+    root = tmp_path_factory.mktemp('root')
+    storage_dir = root / 'storage'
+    (storage_dir / EMAIL).mkdir(parents=True)
+    (root / 'static' / 'previews').mkdir(parents=True)
+
+    encrypter = Encrypter(key=KEY, iv=IV)
+    with sqlite3.connect(root / 'database.db') as conn:
+        conn.executescript("""
+            create table servers (email text primary key, mega_pw blob, dek blob);
+            create table files (filename text, unix_timestamp integer, email text, dek blob);
+        """)
+        migrate(conn)
+        for filename in ('20240101_101010.jpg', '20240102_101010.jpg'):
+            dek = Encrypter.generate_iv()
+            insert_files(conn.cursor(), [
+                {'filename': filename, 'unix_timestamp': 1704100000, 'email': EMAIL, 'dek': encrypter.encrypt(dek)}
+            ])
+            if filename == '20240101_101010.jpg':
+                (storage_dir / EMAIL / encrypter.hash(filename, dek)).write_bytes(encrypter.encrypt(PLAINTEXT, iv=dek))
+            # the second one's object was never uploaded
+
+    environment = {
+        'mega_root': str(root),
+        'key': base64.b64encode(KEY).decode(),
+        'iv': base64.b64encode(IV).decode(),
+        'static_dir': str(root / 'static'),
+        'storage_backend': 'local',
+        'storage_dir': str(storage_dir),
+        'prefetch_depth': '0',
+    }
+    saved = {name: os.environ.get(name) for name in environment}
+    os.environ.update(environment)
+    try:
+        yield importlib.import_module('app')
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def get(app, filename, byte_range=None):
+    client = app.app.test_client()
+    response = client.get(f'/stream?filename={filename}', headers={'Range': byte_range} if byte_range else {})
+    data = response.get_data()
+    # the way a server would, which lets the download finish into the cache
+    response.close()
+    return response, data
+
+def test_ranged_miss_streams_and_fills_the_cache(app):
+    response, data = get(app, '20240101_101010.jpg', 'bytes=100-199')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 100-199/*'
+    assert data == PLAINTEXT[100:200]
+
+    deadline = time.monotonic() + 5
+    while not app.object_cache.stats()['disk_entries'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert app.object_cache.stats()['disk_entries'] == 1
+
+    # served from the cache now, which knows the size
+    response, data = get(app, '20240101_101010.jpg', 'bytes=-10')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {len(PLAINTEXT) - 10}-{len(PLAINTEXT) - 1}/{len(PLAINTEXT)}'
+    assert data == PLAINTEXT[-10:]
+    response, data = get(app, '20240101_101010.jpg')
+    assert (response.status_code, data) == (200, PLAINTEXT)
+
+def test_failed_download_is_a_502(app):
+    response, _ = get(app, '20240102_101010.jpg')
+    assert response.status_code == 502
+    assert 'ETag' not in response.headers
+    assert app.object_cache.inflight == {}
+
+def test_failed_download_is_a_502_on_the_event_loop(app):
+    asgi = importlib.import_module('asgi')
+
+    async def request():
+        messages = []
+        async def receive():
+            # the client stays connected
+            await asyncio.Event().wait()
+        async def send(message):
+            messages.append(message)
+        scope = {
+            'type': 'http', 'path': '/stream', 'method': 'GET',
+            'query_string': b'filename=20240102_101010.jpg', 'headers': []
+        }
+        await asgi.app(scope, receive, send)
+        return messages
+
+    messages = asyncio.run(request())
+    assert messages[0]['type'] == 'http.response.start'
+    assert messages[0]['status'] == 502
+    assert b'etag' not in dict(messages[0]['headers'])
+    assert app.object_cache.inflight == {}
@@ -0,0 +1,27 @@
+import shutil
+import subprocess
+
+import pytest
+
+pytest.importorskip('PIL')
+
+from PIL import Image
+
+from thumbnail_generator.video_process import VideoProcess
+
+def test_thumbnail_from_a_decoded_frame_with_its_duration(tmp_path):
+    frame = Image.new('RGB', (640, 360), 'green')
+    thumb = VideoProcess(str(tmp_path / 'missing.webm')).create_thumbnail((200, 200), image=frame, duration=75)
+    assert thumb.size == (200, 200)
+
+@pytest.mark.skipif(not (shutil.which('ffmpeg') and shutil.which('ffprobe')), reason='needs ffmpeg and ffprobe')
+def test_thumbnail_from_a_decoded_frame_probes_the_duration(tmp_path):
+    filepath = tmp_path / 'video.webm'
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=2:size=160x120:rate=10',
+        '-c:v', 'libvpx', '-b:v', '200k', str(filepath)
+    ], check=True)
+    process = VideoProcess(str(filepath))
+    thumb = process.create_thumbnail((200, 200), image=Image.new('RGB', (640, 360), 'green'))
+    assert thumb.size == (200, 200)
+    assert process.duration > 0
@@ -1,18 +1,29 @@
 import os
-import sqlite3
+import io
+import hashlib
 import base64
-import subprocess
 import glob
-from datetime import datetime, timedelta
+import re
+import tempfile
+import threading
+import contextlib
+import collections
+from datetime import datetime, timedelta, timezone
 from flask import Flask, request, jsonify, Response, render_template, send_file, make_response
 from common.encrypt import Encrypter
+from common.schema import wait_for_schema, TIMELINE_FILTER
+from common.storage import LocalBackend, MegatoolsBackend, StorageError
+from common.thumbstore import ThumbnailStore
+from database import Database
+from object_cache import ObjectCache
+from prefetch import Prefetcher
 from dotenv import load_dotenv
 from flask_cors import CORS
 import json
 
-app = Flask(__name__)
-CORS(app)
 load_dotenv()
+app = Flask(__name__, static_folder=os.getenv('static_dir', 'static'))
+CORS(app)
 
 mega_root = os.getenv('mega_root')
 db_file = os.path.join(mega_root, 'database.db')
@@ -21,48 +32,93 @@ encrypter = Encrypter(
     iv=base64.b64decode(os.getenv('iv'))
 )
 
+# thumbnails packed into segment files by the uploader
+thumbnail_store = ThumbnailStore(os.path.join(app.static_folder, 'thumbnails'))
+
+# objects fetched from storage, kept encrypted
+object_cache = ObjectCache(
+    cache_dir=os.getenv('cache_dir', os.path.join(mega_root, 'cache')),
+    memory_bytes=int(os.getenv('cache_memory_mb', 64)) * 1024 * 1024,
+    disk_bytes=int(os.getenv('cache_disk_mb', 1024)) * 1024 * 1024
+)
+
+def account_password(email):
+    server = db_fetch('select mega_pw, dek from servers where email = ?', (email,), fetch_type='one')
+    server_dek = encrypter.decrypt(server['dek'])
+    return encrypter.decrypt(server['mega_pw'], iv=server_dek).decode('utf-8')
+
+# storage_backend=local reads from a mirror in storage_dir instead of mega
+if os.getenv('storage_backend', 'megatools') == 'local':
+    storage = LocalBackend(os.getenv('storage_dir'))
+else:
+    storage = MegatoolsBackend(
+        account_password,
+        binary=os.getenv('megatools_bin', 'megatools'),
+        workers_per_account=int(os.getenv('storage_workers_per_account', 2))
+    )
+
+# read-ahead of video chunks into object_cache
+prefetcher = Prefetcher(
+    depth=int(os.getenv('prefetch_depth', 3)),
+    max_concurrent=int(os.getenv('prefetch_concurrency', 4)),
+    idle_timeout=float(os.getenv('prefetch_idle_seconds', 300))
+)
+
+# for responses that can never change.  private, they're someone's photos
+IMMUTABLE = 'private, max-age=31536000, immutable'
+
 def trace_callback(query):
     print("executing query: ", query)
 
 
 thumbnails_by_date = {}
 
+# the ui only reads: the uploader migrates the database (and puts it in wal mode).
+# a database older than this code is waited on for schema_wait_seconds, then refused
+wait_for_schema(db_file, timeout=float(os.getenv('schema_wait_seconds', 60)))
+
+# set db_trace to print every query
+database = Database(
+    db_file,
+    pool_size=int(os.getenv('db_pool_size', 8)),
+    trace=trace_callback if os.getenv('db_trace') else None
+)
+
 def db_fetch(query, parameters=(), *, fetch_type='all', fetch_count=None):
-    with sqlite3.connect(db_file) as conn:
-        conn.row_factory = sqlite3.Row
-        conn.set_trace_callback(trace_callback)
-        cursor = conn.cursor()
-        cursor.execute(query, parameters)
-
-        match fetch_type:
-            case 'all':
-                return cursor.fetchall()
-            case 'one':
-                return cursor.fetchone()
-            case 'many':
-                return cursor.fetchmany(fetch_count)
-        
-
-def setup_caches():
-    records = db_fetch("""
-        SELECT 
-            strftime('%Y-%m-%d', unix_timestamp, 'unixepoch', 'localtime', '+9 hours') AS date, 
-            COUNT(*) AS count 
-        FROM 
-            v_distinct_files 
-        GROUP BY 
-            date;
-    """)
-
-    for record in records:
-        dt = datetime.strptime(record['date'], '%Y-%m-%d')
-        if dt.year not in thumbnails_by_date:
-            thumbnails_by_date[dt.year] = []
-        thumbnails_by_date[dt.year].append({
-            record['date']: record['count']
-        })
+    return database.fetch(query, parameters, fetch_type=fetch_type, fetch_count=fetch_count)
+
+# date -> count of every day seen so far, and the highest daily_counts.seq among them
+daily_counts = {}
+daily_counts_seq = -1
+daily_counts_lock = threading.Lock()
+
+def refresh_caches():
+    # only days that changed since the last refresh are read back
+    global thumbnails_by_date, daily_counts_seq
+
+    with daily_counts_lock:
+        records = db_fetch(
+            'select local_date, count, seq from daily_counts where seq > ?',
+            (daily_counts_seq,)
+        )
+        if not records:
+            return
+
+        for record in records:
+            daily_counts[record['local_date']] = record['count']
+            daily_counts_seq = max(daily_counts_seq, record['seq'])
+
+        by_date = {}
+        for date in sorted(daily_counts):
+            dt = datetime.strptime(date, '%Y-%m-%d')
+            if dt.year not in by_date:
+                by_date[dt.year] = []
+            by_date[dt.year].append({
+                date: daily_counts[date]
+            })
+        thumbnails_by_date = by_date
     
-setup_caches()
+refresh_caches()
 
 @app.route('/', methods=('GET',))
 def index():
@@ -70,6 +126,7 @@ def index():
 
 @app.route('/distinct_years', methods=('GET',))
 def distinct_years():
+    refresh_caches()
     ret = json.dumps(list(thumbnails_by_date.keys()))
     print(ret)
     return ret
@@ -77,6 +134,7 @@ def distinct_years():
 @app.route('/files_by_day', methods=('GET',))
 def files_by_day():
     year = int(request.args.get('year'))
+    refresh_caches()
     return json.dumps({year: thumbnails_by_date[year]})
 
 @app.route('/thumbnails', methods=('GET',))
@@ -85,149 +143,344 @@ def thumbnails():
     offset = request.args.get('fromIndex')
     limit = request.args.get('limit')
 
+    # keyset pagination: the (unix_timestamp, filename) of the last thumbnail
+    # the client has, the page starts right after it.  fromIndex still works
+    # but has to step over every skipped row.
+    cursor_timestamp = request.args.get('cursorTimestamp')
+    cursor_filename = request.args.get('cursorFilename')
+
     # TODO input validation
 
-    records = db_fetch("""
+    # a page changes whenever a file is added (older photos land in the middle of the
+    # timeline, not just at the top), and every addition moves daily_counts' seq on,
+    # so the browser revalidates each time but an unchanged page costs one query
+    refresh_caches()
+    etag = hashlib.sha256(f'{daily_counts_seq}?{request.query_string.decode()}'.encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        return cached_response(etag, 'private, no-cache')
+
+    conditions = [TIMELINE_FILTER]
+    parameters = []
+    if target_date:
+        conditions.append('unix_timestamp <= ?')
+        parameters.append(timeline_day_start(target_date))
+    if cursor_timestamp and cursor_filename:
+        conditions.append('(unix_timestamp, filename) < (?, ?)')
+        parameters += [int(cursor_timestamp), cursor_filename.replace('.webm', '_0000.webm')]
+        offset = 0
+
+    records = db_fetch(f"""
         select 
-            filename,
-            strftime('%Y-%m-%d', unix_timestamp, 'unixepoch', 'localtime', '+9 hours') as date
-        from 
-            v_distinct_files 
-        WHERE unix_timestamp <= strftime('%s', ? || ' 00:00:00 -09:00')
-        order by unix_timestamp DESC
-        limit ? offset ?;""",
-        (target_date, limit, offset)
+            replace(timeline.filename, '_0000.webm', '.webm') as filename,
+            timeline.unix_timestamp,
+            timeline.local_date as date,
+            thumbnails.segment,
+            thumbnails.offset,
+            thumbnails.length
+        from (
+            select filename, unix_timestamp, local_date
+            from files
+            where {' and '.join(conditions)}
+            order by unix_timestamp desc, filename desc
+            limit ? offset ?
+        ) as timeline
+        left join thumbnails on thumbnails.filename = replace(timeline.filename, '_0000.webm', '.webm')
+        order by timeline.unix_timestamp desc, timeline.filename desc;""",
+        (*parameters, limit, offset or 0)
     )
     
     images = []
     for record in records: 
-        filepath = os.path.join(app.static_folder, 'thumbnails', f"{record['filename']}.jpg")
-        with open(filepath, 'rb') as image_file:
-            b64 = base64.b64encode(image_file.read()).decode('utf-8')
+        if record['segment'] is not None:
+            thumbnail = thumbnail_store.read(record['segment'], record['offset'], record['length'])
+        else:
+            # not migrated into the packed store yet
+            filepath = os.path.join(app.static_folder, 'thumbnails', f"{record['filename']}.jpg")
+            with open(filepath, 'rb') as image_file:
+                thumbnail = image_file.read()
 
         images.append(
-            [os.path.basename(filepath)[:-4], b64]
+            [record['filename'], base64.b64encode(thumbnail).decode('utf-8'), record['unix_timestamp']]
         )
 
-    return jsonify(images), 200
+    resp = jsonify(images)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+def timeline_day_start(date):
+    # same instant as strftime('%s', date || ' 00:00:00 -09:00')
+    day = datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone(timedelta(hours=-9)))
+    return int(day.timestamp())
 
 @app.route('/stream', methods=('GET',))
 def data():
-    filename = request.args.get("filename")
+    video = request.args.get('filename')
     chunk = request.args.get('chunkIndex')
+    filename, mimetype, on_disk = stream_target(video, chunk, request.args.get('placeholder'))
+    byte_range = parse_range(request.headers.get('Range'))
+
+    record = None if on_disk else file_record(filename)
+    etag = stream_etag(filename, on_disk, record)
+    if etag and request.if_none_match.contains_weak(etag):
+        # the browser already has it, and so most likely what follows it too
+        return cached_response(etag, IMMUTABLE)
+    read_ahead(f'{request.remote_addr} {request.user_agent}', video, chunk)
+
+    if on_disk:
+        # werkzeug answers Range and If-Range itself, and a server with a wsgi.file_wrapper
+        # (gunicorn) hands the file to the kernel with sendfile rather than reading it through python
+        response = send_file(
+            os.path.join(app.static_folder, 'previews', filename),
+            mimetype=mimetype,
+            conditional=True,
+            etag=etag
+        )
+    elif not record:
+        return Response(status=204)
+    else:
+        response = object_response(record, byte_range, mimetype)
+
+    if response.status_code in (200, 206, 304):
+        # a 416 isn't the object, it must not be cached (let alone for a year) under its etag
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+def stream_target(filename, chunk, placeholder):
+    # the object a /stream request is for, its mimetype, and whether it's served from previews/
     if chunk: # if there's a chunk index then it's a video
         filename = filename.replace('.webm', f'_{chunk.zfill(4)}.webm')
-    
-    placeholder = request.args.get('placeholder')
 
     mimetype = 'video/webm' if filename.endswith('webm') else 'image/jpeg'
-    if filename.endswith('_0000.webm') or (filename.endswith('.jpg') and placeholder):
-        return Response(download_from_disk(filename), mimetype=mimetype)
+    on_disk = filename.endswith('_0000.webm') or (filename.endswith('.jpg') and bool(placeholder))
+    return filename, mimetype, on_disk
 
-    record = db_fetch("""
+def read_ahead(viewer, video, chunk):
+    # start loading the chunks after a video chunk, or stop once the viewer moves on to an image
+    if chunk:
+        prefetcher.schedule(viewer, video, int(chunk), lambda index: prefetch_chunk(video, index))
+    else:
+        prefetcher.cancel(viewer)
+
+def stream_etag(filename, on_disk, record):
+    # what /stream sends for filename is identified without reading any of it, None if there's nothing to send.
+    # stored objects are named after the file and its own data key and never rewritten,
+    # so the name is the content's identity
+    if on_disk:
+        stat = os.stat(os.path.join(app.static_folder, 'previews', filename))
+        return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    return object_key(record)[0] if record else None
+
+def cached_response(etag, cache_control):
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache_control
+    return resp
+
+@app.route('/seek_index', methods=('GET',))
+def seek_index():
+    # [[start_ms, chunk], ...] so the player can jump straight to the chunk covering a seek
+    records = db_fetch(
+        'select start_ms, chunk from video_chunks where filename=? order by chunk',
+        (request.args.get('filename'),)
+    )
+    return jsonify([[record['start_ms'], record['chunk']] for record in records]), 200
+
+@app.route('/cache_stats', methods=('GET',))
+def cache_stats():
+    return jsonify(object_cache.stats()), 200
+
+@app.route('/db_stats', methods=('GET',))
+def db_stats():
+    return jsonify(database.stats()), 200
+
+@app.route('/storage_stats', methods=('GET',))
+def storage_stats():
+    return jsonify(storage.stats()), 200
+
+@app.route('/cancel_prefetch', methods=('POST',))
+def cancel_prefetch():
+    prefetcher.cancel(f'{request.remote_addr} {request.user_agent}')
+    return Response(status=204)
+
+@app.route('/prefetch_stats', methods=('GET',))
+def prefetch_stats():
+    return jsonify(prefetcher.stats()), 200
+
+def file_record(filename):
+    return db_fetch("""
             select 
                 filename, 
-                files.email, 
-                mega_pw, 
-                servers.dek as server_dek, 
-                files.dek as data_dek
+                email, 
+                dek as data_dek
             from files
-            inner join servers on servers.email = files.email
             where filename=?
         """, 
         (filename,), 
         fetch_type='one'
     )
-    
-    if not record:
-        return Response(status=204)
-    
-    return Response(download_from_server(record), mimetype=mimetype)
+
+def prefetch_chunk(video, chunk_index):
+    # the first chunk is always on disk, and past the last chunk there's no record
+    if chunk_index and (record := file_record(video.replace('.webm', f'_{chunk_index:04d}.webm'))):
+        download_from_server(record)
+
+def parse_range(header):
+    # only a single byte range is honoured, anything else gets the whole object
+    if not header or not (match := re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())):
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if start and end and int(end) < int(start):
+        return None
+    return int(start) if start else None, int(end) if end else None
+
+def byte_span(size, byte_range):
+    # the (start, end) byte_range covers of an object of size bytes, end inclusive, None if it can't be satisfied
+    start, end = byte_range
+    if start is None: # suffix range, the last n bytes
+        start, end = max(size - end, 0), size - 1
+    end = size - 1 if end is None else min(end, size - 1)
+    return (start, end) if start <= end else None
+
+def ranged_response(size, byte_range, mimetype, body):
+    if not byte_range:
+        return Response(body(0, None), mimetype=mimetype, headers={'Accept-Ranges': 'bytes'})
+
+    span = byte_span(size, byte_range)
+    if not span:
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+    start, end = span
+    resp = Response(body(start, end - start + 1), 206, mimetype=mimetype)
+    resp.headers.add('Accept-Ranges', 'bytes')
+    resp.headers.add('Content-Range', f'bytes {start}-{end}/{size}')
+    return resp
 
 @app.after_request
 def after_request(response):
-    response.headers.add('Accept-Ranges', 'bytes')
+    # published previews are only ever written once, under the file's own name
+    if request.endpoint == 'static' and request.view_args.get('filename', '').startswith('previews/'):
+        response.headers['Cache-Control'] = IMMUTABLE
     return response
 
-
-def get_chunk(byte1=None, byte2=None):
-    # full_path = "try2.mp4"
-    filename = '20240505_075545.mp40.ts'
-    # chunk = request.args.get('chunkIndex')
-
-    # filename = filename.replace('.webm', f'_{chunk.zfill(4)}.webm')
-    full_path = os.path.join(app.static_folder, filename)
-    file_size = os.stat(full_path).st_size
-    start = 0
-    
-    if byte1 < file_size:
-        start = byte1
-    if byte2:
-        length = byte2 + 1 - byte1
+def object_key(db_entry):
+    # the object's name in storage (and in object_cache), and the key to decrypt it
+    data_dek = encrypter.decrypt(db_entry['data_dek'])
+    return encrypter.hash(db_entry['filename'], data_dek), data_dek
+
+def object_response(record, byte_range, mimetype):
+    # a stored object, from the cache or decrypted from storage as it downloads
+    filename_hash, data_dek = object_key(record)
+    cached = open_cached(filename_hash)
+    if cached is not None:
+        src = io.BytesIO(cached) if isinstance(cached, bytes) else cached
+        response = ranged_response(
+            len(cached) if isinstance(cached, bytes) else os.fstat(cached.fileno()).st_size,
+            byte_range,
+            mimetype,
+            # everything before offset is skipped without being decrypted
+            lambda offset, length: encrypter.decrypt_range(src, offset, length, iv=data_dek)
+        )
+        response.call_on_close(src.close)
+        return response
+
+    source = stream_from_server(record, filename_hash)
+    reader = io.BufferedReader(ChunkReader(source))
+    try:
+        # the first bytes are in before the status goes out, so a failed download is a 502
+        # rather than a success with a truncated body
+        reader.peek(1)
+    except StorageError:
+        app.logger.exception(f"download of {record['filename']} failed")
+        return Response(status=502)
+
+    # the object's size isn't known until the download ends, so only a range with an end is
+    # honoured (reporting '*' as the size), anything else gets the whole object
+    if byte_range and None not in byte_range:
+        start, end = byte_range
+        response = Response(
+            encrypter.decrypt_range(reader, start, end - start + 1, iv=data_dek),
+            206,
+            mimetype=mimetype
+        )
+        response.headers.add('Content-Range', f'bytes {start}-{end}/*')
     else:
-        length = file_size - start
-
-    with open(full_path, 'rb') as f:
-        f.seek(start)
-        chunk = f.read(length)
-    return chunk, start, length, file_size
-
-
-import re
-@app.route('/stream_test')
-def get_file():
-    range_header = request.headers.get('Range', None)
-    byte1, byte2 = 0, None
-    if range_header:
-        match = re.search(r'(\d+)-(\d*)', range_header)
-        groups = match.groups()
-
-        if groups[0]:
-            byte1 = int(groups[0])
-        if groups[1]:
-            byte2 = int(groups[1])
-       
-    chunk, start, length, file_size = get_chunk(byte1, byte2)
-    resp = Response(chunk, 206, mimetype='video/mp4',
-                      content_type='video/mp4', direct_passthrough=True)
-    resp.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(start, start + length - 1, file_size))
-    return resp
+        response = Response(encrypter.decrypt_range(reader, 0, None, iv=data_dek), mimetype=mimetype)
+    response.headers.add('Accept-Ranges', 'bytes')
+    # whatever the response didn't need still goes into the cache, off the request
+    response.call_on_close(lambda: threading.Thread(target=finish_download, args=(source,), daemon=True).start())
+    return response
 
-def download_from_disk(filename):
-    # the first chunk of the video is cached on disk for quick viewing
-    with open(os.path.join(app.static_folder, 'previews', filename), 'rb') as f:
-        while chunk := f.read(4096):
-            yield chunk
+def open_cached(filename_hash):
+    # the cached object (bytes, or an open file), or None once this request has claimed its download
+    while True:
+        cached = object_cache.open(filename_hash)
+        if cached is not None:
+            return cached
+
+        future = object_cache.claim(filename_hash)
+        if future is None:
+            return None
+        # someone else (usually the prefetcher) is already downloading it
+        data = future.result()
+        if data is not None:
+            return data
+
+def stream_from_server(record, filename_hash):
+    # the object's ciphertext as it arrives from storage, spooled into the object cache on the way.
+    # the caller has claimed filename_hash
+    spool = tempfile.NamedTemporaryFile(dir=object_cache.cache_dir, suffix='.tmp', delete=False)
+    try:
+        with contextlib.closing(storage.get_stream(record['email'], filename_hash)) as chunks:
+            for chunk in chunks:
+                spool.write(chunk)
+                yield chunk
+        spool.close()
+        object_cache.adopt(filename_hash, spool.name)
+    except BaseException as e:
+        spool.close()
+        os.remove(spool.name)
+        # anyone waiting on it fetches it themselves
+        object_cache.abandon(
+            filename_hash,
+            e if isinstance(e, Exception) else StorageError(f'download of {filename_hash} was cancelled')
+        )
+        raise
+
+def finish_download(source):
+    try:
+        collections.deque(source, maxlen=0)
+    except Exception:
+        app.logger.exception('download into the cache failed')
+
+class ChunkReader(io.RawIOBase):
+    # a read-only file over an iterator of chunks, so decrypt_range can read a download as it arrives
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending:
+            self.pending = memoryview(next(self.chunks, b''))
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
 
 def download_from_server(db_entry):
-    server_dek = encrypter.decrypt(db_entry['server_dek'])
-    data_dek = encrypter.decrypt(db_entry['data_dek'])
-    filename_hash = encrypter.hash(db_entry['filename'], data_dek)
-
-    command = [
-        'megatools',
-        'get',
-        # '--dryrun',
-        # '--no-progress',
-        '--username', db_entry['email'],
-        '--password', encrypter.decrypt(db_entry['mega_pw'], iv=server_dek).decode('utf-8'),
-        '--path', '-',
-        f'/Root/{filename_hash}'
-    ]
-
-    with subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        text=False
-    ) as process:
-        decryptor = encrypter.cipher(data_dek).decryptor()
-        while True:
-            line = process.stdout.read(1024)
-            if not line:
-                yield decryptor.finalize()
-                break
-            decrypted = decryptor.update(line)
-            yield decrypted
+    # returns the object still encrypted, along with the key to decrypt it
+    filename_hash, data_dek = object_key(db_entry)
+    return object_cache.get(filename_hash, lambda: fetch_from_server(db_entry, filename_hash)), data_dek
+
+def fetch_from_server(db_entry, filename_hash):
+    return b''.join(storage.get_stream(db_entry['email'], filename_hash))
 
 if __name__ == '__main__':
     app.run(debug=True, threaded=True)
\ No newline at end of file
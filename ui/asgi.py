@@ -0,0 +1,336 @@
+"""
+Asyncio (ASGI) serving mode for the ui.
+
+/stream is served on the event loop: storage downloads are asyncio subprocesses
+(or the backend's executor fallback), decryption is done chunk by chunk in the loop,
+and every chunk is only read once the client has taken the previous one, so a slow
+viewer stalls their own download rather than buffering it.  A stream holds at most a
+few stream_buffer_kb buffers at a time, so hundreds of them can share one process.
+Every other route is handed to the Flask app on a thread.
+
+Run with any ASGI server, from the ui directory:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+or python asgi.py.
+"""
+
+import io
+import os
+import sys
+import asyncio
+import logging
+import tempfile
+import contextlib
+import concurrent.futures
+from urllib.parse import parse_qs
+from werkzeug.http import parse_etags, quote_etag
+
+from common.encrypt.encrypt import BLOCK_SIZE
+from common.storage import StorageError
+from app import (
+    app as flask_app, encrypter, object_cache, storage, IMMUTABLE,
+    stream_target, read_ahead, stream_etag, file_record, object_key, parse_range, byte_span
+)
+
+logger = logging.getLogger('asgi')
+
+# bytes read from storage, the cache or disk per step, and so the most a stream holds at once
+STREAM_BUFFER = int(os.getenv('stream_buffer_kb', 256)) * 1024
+
+# disk reads, cache writes and database lookups, none of which may block the loop
+io_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('stream_io_threads', 4)),
+    thread_name_prefix='stream_io'
+)
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/stream':
+        await until_disconnect(receive, stream(scope, send))
+    elif scope['type'] == 'http':
+        await wsgi(scope, receive, send)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            io_executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def until_disconnect(receive, coroutine):
+    # runs the response, cancelling it (and with it any download) if the client goes away
+    task = asyncio.ensure_future(coroutine)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for future in (task, disconnected):
+            future.cancel()
+        # surfaces any error from the response
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def stream(scope, send):
+    loop = asyncio.get_running_loop()
+    args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    client = scope.get('client') or ('', 0)
+
+    video = args.get('filename')
+    chunk = args.get('chunkIndex')
+    filename, mimetype, on_disk = stream_target(video, chunk, args.get('placeholder'))
+    byte_range = parse_range(headers.get('range'))
+
+    record = None if on_disk else await loop.run_in_executor(io_executor, file_record, filename)
+    etag = await loop.run_in_executor(io_executor, stream_etag, filename, on_disk, record)
+    caching = [(b'etag', quote_etag(etag).encode()), (b'cache-control', IMMUTABLE.encode())] if etag else []
+    if etag and parse_etags(headers.get('if-none-match')).contains_weak(etag):
+        # the browser already has it, and so most likely what follows it too
+        await respond(send, 304, None, caching, None)
+        return
+    read_ahead(f"{client[0]} {headers.get('user-agent', '')}", video, chunk)
+
+    if on_disk:
+        filepath = os.path.join(flask_app.static_folder, 'previews', filename)
+        f = await loop.run_in_executor(io_executor, open, filepath, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            await ranged(
+                send, size, byte_range, mimetype, caching, lambda offset, length: read_file(f, offset, length)
+            )
+        finally:
+            f.close()
+        return
+
+    if not record:
+        await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    filename_hash, data_dek = object_key(record)
+    cached = await open_cached(filename_hash)
+    if cached is None:
+        # the size isn't known until the download ends, so a miss is sent whole and
+        # any range is ignored.  the next request for it is served from the cache
+        source = download(record, filename_hash)
+        async with contextlib.aclosing(source):
+            chunks = decrypt(source, 0, 0, None, data_dek)
+            try:
+                # the first bytes are in before the status goes out, so a failed download is a 502
+                # rather than a success with a truncated body
+                first = await anext(chunks, b'')
+            except StorageError:
+                logger.exception(f"download of {record['filename']} failed")
+                await respond(send, 502, None, [], None)
+                return
+            await respond(send, 200, mimetype, caching, prepend(first, chunks))
+        return
+
+    try:
+        if isinstance(cached, bytes):
+            size = len(cached)
+            body = lambda offset, length: read_memory(cached, offset, length)
+        else:
+            size = os.fstat(cached.fileno()).st_size
+            body = lambda offset, length: read_file(cached, offset, length)
+        await ranged(
+            send, size, byte_range, mimetype, caching,
+            lambda offset, length: decrypt(body(offset, length), offset, offset, length, data_dek)
+        )
+    finally:
+        if not isinstance(cached, bytes):
+            cached.close()
+
+async def open_cached(filename_hash):
+    # the cached object (bytes, or an open file), or None once this request has claimed its download
+    loop = asyncio.get_running_loop()
+    while True:
+        cached = await loop.run_in_executor(io_executor, object_cache.open, filename_hash)
+        if cached is not None:
+            return cached
+
+        future = object_cache.claim(filename_hash)
+        if future is None:
+            return None
+        # someone else (usually the prefetcher) is already downloading it
+        data = await asyncio.wrap_future(future)
+        if data is not None:
+            return data
+
+async def download(record, filename_hash):
+    # the object's ciphertext as it arrives from storage, spooled into the object cache on the way
+    loop = asyncio.get_running_loop()
+    spool = await loop.run_in_executor(
+        io_executor,
+        lambda: tempfile.NamedTemporaryFile(dir=object_cache.cache_dir, suffix='.tmp', delete=False)
+    )
+    try:
+        chunks = storage.get_stream_async(record['email'], filename_hash, chunk_size=STREAM_BUFFER)
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                await loop.run_in_executor(io_executor, spool.write, chunk)
+                yield chunk
+        await loop.run_in_executor(io_executor, spool.close)
+        object_cache.adopt(filename_hash, spool.name)
+    except BaseException as e:
+        spool.close()
+        os.remove(spool.name)
+        # a viewer going away mid download fails anyone waiting on it too, they fetch it themselves
+        object_cache.abandon(
+            filename_hash,
+            e if isinstance(e, Exception) else StorageError(f'download of {filename_hash} was cancelled')
+        )
+        raise
+
+async def prepend(first, chunks):
+    async with contextlib.aclosing(chunks):
+        yield first
+        async for chunk in chunks:
+            yield chunk
+
+async def read_memory(data, offset, length):
+    view = memoryview(data)
+    end = len(view) if length is None else min(len(view), offset + length)
+    for i in range(offset, end, STREAM_BUFFER):
+        yield view[i:min(i + STREAM_BUFFER, end)]
+
+async def read_file(f, offset, length):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(io_executor, f.seek, offset)
+    while length is None or length > 0:
+        chunk = await loop.run_in_executor(
+            io_executor, f.read, STREAM_BUFFER if length is None else min(STREAM_BUFFER, length)
+        )
+        if not chunk:
+            break
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+async def decrypt(chunks, position, offset, length, iv):
+    """
+    Decrypt the plaintext bytes [offset, offset + length) from ciphertext chunks.
+
+    Args:
+    chunks (AsyncIterator[bytes]): Consecutive ciphertext, starting at byte position of the object.
+    position (int): Where in the object chunks start, at or before offset.
+    offset (int): The first byte to decrypt, chunks before it are skipped without being decrypted.
+    length (int): How many bytes to decrypt, None for the rest of the object.
+    iv (bytes): The object's data key.
+    """
+    end = None if length is None else offset + length
+    decryptor = None
+    async for chunk in chunks:
+        chunk_start, position = position, position + len(chunk)
+        if position <= offset:
+            continue
+
+        if decryptor is None:
+            # the keystream starts at offset's block, step it up to offset itself
+            decryptor = encrypter.range_cipher(offset, iv).decryptor()
+            decryptor.update(bytes(offset % BLOCK_SIZE))
+
+        view = memoryview(chunk)[max(offset - chunk_start, 0):None if end is None else end - chunk_start]
+        if len(view):
+            yield decryptor.update(view)
+        if end is not None and position >= end:
+            break
+
+async def ranged(send, size, byte_range, mimetype, headers, body):
+    if not byte_range:
+        await respond(send, 200, mimetype, headers, body(0, None))
+        return
+
+    span = byte_span(size, byte_range)
+    if not span:
+        await respond(send, 416, mimetype, [(b'content-range', f'bytes */{size}'.encode())], None)
+        return
+
+    start, end = span
+    await respond(
+        send, 206, mimetype, [*headers, (b'content-range', f'bytes {start}-{end}/{size}'.encode())],
+        body(start, end - start + 1)
+    )
+
+async def respond(send, status, mimetype, headers, chunks):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            *([(b'content-type', mimetype.encode())] if mimetype else []),
+            (b'accept-ranges', b'bytes'),
+            *headers
+        ],
+    })
+    if chunks is not None:
+        # send() returns once the server has room for more (uvicorn waits on the
+        # transport draining), so the next chunk is only read when the client keeps up
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def wsgi(scope, receive, send):
+    # the rest of the ui is small request/response json, run as-is on a thread
+    body = io.BytesIO()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def run():
+        response = flask_app(environ, start_response)
+        try:
+            return b''.join(response)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+    content = await asyncio.get_running_loop().run_in_executor(None, run)
+    await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+    await send({'type': 'http.response.body', 'body': content})
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.getenv('asgi_host', '127.0.0.1'), port=int(os.getenv('asgi_port', 5000)))
@@ -0,0 +1,101 @@
+import re
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+from common.latency import LatencyHistogram
+
+logger = logging.getLogger('database')
+
+class Database:
+    """
+    Pool of read-only sqlite connections with per-query latency histograms.
+
+    Connections are opened lazily up to pool_size and handed out to whichever thread
+    needs one, so they (and their prepared statement caches) outlive the request
+    threads.  Tracing is off unless a trace callback is given.
+
+    Methods:
+        __init__(db_file, pool_size, cached_statements, trace): Initialize the pool.
+        fetch(query, parameters, fetch_type, fetch_count): Run a query and fetch its rows.
+        stats(): Latency histograms keyed by query.
+    """
+    def __init__(
+        self,
+        db_file: str,
+        *,
+        pool_size: int=8,
+        cached_statements: int=256,
+        trace=None
+    ):
+        self.db_file = db_file
+        self.cached_statements = cached_statements
+        self.trace = trace
+        self.pool = queue.LifoQueue()
+        self.available = threading.Semaphore(pool_size)
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            f'file:{self.db_file}?mode=ro',
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+        if self.trace:
+            conn.set_trace_callback(self.trace)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        self.available.acquire()
+        try:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except sqlite3.Error:
+                # don't hand a connection in an unknown state to the next caller
+                conn.close()
+                raise
+            else:
+                self.pool.put(conn)
+        finally:
+            self.available.release()
+
+    def fetch(self, query, parameters=(), *, fetch_type='all', fetch_count=None):
+        start = time.perf_counter()
+        with self.connection() as conn:
+            cursor = conn.execute(query, parameters)
+
+            match fetch_type:
+                case 'all':
+                    result = cursor.fetchall()
+                case 'one':
+                    result = cursor.fetchone()
+                case 'many':
+                    result = cursor.fetchmany(fetch_count)
+                case _:
+                    result = None
+            cursor.close()
+
+        self._observe(query, time.perf_counter() - start)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {query: histogram.snapshot() for query, histogram in self.histograms.items()}
+
+    def _observe(self, query, seconds):
+        key = re.sub(r'\s+', ' ', query).strip()
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram()
+            self.histograms[key].observe(seconds)
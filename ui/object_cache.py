@@ -0,0 +1,239 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import BinaryIO
+
+logger = logging.getLogger('object_cache')
+
+class ObjectCache:
+    """
+    Size-bounded two-tier (memory + local disk) LRU cache for objects fetched from storage.
+
+    Entries are keyed by the object's filename hash and are stored exactly as they
+    were fetched, so they stay encrypted at rest.  Every fetched object is written
+    to disk and, if it fits, kept in memory too; each tier evicts its least recently
+    used entries once it goes over its byte budget.  Concurrent misses for the same
+    key are coalesced so that only one fetch is made.
+
+    Objects can also be streamed in rather than fetched whole: open() on a miss, then
+    claim() the fetch, write the object to a temporary file in cache_dir and adopt() it
+    (or abandon() it on failure).  Streamed objects only go to the disk tier.
+
+    Methods:
+        __init__(cache_dir, memory_bytes, disk_bytes): Initialize, adopting anything already in cache_dir.
+        get(key, fetch): Return the cached object, calling fetch() to load it on a miss.
+        open(key): Return the object from memory, or an open file on disk, without fetching.
+        claim(key): Become the one fetching key, or get the future of whoever already is.
+        adopt(key, path): Move a streamed-in object into the disk tier, ending the claim.
+        abandon(key, error): End a claim that failed.
+        stats(): Hit/miss counters and current usage of each tier.
+    """
+    def __init__(self, *, cache_dir: str, memory_bytes: int, disk_bytes: int):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.disk = OrderedDict()
+        self.disk_used = 0
+        self.inflight = {}
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+        }
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # pick up where the last run left off, oldest first
+        for entry in sorted(os.scandir(cache_dir), key=lambda e: e.stat().st_mtime):
+            if entry.name.endswith('.tmp'):
+                # an interrupted write
+                os.remove(entry.path)
+            elif entry.is_file():
+                self.disk[entry.name] = entry.stat().st_size
+                self.disk_used += self.disk[entry.name]
+        with self.lock:
+            self._evict()
+
+    def get(self, key: str, fetch) -> bytes:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return self.memory[key]
+
+            on_disk = key in self.disk
+            if on_disk:
+                self.disk.move_to_end(key)
+
+        if on_disk:
+            data = self._read(key)
+            if data is not None:
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+                    self._remember(key, data)
+                return data
+
+        with self.lock:
+            if key in self.inflight:
+                self.counters['coalesced'] += 1
+                future = self.inflight[key]
+                leader = False
+            else:
+                self.counters['misses'] += 1
+                future = self.inflight[key] = Future()
+                leader = True
+
+        if not leader:
+            data = future.result()
+            if data is None:
+                # streamed straight to disk by claim()/adopt()
+                data = self._read(key)
+                if data is None:
+                    # and already evicted again
+                    data = fetch()
+            return data
+
+        try:
+            data = fetch()
+            self._write(key, data)
+            with self.lock:
+                self._remember(key, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def open(self, key: str) -> bytes | BinaryIO | None:
+        """
+        Returns:
+        bytes | BinaryIO | None: The object if it's in memory, an open file positioned at its start
+            if it's only on disk (eviction can't pull it out from under the reader), None on a miss.
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return self.memory[key]
+            if key not in self.disk:
+                return None
+            self.disk.move_to_end(key)
+
+        filepath = os.path.join(self.cache_dir, key)
+        try:
+            f = open(filepath, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(filepath)
+        with self.lock:
+            self.counters['disk_hits'] += 1
+        return f
+
+    def claim(self, key: str) -> Future | None:
+        """
+        Returns:
+        Future | None: None if the caller now owns the fetch of key and has to adopt() or abandon() it,
+            otherwise the future of the fetch already running.  Its result is the object,
+            or None if it was streamed to disk and has to be open()ed.
+        """
+        with self.lock:
+            if key in self.inflight:
+                self.counters['coalesced'] += 1
+                return self.inflight[key]
+            self.counters['misses'] += 1
+            self.inflight[key] = Future()
+            return None
+
+    def adopt(self, key: str, path: str) -> None:
+        """
+        Args:
+        key (str): The claimed key.
+        path (str): The complete object, in cache_dir so it can be renamed into place.
+        """
+        filepath = os.path.join(self.cache_dir, key)
+        size = os.path.getsize(path)
+        os.replace(path, filepath)
+
+        with self.lock:
+            self.disk_used += size - self.disk.get(key, 0)
+            self.disk[key] = size
+            self.disk.move_to_end(key)
+            self._evict()
+            future = self.inflight.pop(key, None)
+        if future:
+            future.set_result(None)
+
+    def abandon(self, key: str, error: Exception) -> None:
+        with self.lock:
+            future = self.inflight.pop(key, None)
+        if future:
+            future.set_exception(error)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.counters,
+                'memory_entries': len(self.memory),
+                'memory_used': self.memory_used,
+                'memory_bytes': self.memory_bytes,
+                'disk_entries': len(self.disk),
+                'disk_used': self.disk_used,
+                'disk_bytes': self.disk_bytes,
+            }
+
+    def _read(self, key):
+        filepath = os.path.join(self.cache_dir, key)
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            os.utime(filepath)
+            return data
+        except FileNotFoundError:
+            # evicted between the lookup and the read
+            return None
+
+    def _write(self, key, data):
+        filepath = os.path.join(self.cache_dir, key)
+        with open(f'{filepath}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{filepath}.tmp', filepath)
+
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = len(data)
+                self.disk_used += len(data)
+            self._evict()
+
+    def _remember(self, key, data):
+        # caller holds the lock
+        if len(data) > self.memory_bytes or key in self.memory:
+            return
+        self.memory[key] = data
+        self.memory_used += len(data)
+        self._evict()
+
+    def _evict(self):
+        # caller holds the lock
+        while self.memory_used > self.memory_bytes:
+            _, data = self.memory.popitem(last=False)
+            self.memory_used -= len(data)
+            self.counters['evictions'] += 1
+
+        while self.disk_used > self.disk_bytes:
+            key, size = self.disk.popitem(last=False)
+            self.disk_used -= size
+            self.counters['evictions'] += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except FileNotFoundError:
+                logger.warning(f'cache entry {key} already gone')
@@ -0,0 +1,102 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('prefetch')
+
+class Prefetcher:
+    """
+    Read-ahead scheduler for chunked video playback.
+
+    When a viewer asks for chunk N of a video, chunks N+1..N+depth are loaded in the
+    background (into the object cache, via the load callback) so that the sequential
+    requests that follow are served locally.  At most max_concurrent prefetches run
+    at once across all viewers.  A viewer moving on to another file, or cancelling
+    explicitly, drops every prefetch of theirs that hasn't started yet; ones already
+    downloading are left to finish into the cache.  Viewers that go quiet (closing the
+    tab doesn't tell the server) are forgotten after idle_timeout seconds, swept
+    whenever new work is scheduled.
+
+    Methods:
+        __init__(depth, max_concurrent, idle_timeout): Initialize the read-ahead depth, the global
+            concurrency limit and how long an idle viewer is kept.
+        schedule(viewer, video, chunk_index, load): Record a request and queue the chunks that follow it.
+        cancel(viewer): Drop the viewer's outstanding prefetches.
+        stats(): Counters for scheduled, claimed, cancelled, failed and expired prefetches.
+    """
+    def __init__(self, *, depth: int, max_concurrent: int, idle_timeout: float=300.0):
+        self.depth = depth
+        self.idle_timeout = idle_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='prefetch')
+        self.lock = threading.Lock()
+        # viewer -> (video, {chunk_index: future}, last seen), least recently seen first
+        self.viewers = {}
+        self.counters = {
+            'scheduled': 0,
+            'claimed': 0,
+            'cancelled': 0,
+            'failed': 0,
+            'expired': 0,
+        }
+
+    def schedule(self, viewer, video, chunk_index, load):
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            current_video, pending, _ = self.viewers.pop(viewer, (None, {}, None))
+            if current_video != video:
+                self._cancel(pending)
+                pending = {}
+            # reinserted, so the dict stays in last seen order
+            self.viewers[viewer] = (video, pending, now)
+
+            if pending.pop(chunk_index, None) is not None:
+                self.counters['claimed'] += 1
+
+            # chunks the viewer has moved past are no longer interesting
+            behind = [index for index in pending if index < chunk_index]
+            self._cancel({index: pending.pop(index) for index in behind})
+
+            for index in range(chunk_index + 1, chunk_index + self.depth + 1):
+                if index not in pending:
+                    pending[index] = self.executor.submit(self._load, load, index)
+                    self.counters['scheduled'] += 1
+
+    def cancel(self, viewer):
+        with self.lock:
+            _, pending, _ = self.viewers.pop(viewer, (None, {}, None))
+            self._cancel(pending)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.counters,
+                'viewers': len(self.viewers),
+                'pending': sum(len(pending) for _, pending, _ in self.viewers.values()),
+            }
+
+    def _expire(self, now):
+        # caller holds the lock.  the oldest viewers come first, so stop at the first recent one
+        while self.viewers:
+            viewer, (_, pending, last_seen) = next(iter(self.viewers.items()))
+            if now - last_seen < self.idle_timeout:
+                break
+            del self.viewers[viewer]
+            self._cancel(pending)
+            self.counters['expired'] += 1
+
+    def _cancel(self, pending):
+        # caller holds the lock
+        for future in pending.values():
+            if future.cancel():
+                self.counters['cancelled'] += 1
+
+    def _load(self, load, index):
+        try:
+            load(index)
+        except Exception:
+            logger.exception(f'prefetch of chunk {index} failed')
+            with self.lock:
+                self.counters['failed'] += 1
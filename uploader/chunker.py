@@ -0,0 +1,295 @@
+import os
+import random
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger('chunker')
+
+# one chunk of a video: where it is in the file, and the time it starts playing at
+# (None when it isn't known, i.e. the file couldn't be parsed as webm)
+ChunkPlan = namedtuple('ChunkPlan', ['offset', 'length', 'start_ms'])
+
+# matroska element ids, marker bits included
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+CLUSTER = 0x1F43B675
+TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+REFERENCE_BLOCK = 0xFB
+CUES = 0x1C53BB6B
+TAGS = 0x1254C367
+CHAPTERS = 0x1043A770
+ATTACHMENTS = 0x1941A469
+TOP_LEVEL = {SEEK_HEAD, INFO, TRACKS, CLUSTER, CUES, TAGS, CHAPTERS, ATTACHMENTS}
+
+VIDEO_TRACK = 1
+
+Cluster = namedtuple('Cluster', ['offset', 'end', 'timecode', 'keyframe'])
+
+def _vint(f, *, keep_marker=False):
+    first = f.read(1)
+    if not first or not first[0]:
+        raise ValueError('invalid ebml variable-length integer')
+
+    length = 9 - first[0].bit_length()
+    value = first[0] if keep_marker else first[0] & (0xFF >> length)
+    for byte in f.read(length - 1):
+        value = value << 8 | byte
+
+    # a size with every value bit set means "unknown"
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, length, unknown
+
+def _header(f, offset):
+    # returns the element id, where its data starts, and its size (None if unknown)
+    f.seek(offset)
+    element_id, id_length, _ = _vint(f, keep_marker=True)
+    size, size_length, unknown = _vint(f)
+    return element_id, offset + id_length + size_length, None if unknown else size
+
+def _children(f, start, end):
+    offset = start
+    while offset < end:
+        element_id, data, size = _header(f, offset)
+        if size is None:
+            raise ValueError(f'unknown-size element {element_id:x} at {offset}')
+        yield element_id, data, size
+        offset = data + size
+
+def _uint(f, data, size):
+    f.seek(data)
+    return int.from_bytes(f.read(size), 'big')
+
+def _video_track(f, data, size):
+    for element_id, entry, entry_size in _children(f, data, data + size):
+        if element_id != TRACK_ENTRY:
+            continue
+        fields = {child_id: _uint(f, child, child_size) for child_id, child, child_size in _children(f, entry, entry + entry_size)
+                  if child_id in (TRACK_NUMBER, TRACK_TYPE)}
+        if fields.get(TRACK_TYPE) == VIDEO_TRACK:
+            return fields.get(TRACK_NUMBER)
+    return None
+
+def _block_track(f, data):
+    f.seek(data)
+    track, _, _ = _vint(f)
+    f.seek(2, os.SEEK_CUR)
+    return track, f.read(1)[0]
+
+def _cluster(f, offset, data, end, video_track):
+    timecode = None
+    keyframe = None
+    for element_id, child, child_size in _children(f, data, end):
+        if element_id == TIMECODE:
+            timecode = _uint(f, child, child_size)
+
+        elif element_id == SIMPLE_BLOCK and keyframe is None:
+            track, flags = _block_track(f, child)
+            if track == video_track:
+                keyframe = bool(flags & 0x80)
+
+        elif element_id == BLOCK_GROUP and keyframe is None:
+            group = list(_children(f, child, child + child_size))
+            block = next(((group_child, group_size) for group_id, group_child, group_size in group if group_id == BLOCK), None)
+            if block and _block_track(f, block[0])[0] == video_track:
+                # blocks in a group are keyframes unless they reference another frame
+                keyframe = not any(group_id == REFERENCE_BLOCK for group_id, _, _ in group)
+
+        if timecode is not None and keyframe is not None:
+            break
+
+    return Cluster(offset, end, timecode or 0, bool(keyframe))
+
+def parse_clusters(filepath: str) -> tuple[list[Cluster], float]:
+    """
+    Find the clusters of a webm file without reading their frame data.
+
+    Args:
+    filepath (str): The webm file.
+
+    Returns:
+    tuple: The clusters (offset, end, timecode, whether the first video frame is a keyframe)
+        and the number of milliseconds per timecode tick.
+    """
+    file_size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        element_id, data, size = _header(f, 0)
+        if element_id != EBML:
+            raise ValueError(f'{filepath} is not an ebml file')
+
+        element_id, segment, segment_size = _header(f, data + size)
+        if element_id != SEGMENT:
+            raise ValueError(f'{filepath} has no segment')
+        segment_end = file_size if segment_size is None else min(segment + segment_size, file_size)
+
+        timecode_scale = 1_000_000
+        video_track = None
+        clusters = []
+        offset = segment
+        while offset < segment_end:
+            element_id, data, size = _header(f, offset)
+
+            if size is None:
+                if element_id != CLUSTER:
+                    raise ValueError(f'unknown-size element {element_id:x} at {offset}')
+                # live-style cluster, it runs until the next top level element
+                end = data
+                while end < segment_end:
+                    child_id, child, child_size = _header(f, end)
+                    if child_id in TOP_LEVEL:
+                        break
+                    end = child + child_size
+                size = end - data
+
+            if element_id == INFO:
+                for child_id, child, child_size in _children(f, data, data + size):
+                    if child_id == TIMECODE_SCALE:
+                        timecode_scale = _uint(f, child, child_size)
+            elif element_id == TRACKS:
+                video_track = _video_track(f, data, size)
+            elif element_id == CLUSTER:
+                clusters.append(_cluster(f, offset, data, min(data + size, segment_end), video_track))
+
+            offset = data + size
+
+    return clusters, timecode_scale / 1_000_000
+
+def plan_chunks(
+    filepath: str,
+    *,
+    min_size: int=700 * 1024,
+    max_size: int=2 * 1024 * 1024,
+    hard_max_size: int=4 * 1024 * 1024
+) -> list[ChunkPlan]:
+    """
+    Decide where to cut a video into chunks.
+
+    Cuts fall on clusters that start with a video keyframe, so a chunk after the first
+    is an independently decodable media segment; the first chunk also carries the header
+    the others need.  Each chunk is cut at the first such cluster once it reaches a random
+    target size between min_size and max_size, so chunk sizes still don't give away what
+    the file is.  Where keyframes are sparse (a long static scene, a screen recording) a
+    chunk that would grow past hard_max_size is cut at the last cluster before that
+    instead; it plays on from the chunk before it but isn't a seek target (its start_ms
+    is None).  Files that can't be parsed as webm are cut at random byte offsets, as they
+    always were.
+
+    Args:
+    filepath (str): The sanitized video.
+    min_size (int): The smallest target chunk size in bytes, default is 700KiB.
+    max_size (int): The largest target chunk size in bytes, default is 2MiB.
+    hard_max_size (int): The size no chunk grows past unless a single cluster does, default is 4MiB.
+
+    Returns:
+    list[ChunkPlan]: The chunks in order, together covering the whole file.
+    """
+    file_size = os.path.getsize(filepath)
+    try:
+        clusters, ms_per_tick = parse_clusters(filepath)
+    except (ValueError, IndexError) as e:
+        logger.warning(f'{filepath} not parsable as webm ({e}), cutting at random offsets')
+        clusters = []
+
+    if not any(cluster.keyframe for cluster in clusters[1:]) and file_size > max_size:
+        if clusters:
+            logger.warning(f'{filepath} has no keyframe clusters to cut at, cutting at random offsets')
+        plan = []
+        offset = 0
+        while offset < file_size:
+            length = min(random.randint(min_size, max_size), file_size - offset)
+            plan.append(ChunkPlan(offset, length, 0 if offset == 0 else None))
+            offset += length
+        return plan
+
+    plan = []
+    start, start_ms = 0, 0
+    target = random.randint(min_size, max_size)
+    # the last cluster boundary after start, where an oversized chunk is cut
+    previous = None
+
+    def cut_oversized(end):
+        nonlocal start, start_ms, target
+        if previous and end - start > hard_max_size:
+            plan.append(ChunkPlan(start, previous.offset - start, start_ms))
+            start = previous.offset
+            start_ms = round(previous.timecode * ms_per_tick) if previous.keyframe else None
+            target = random.randint(min_size, max_size)
+
+    for cluster in clusters[1:]:
+        cut_oversized(cluster.offset)
+        if cluster.keyframe and cluster.offset - start >= target:
+            plan.append(ChunkPlan(start, cluster.offset - start, start_ms))
+            start, start_ms = cluster.offset, round(cluster.timecode * ms_per_tick)
+            target = random.randint(min_size, max_size)
+            previous = None
+        else:
+            previous = cluster
+    # the last chunk also carries anything after the clusters (cues, tags)
+    cut_oversized(file_size)
+    plan.append(ChunkPlan(start, file_size - start, start_ms))
+    return plan
+
+def chunk_filename(filename: str, chunk_number: int) -> str:
+    return filename.replace('.webm', f'_{chunk_number:04d}.webm')
+
+def read_chunks(filepath: str, plan: list[ChunkPlan]):
+    """
+    Yield the bytes of each planned chunk, in order.
+    """
+    with open(filepath, 'rb') as infile:
+        for chunk in plan:
+            infile.seek(chunk.offset)
+            yield infile.read(chunk.length)
+
+def chunk_video(
+    filepath: str,
+    dest_dir: str,
+    *,
+    min_size: int=700 * 1024,
+    max_size: int=2 * 1024 * 1024,
+    hard_max_size: int=4 * 1024 * 1024
+) -> list[ChunkPlan]:
+    """
+    Split a video into name_0000.webm, name_0001.webm, ... chunks, see plan_chunks.
+
+    Args:
+    filepath (str): The sanitized video.
+    dest_dir (str): The directory to write the chunks to.
+    min_size (int): The smallest target chunk size in bytes, default is 700KiB.
+    max_size (int): The largest target chunk size in bytes, default is 2MiB.
+    hard_max_size (int): The size no chunk grows past unless a single cluster does, default is 4MiB.
+
+    Returns:
+    list[ChunkPlan]: The chunks written, in order.
+    """
+    filename = os.path.basename(filepath)
+    plan = plan_chunks(filepath, min_size=min_size, max_size=max_size, hard_max_size=hard_max_size)
+
+    for chunk_number, data in enumerate(read_chunks(filepath, plan)):
+        with open(os.path.join(dest_dir, chunk_filename(filename, chunk_number)), 'wb') as outfile:
+            outfile.write(data)
+
+    return plan
+
+def seek_index(filename: str, plan: list[ChunkPlan]) -> list[dict]:
+    """
+    The video_chunks rows for a chunked video: the time each chunk starts playing at.
+
+    Args:
+    filename (str): The video's filename, e.g. name.webm.
+    plan (list[ChunkPlan]): How it was chunked.
+    """
+    return [
+        {'filename': filename, 'chunk': chunk_number, 'start_ms': chunk.start_ms}
+        for chunk_number, chunk in enumerate(plan)
+        if chunk.start_ms is not None
+    ]
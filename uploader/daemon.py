@@ -0,0 +1,124 @@
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from sanitizer import sanitize_file
+from sanitizer.sanitizer_factory import SanitizerFactory
+from metadata import MetadataWriter
+from watcher import Watcher
+
+logger = logging.getLogger('daemon')
+
+def watch(
+    pipeline,
+    *,
+    workers: int=2,
+    debounce: float=2.0,
+    poll_interval: float=1.0,
+    flush_interval: float=30.0,
+    backup_interval: float=600.0,
+    metrics_json: str=None,
+    metrics_prom: str=None,
+    stop: threading.Event=None
+) -> None:
+    """
+    Keep ingesting files as they're dropped into unprocessed/, until stop is set.
+
+    Whatever is already waiting is ingested with one pipeline.run() first.  After that each
+    file is pushed through on its own as soon as it has stopped changing: sanitized in a
+    worker process (images writing their thumbnail and preview from that same decode),
+    then streamed into the server directories.  At most workers files are in flight at once.
+
+    Uploading, thumbnail packing and preview publishing work on whole directories, so they
+    run as a flush: as soon as nothing is in flight, or after flush_interval seconds of
+    continuous work, in which case new files wait until the ones in flight are done.
+    The database backup is uploaded at most every backup_interval seconds.  The metrics
+    files are rewritten after every flush, so they can be scraped while the daemon runs.
+
+    Args:
+    pipeline (Pipeline): The work directory and settings.
+    workers (int): The most files sanitized at once, default is 2.
+    debounce (float): Seconds a file must be unchanged before it's picked up, default is 2.
+    poll_interval (float): Seconds between scans where inotify isn't available, default is 1.
+    flush_interval (float): The longest an ingested file waits for its upload while busy, default is 30.
+    backup_interval (float): The least time between database backups, default is 600.
+    metrics_json (str): Where to write the JSON metrics, default is metrics.json in the work directory.
+    metrics_prom (str): Where to write the Prometheus metrics, default is metrics.prom in the work directory.
+    stop (threading.Event): Set to make the daemon finish what's in flight and return.
+    """
+    stop = stop or threading.Event()
+
+    # catch up on anything left over from before the daemon started
+    pipeline.run()
+    pipeline.write_metrics(metrics_json=metrics_json, metrics_prom=metrics_prom)
+    last_backup = time.monotonic()
+
+    classifier = SanitizerFactory()
+    queue = collections.deque()
+    in_flight = {}
+    # ingested since the last flush, and when the oldest of them was
+    unflushed = 0
+    oldest = None
+
+    with Watcher(pipeline.path('unprocessed'), debounce=debounce, poll_interval=poll_interval) as watcher, \
+            MetadataWriter(pipeline.db_file, manifest=pipeline.manifest, batch_size=pipeline.metadata_batch) as writer, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        while not stop.is_set() or in_flight:
+            if not stop.is_set():
+                queue.extend(watcher.ready(timeout=0.0 if in_flight else 1.0))
+
+            # a due flush stops new work so it never packs a half-ingested file's thumbnail
+            flush_due = unflushed and (not in_flight and not queue or time.monotonic() - oldest >= flush_interval)
+            while queue and len(in_flight) < workers and not flush_due and not stop.is_set():
+                path = queue.popleft()
+                kind = classifier.kind(path)
+                if kind is None:
+                    logger.warning(f'{path} not image or video, leaving it')
+                    continue
+
+                threads = pipeline.sanitize_video_threads if kind == 'video' else None
+                future = executor.submit(sanitize_file, path, pipeline.src_dir, threads, pipeline.derived())
+                in_flight[future] = (path, time.monotonic())
+
+            if in_flight:
+                done, _ = concurrent.futures.wait(in_flight, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    path, queued = in_flight.pop(future)
+                    try:
+                        _, nbytes, seconds, output, renditions, _ = future.result()
+                    except Exception:
+                        logger.exception(f'failed to sanitize {path}')
+                        continue
+
+                    pipeline.metrics.record('sanitize', nbytes=nbytes, seconds=seconds)
+                    for stage in renditions:
+                        pipeline.manifest.mark(output, stage)
+                    try:
+                        pipeline.ingest_file(output, writer)
+                    except Exception:
+                        logger.exception(f'failed to ingest {output}')
+                        continue
+
+                    logger.info(f'ingested {path} in {time.monotonic() - queued:.1f}s')
+                    unflushed += 1
+                    oldest = oldest or time.monotonic()
+
+            if unflushed and not in_flight and (not queue or flush_due or stop.is_set()):
+                # the rows have to be in before the thumbnail index and backup
+                writer.flush()
+                pipeline.pack_thumbnails()
+                if time.monotonic() - last_backup >= backup_interval:
+                    pipeline.backup_database()
+                    last_backup = time.monotonic()
+                pipeline.upload()
+                pipeline.publish_previews()
+                pipeline.write_metrics(metrics_json=metrics_json, metrics_prom=metrics_prom)
+                logger.info(f'uploaded {unflushed} files')
+                unflushed = 0
+                oldest = None
+
+    # leave an up to date backup behind
+    pipeline.backup_database()
+    pipeline.upload()
@@ -0,0 +1,109 @@
+import os
+import time
+import hashlib
+import sqlite3
+import logging
+
+logger = logging.getLogger('manifest')
+
+class Manifest:
+    """
+    Persistent record of which ingest stages each file has completed, keyed by content hash.
+
+    Rows live in the manifest table of the main database so that the 'encrypted' stage
+    can be recorded in the same transaction as the files rows it produces.  Content
+    hashes are cached against (path, size, mtime) in a separate database, so unchanged
+    files aren't re-read on every run and caching never contends with the caller's
+    write transaction.
+
+    Methods:
+        __init__(db_file, hash_cache_file): Initialize with the database holding the manifest table
+            and the database caching content hashes.
+        hash(filepath): The sha256 of the file's content.
+        done(filepath, stage): Whether the file has completed the stage.
+        mark(filepath, stage, detail, cursor): Record a completed stage, in the caller's transaction if given a cursor.
+        mark_many(marks, cursor): mark() for a list of (filepath, stage, detail).
+        mark_uploaded(pending): Record every encrypted file as uploaded unless one of its servers is in pending.
+    """
+    STAGES = ('thumbnail', 'preview', 'chunked', 'encrypted', 'uploaded')
+
+    def __init__(self, db_file: str, hash_cache_file: str):
+        self.conn = sqlite3.connect(db_file)
+        self.hash_cache = sqlite3.connect(hash_cache_file)
+        self.hash_cache.execute(
+            'create table if not exists content_hashes (path text primary key, size integer, mtime_ns integer, hash text)'
+        )
+        self.hashes = {}
+
+    def hash(self, filepath: str) -> str:
+        stat = os.stat(filepath)
+        key = (filepath, stat.st_size, stat.st_mtime_ns)
+        if key in self.hashes:
+            return self.hashes[key]
+
+        row = self.hash_cache.execute(
+            'select hash from content_hashes where path = ? and size = ? and mtime_ns = ?',
+            key
+        ).fetchone()
+        if row:
+            self.hashes[key] = row[0]
+            return row[0]
+
+        sha256 = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                sha256.update(chunk)
+
+        self.hashes[key] = sha256.hexdigest()
+        self.hash_cache.execute('insert or replace into content_hashes values (?, ?, ?, ?)', (*key, self.hashes[key]))
+        self.hash_cache.commit()
+        return self.hashes[key]
+
+    def done(self, filepath: str, stage: str) -> bool:
+        return self.conn.execute(
+            'select 1 from manifest where hash = ? and stage = ?',
+            (self.hash(filepath), stage)
+        ).fetchone() is not None
+
+    def mark(self, filepath: str, stage: str, detail: str=None, *, cursor: sqlite3.Cursor=None) -> None:
+        # with a cursor the caller owns the transaction, otherwise the mark is committed here
+        assert stage in self.STAGES, stage
+        (cursor or self.conn).execute('insert or replace into manifest values (?, ?, ?, ?, ?)', (
+            self.hash(filepath),
+            stage,
+            os.path.basename(filepath),
+            detail,
+            int(time.time())
+        ))
+        if cursor is None:
+            self.conn.commit()
+
+    def mark_many(self, marks: list[tuple], *, cursor: sqlite3.Cursor=None) -> None:
+        # marks are (filepath, stage, detail)
+        assert all(stage in self.STAGES for _, stage, _ in marks), marks
+        (cursor or self.conn).executemany('insert or replace into manifest values (?, ?, ?, ?, ?)', [
+            (self.hash(filepath), stage, os.path.basename(filepath), detail, int(time.time()))
+            for filepath, stage, detail in marks
+        ])
+        if cursor is None:
+            self.conn.commit()
+
+    def mark_uploaded(self, pending: set) -> None:
+        # detail lists the servers a file was encrypted for, comma separated
+        rows = self.conn.execute("""
+            select hash, filename, detail from manifest as encrypted
+            where stage = 'encrypted' and not exists (
+                select 1 from manifest where hash = encrypted.hash and stage = 'uploaded'
+            )
+        """).fetchall()
+
+        self.conn.executemany('insert or replace into manifest values (?, ?, ?, ?, ?)', [
+            (content_hash, 'uploaded', filename, detail, int(time.time()))
+            for content_hash, filename, detail in rows
+            if not set(detail.split(',')) & pending
+        ])
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+        self.hash_cache.close()
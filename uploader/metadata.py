@@ -0,0 +1,91 @@
+import time
+import sqlite3
+import logging
+
+from common.schema import insert_files, insert_seek_index
+
+logger = logging.getLogger('metadata')
+
+class MetadataWriter:
+    """
+    Buffers files rows, seek index rows and manifest marks and writes them in short,
+    batched transactions.
+
+    A file's rows and its marks are always added together and so always land in the
+    same transaction.  The buffer is flushed once it holds batch_size files or its
+    oldest entry is max_delay seconds old, and on leaving the with block, so the write
+    lock is only held for one executemany at a time and never across encryption work.
+
+    Methods:
+        __init__(db_file, manifest, batch_size, max_delay): Initialize the writer connection and limits.
+        add(rows, marks, seek_index): Buffer one file's rows, manifest marks and seek index,
+            flushing if the batch is full.
+        flush(): Write everything buffered in one transaction.
+        close(): Flush and close the connection.
+    """
+    def __init__(
+        self,
+        db_file: str,
+        *,
+        manifest=None,
+        batch_size: int=500,
+        max_delay: float=5.0
+    ):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute('pragma journal_mode=wal')
+        # wal with synchronous=normal can't corrupt, it can only lose the last commits on power loss
+        self.conn.execute('pragma synchronous=normal')
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.files = 0
+        self.rows = []
+        self.marks = []
+        self.seek_index = []
+        self.oldest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, rows: list[dict], marks: list[tuple]=(), seek_index: list[dict]=()) -> None:
+        """
+        Args:
+        rows (list[dict]): files rows as taken by insert_files.
+        marks (list[tuple]): (filepath, stage, detail) manifest marks.
+        seek_index (list[dict]): video_chunks rows as taken by insert_seek_index.
+        """
+        self.rows.extend(rows)
+        self.marks.extend(marks)
+        self.seek_index.extend(seek_index)
+        self.files += 1
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+        if self.files >= self.batch_size or time.monotonic() - self.oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows and not self.marks and not self.seek_index:
+            return
+
+        start = time.perf_counter()
+        with self.conn:
+            cursor = self.conn.cursor()
+            insert_files(cursor, self.rows)
+            insert_seek_index(cursor, self.seek_index)
+            if self.manifest:
+                self.manifest.mark_many(self.marks, cursor=cursor)
+        logger.debug(f'wrote {len(self.rows)} rows for {self.files} files in {time.perf_counter() - start:.3f}s')
+
+        self.files = 0
+        self.rows = []
+        self.marks = []
+        self.seek_index = []
+        self.oldest = None
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
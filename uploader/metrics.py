@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import random
+import logging
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger('metrics')
+
+class StageMetrics:
+    """
+    Accumulates file counts, byte counts, wall time and per-file latencies per ingest stage.
+
+    Each record() is one file's worth of work.  Latency percentiles come from a uniform
+    sample of at most RESERVOIR latencies per stage, so a long running daemon doesn't
+    keep every one of them; the maximum is exact.  Wall time is the span from the earliest
+    recorded start to the latest recorded end of a stage, so stages that run files in
+    parallel report real throughput rather than summed work; span() stretches it over
+    a block whose files are recorded afterwards (e.g. results collected from a pool).
+
+    Stages named in profile_stages are run under cProfile and their stats dumped to
+    profile_dir as <stage>.prof; stages named in memory_stages record their peak
+    tracemalloc usage.  Both only see work done in this process.
+
+    Methods:
+        __init__(profile_stages, memory_stages, profile_dir): Initialize, optionally profiling some stages.
+        record(stage, nbytes, seconds): Add one unit of work to a stage.
+        stage(name, nbytes): Context manager timing the enclosed block as one unit of work.
+        span(name): Context manager counting the enclosed block towards a stage's wall time only.
+        summary(): Per-stage totals, throughput and latency percentiles.
+        report(): Log the throughput of every stage seen so far.
+        write_json(filepath): Write summary() as JSON.
+        write_prometheus(filepath): Write summary() in the Prometheus text format.
+    """
+    PERCENTILES = (50, 90, 99)
+    RESERVOIR = 4096
+
+    def __init__(
+        self,
+        *,
+        profile_stages: tuple=(),
+        memory_stages: tuple=(),
+        profile_dir: str=None
+    ):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        self.profile_stages = set(profile_stages)
+        self.memory_stages = set(memory_stages)
+        self.profile_dir = profile_dir
+        self.profiles = {}
+        # only one profiler can be active at a time
+        self.profiling = False
+
+    def _totals(self, stage):
+        # caller holds the lock
+        return self.stages.setdefault(stage, {
+            'files': 0,
+            'bytes': 0,
+            'seconds': 0.0,
+            'latencies': [],
+            'max_latency': 0.0,
+            'start': None,
+            'end': None,
+            'peak_memory': None,
+        })
+
+    def _extend(self, totals, start, end):
+        # caller holds the lock
+        totals['start'] = start if totals['start'] is None else min(totals['start'], start)
+        totals['end'] = end if totals['end'] is None else max(totals['end'], end)
+
+    def record(self, stage, *, nbytes=0, seconds=0.0):
+        end = time.perf_counter()
+        with self.lock:
+            totals = self._totals(stage)
+            totals['files'] += 1
+            totals['bytes'] += nbytes
+            totals['seconds'] += seconds
+            totals['max_latency'] = max(totals['max_latency'], seconds)
+            # reservoir sampling: every file so far is equally likely to be in the sample
+            if len(totals['latencies']) < self.RESERVOIR:
+                totals['latencies'].append(seconds)
+            else:
+                slot = random.randrange(totals['files'])
+                if slot < self.RESERVOIR:
+                    totals['latencies'][slot] = seconds
+            self._extend(totals, end - seconds, end)
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        start = time.perf_counter()
+        try:
+            with self._profiled(name):
+                yield
+        finally:
+            self.record(name, nbytes=nbytes, seconds=time.perf_counter() - start)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            with self._profiled(name):
+                yield
+        finally:
+            with self.lock:
+                self._extend(self._totals(name), start, time.perf_counter())
+
+    @contextmanager
+    def _profiled(self, name):
+        profile = None
+        if name in self.profile_stages and not self.profiling:
+            self.profiling = True
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+
+        trace = name in self.memory_stages
+        if trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        try:
+            yield
+        finally:
+            if trace:
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                with self.lock:
+                    totals = self._totals(name)
+                    totals['peak_memory'] = max(totals['peak_memory'] or 0, peak)
+
+            if profile:
+                profile.disable()
+                self.profiling = False
+
+    def summary(self) -> dict:
+        with self.lock:
+            stages = {}
+            for name, totals in self.stages.items():
+                wall = totals['end'] - totals['start'] if totals['start'] is not None else 0.0
+                latencies = sorted(totals['latencies'])
+                stages[name] = {
+                    'files': totals['files'],
+                    'bytes': totals['bytes'],
+                    'seconds': totals['seconds'],
+                    'wall_seconds': wall,
+                    'files_per_sec': totals['files'] / wall if wall else 0.0,
+                    'bytes_per_sec': totals['bytes'] / wall if wall else 0.0,
+                    'latency_seconds': {
+                        **{f'p{p}': _percentile(latencies, p) for p in self.PERCENTILES},
+                        'max': totals['max_latency'],
+                    },
+                    'peak_memory_bytes': totals['peak_memory'],
+                }
+            return {'started': self.started, 'finished': time.time(), 'stages': stages}
+
+    def report(self):
+        for name, stage in self.summary()['stages'].items():
+            latency = stage['latency_seconds']
+            logger.info(
+                f"{name}: {stage['files']} files, "
+                f"{stage['bytes'] / 1024 / 1024:.1f} MiB in {stage['wall_seconds']:.2f}s "
+                f"({stage['files_per_sec']:.1f} files/s, "
+                f"{stage['bytes_per_sec'] / 1024 / 1024:.1f} MiB/s, "
+                f"p50 {latency['p50'] * 1000:.0f}ms, p99 {latency['p99'] * 1000:.0f}ms)"
+            )
+
+        for name, profile in self.profiles.items():
+            filepath = os.path.join(self.profile_dir or '.', f'{name}.prof')
+            profile.dump_stats(filepath)
+            logger.info(f'{name}: profile written to {filepath}')
+
+    def write_json(self, filepath):
+        _write_atomic(filepath, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, filepath):
+        # for node_exporter's textfile collector, hence the atomic replace
+        stages = self.summary()['stages']
+        metrics = [
+            ('files_total', 'counter', 'Files processed by the stage.', lambda s: [('', s['files'])]),
+            ('bytes_total', 'counter', 'Bytes processed by the stage.', lambda s: [('', s['bytes'])]),
+            ('wall_seconds', 'gauge', 'Wall time of the stage in the last run.', lambda s: [('', s['wall_seconds'])]),
+            ('files_per_second', 'gauge', 'Files per second over the stage wall time.', lambda s: [('', s['files_per_sec'])]),
+            ('bytes_per_second', 'gauge', 'Bytes per second over the stage wall time.', lambda s: [('', s['bytes_per_sec'])]),
+            ('latency_seconds', 'summary', 'Per-file latency of the stage.', lambda s: [
+                *((f',quantile="0.{p:02d}"', s['latency_seconds'][f'p{p}']) for p in self.PERCENTILES),
+                ('_sum', s['seconds']),
+                ('_count', s['files']),
+            ]),
+            ('peak_memory_bytes', 'gauge', 'Peak traced memory of the stage.', lambda s: [
+                ('', s['peak_memory_bytes'])
+            ] if s['peak_memory_bytes'] is not None else []),
+        ]
+
+        lines = []
+        for metric, kind, description, samples in metrics:
+            lines += [f'# HELP megabuse_stage_{metric} {description}', f'# TYPE megabuse_stage_{metric} {kind}']
+            for name, stage in stages.items():
+                for suffix, value in samples(stage):
+                    if suffix.startswith('_'):
+                        lines.append(f'megabuse_stage_{metric}{suffix}{{stage="{name}"}} {value}')
+                    else:
+                        lines.append(f'megabuse_stage_{metric}{{stage="{name}"{suffix}}} {value}')
+        _write_atomic(filepath, '\n'.join(lines) + '\n')
+
+def _percentile(values, percentile):
+    # nearest rank on sorted values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(percentile / 100 * len(values)) - 1))]
+
+def _write_atomic(filepath, text):
+    with open(f'{filepath}.tmp', 'w') as f:
+        f.write(text)
+    os.replace(f'{filepath}.tmp', filepath)
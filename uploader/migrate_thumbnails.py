@@ -0,0 +1,69 @@
+"""
+one-shot conversion of a ui static/thumbnails directory full of
+individual <filename>.jpg files into the packed thumbnail store.
+
+the thumbnails are appended to segment files in the same directory and
+indexed in the thumbnails table.  thumbnails that are already indexed are
+skipped, so the tool can be rerun after an interruption.
+
+usage: python migrate_thumbnails.py <static/thumbnails dir> [--delete]
+"""
+
+import os
+import sys
+import glob
+import logging
+import sqlite3
+import argparse
+from dotenv import load_dotenv
+
+from common.schema import migrate
+from common.thumbstore import ThumbnailStore
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+    datefmt='%H:%M:%S'
+)
+
+logger = logging.getLogger('migrate_thumbnails')
+load_dotenv()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('thumbnail_dir', help='the directory holding the <filename>.jpg thumbnails')
+    parser.add_argument('--delete', action='store_true', help='remove the jpgs once they are all packed')
+    parser.add_argument('--batch', type=int, default=1000, help='thumbnails per transaction')
+    args = parser.parse_args()
+
+    store = ThumbnailStore(args.thumbnail_dir)
+    with sqlite3.connect(os.path.join(os.getenv('mega_root'), 'database.db')) as conn:
+        migrate(conn)
+        cursor = conn.cursor()
+        packed = {row[0] for row in cursor.execute('select filename from thumbnails')}
+
+        count = 0
+        for filepath in sorted(glob.glob(os.path.join(args.thumbnail_dir, '*.jpg'))):
+            filename = os.path.basename(filepath)[:-4]
+            if filename not in packed:
+                with open(filepath, 'rb') as f:
+                    store.add(cursor, filename, f.read())
+                count += 1
+                if count % args.batch == 0:
+                    store.sync()
+                    conn.commit()
+                    logger.info(f'packed {count} thumbnails')
+
+        store.sync()
+        conn.commit()
+    store.close()
+
+    if args.delete:
+        # only once everything is committed
+        for filepath in glob.glob(os.path.join(args.thumbnail_dir, '*.jpg')):
+            os.remove(filepath)
+    logger.info(f'packed {count} thumbnails, {len(packed)} were already packed')
+
+if __name__ == '__main__':
+    main()
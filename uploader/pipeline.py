@@ -0,0 +1,467 @@
+import os
+import re
+import glob
+import errno
+import time
+import base64
+import shutil
+import sqlite3
+import logging
+import tempfile
+from datetime import datetime
+
+from thumbnail_generator import generate_thumbnails, derive, Rendition, PREVIEW
+from chunker import chunk_video, seek_index
+from sanitizer import sanitize
+from common.encrypt import Encrypter
+from common.schema import migrate
+from common.storage import LocalBackend, MegatoolsBackend
+from common.thumbstore import ThumbnailStore
+from manifest import Manifest
+from metadata import MetadataWriter
+from metrics import StageMetrics
+from streaming import StreamingIngest
+from upload import upload_all
+
+logger = logging.getLogger('pipeline')
+
+THUMB_SIZE = (128*2, 96*2)
+
+def unix_timestamp(filename):
+    if match := re.search(r'\d{8}_\d{6}', filename):
+        try:
+            dt = datetime.strptime(match.group(), '%Y%m%d_%H%M%S')
+            return int(dt.timestamp())
+        except:
+            pass # fall through to main return
+    return int(time.time())
+
+class Pipeline:
+    """
+    The ingest stages over one work directory (mega_root), importable and runnable one at a time.
+
+    Constructing a pipeline migrates the database, loads the storage servers and creates the
+    work directories; nothing else happens until a stage is called.  run() is the whole batch
+    that uploader.py used to be, daemon.watch() pushes files through one at a time.
+
+    Methods:
+        __init__(mega_root, ...): Initialize with the work directory, keys and settings.
+        from_env(): A pipeline configured from environment variables.
+        path(*subdirectories): A path inside the work directory.
+        sanitize(): Sanitize everything in unprocessed/ into sanitized/.
+        derived(): The renditions the sanitizer writes for each image.
+        ingest(): Thumbnail, preview, chunk and encrypt everything in sanitized/.
+        ingest_file(filepath, writer): Stream one sanitized file into the server directories.
+        pack_thumbnails(): Append new thumbnails to the ui's packed thumbnail store.
+        backup_database(): Encrypt the database into every server directory.
+        backup_name(server): The name of the database backup in a server's storage.
+        upload(): Upload the server directories.
+        publish_previews(): Move previews into the ui static directory.
+        run(sanitize): Every stage once, over whatever is waiting.
+        write_metrics(metrics_json, metrics_prom): Write the metrics out, by default into the work directory.
+        report(metrics_json, metrics_prom): Log the metrics and write them out.
+        close(): Close the manifest.
+    """
+    def __init__(
+        self,
+        mega_root: str,
+        *,
+        key: bytes,
+        iv: bytes,
+        ui_static_dir: str,
+        pipeline_mode: str='batch',
+        storage_backend: str='megatools',
+        storage_dir: str=None,
+        megatools_bin: str='megatools',
+        storage_workers_per_account: int=2,
+        thumbnail_workers: int | None=None,
+        thumbnail_video_workers: int=1,
+        metadata_batch: int=500,
+        sanitize_video_threads: int=4,
+        sanitize_memory_limit: int | None=None,
+        upload_workers: int=4,
+        upload_retries: int=3,
+        upload_backoff: float=5.0,
+        metrics: StageMetrics=None
+    ):
+        self.mega_root = mega_root
+        self.ui_static_dir = ui_static_dir
+        # batch: every stage runs over the whole directory, writing its output to disk.
+        # streaming: each sanitized file is read once and pushed through every stage,
+        #            chunks are encrypted straight into the server directories.
+        self.pipeline_mode = pipeline_mode
+        self.thumbnail_workers = thumbnail_workers
+        self.thumbnail_video_workers = thumbnail_video_workers
+        # files per metadata write transaction
+        self.metadata_batch = metadata_batch
+        self.sanitize_video_threads = sanitize_video_threads
+        self.sanitize_memory_limit = sanitize_memory_limit
+        self.upload_workers = upload_workers
+        self.upload_retries = upload_retries
+        self.upload_backoff = upload_backoff
+        self.metrics = metrics or StageMetrics()
+        self.src_dir = self.path('sanitized')
+
+        # load available storage servers from db
+        self.db_file = self.path('database.db')
+        with sqlite3.connect(self.db_file) as conn:
+            conn.row_factory = sqlite3.Row
+
+            # the uploader is the database's only writer, so it alone migrates it.
+            # wal lets the ui's readers carry on while it writes
+            migrate(conn)
+            conn.execute('pragma journal_mode=wal')
+
+            cursor = conn.cursor()
+            cursor.execute('select * from servers')
+            self.servers = cursor.fetchall()
+
+        # create work dir with children named after storage servers
+        for server in self.servers:
+            os.makedirs(self.path(server['email']), exist_ok=True)
+        for directory in ('unprocessed', 'sanitized', 'thumbnails', 'video_chunks', 'previews'):
+            os.makedirs(self.path(directory), exist_ok=True)
+
+        # stages each file has already been through, so a rerun only does what's left
+        self.manifest = Manifest(self.db_file, self.path('content_hashes.db'))
+
+        self.encrypter = Encrypter(key=key, iv=iv)
+
+        # storage_backend=local mirrors to storage_dir instead of uploading to mega
+        if storage_backend == 'local':
+            self.storage = LocalBackend(storage_dir)
+        else:
+            passwords = {}
+            for server in self.servers:
+                dek = self.encrypter.decrypt(server['dek'])
+                passwords[server['email']] = self.encrypter.decrypt(server['mega_pw'], iv=dek).decode('utf-8')
+
+            self.storage = MegatoolsBackend(
+                passwords.get,
+                binary=megatools_bin,
+                workers_per_account=storage_workers_per_account
+            )
+
+        self.streaming = StreamingIngest(
+            encrypter=self.encrypter,
+            servers=self.servers,
+            path=self.path,
+            db_file=self.db_file,
+            timestamp=unix_timestamp,
+            metrics=self.metrics,
+            thumb_size=THUMB_SIZE,
+            manifest=self.manifest,
+            metadata_batch=self.metadata_batch
+        )
+
+    @classmethod
+    def from_env(cls):
+        mega_root = os.getenv('mega_root')
+        return cls(
+            mega_root,
+            key=base64.b64decode(os.getenv('key')),
+            iv=base64.b64decode(os.getenv('iv')),
+            ui_static_dir=os.getenv('ui_static_dir', '/home/dan/storage/docker/megabuse/ui/static'),
+            pipeline_mode=os.getenv('pipeline_mode', 'batch'),
+            storage_backend=os.getenv('storage_backend', 'megatools'),
+            storage_dir=os.getenv('storage_dir'),
+            megatools_bin=os.getenv('megatools_bin', 'megatools'),
+            storage_workers_per_account=int(os.getenv('storage_workers_per_account', 2)),
+            thumbnail_workers=int(os.getenv('thumbnail_workers', os.cpu_count())),
+            thumbnail_video_workers=int(os.getenv('thumbnail_video_workers', 1)),
+            metadata_batch=int(os.getenv('metadata_batch', 500)),
+            # transcodes get sanitize_video_threads ffmpeg threads each, images fill the other cores
+            sanitize_video_threads=int(os.getenv('sanitize_video_threads', 4)),
+            sanitize_memory_limit=int(os.getenv('sanitize_memory_limit', 0)) or None,
+            upload_workers=int(os.getenv('upload_workers', 4)),
+            upload_retries=int(os.getenv('upload_retries', 3)),
+            upload_backoff=float(os.getenv('upload_backoff', 5)),
+            # stages named in profile_stages / trace_memory_stages (comma separated) are
+            # run under cProfile / tracemalloc, see StageMetrics
+            metrics=StageMetrics(
+                profile_stages=[stage for stage in os.getenv('profile_stages', '').split(',') if stage],
+                memory_stages=[stage for stage in os.getenv('trace_memory_stages', '').split(',') if stage],
+                profile_dir=mega_root
+            )
+        )
+
+    def path(self, *subdirectories):
+        return os.path.join(self.mega_root, *subdirectories)
+
+    def derived(self):
+        # images (heic above all) get their thumbnail and preview from the sanitizer's own decode
+        return [
+            (Rendition('thumbnail', THUMB_SIZE, crop=True), self.path('thumbnails', '{filename}.jpg')),
+            (PREVIEW, self.path('previews', '{filename}'))
+        ]
+
+    def sanitize(self):
+        # users can dump any kind of image/video file here,
+        # and we'll sanitize them into jpg/webm files for further processing.
+        logger.info('sanitizing data...')
+        results = sanitize(
+            self.path('unprocessed'),
+            self.src_dir,
+            metrics=self.metrics,
+            video_threads=self.sanitize_video_threads,
+            memory_limit=self.sanitize_memory_limit,
+            derived=self.derived()
+        )
+        # so the thumbnail and preview stages skip them
+        for result in results:
+            for stage in result.derived:
+                self.manifest.mark(result.output, stage)
+
+    # encrypt and move images into work dir children, round robin style, updatin db
+    def encrypt_and_move(self, src_glob):
+        # metadata is buffered and written in short batched transactions,
+        # so the ui's reads never wait behind a whole encryption run
+        with MetadataWriter(self.db_file, manifest=self.manifest, batch_size=self.metadata_batch) as writer:
+            counter = 0
+            for filepath in glob.glob(src_glob):
+                filename = os.path.basename(filepath)
+                if self.manifest.done(filepath, 'encrypted'):
+                    logger.debug(f'skipping {filepath}, already encrypted')
+                    continue
+
+                dek = Encrypter.generate_iv()
+                encrypted_dek = self.encrypter.encrypt(dek)
+
+                email = self.servers[counter % len(self.servers)]['email']
+                with self.metrics.stage('encrypt', os.path.getsize(filepath)):
+                    self.encrypter.encrypt_file(
+                        src_file=filepath,
+                        dest_file=self.path(email, self.encrypter.hash(filename, iv=dek)),
+                        iv=dek
+                    )
+
+                # videos are chunked, and there's only one thumbnail for the whole set.
+                if filename.endswith('.jpg') or filename.endswith('_0000.webm'):
+                    thumb_filename = f"{filename.replace('_0000.webm', '.webm')}.jpg"
+                    thumb_filepath = os.path.join(self.path('thumbnails', thumb_filename))
+
+                    # no need to store the thumbnail entry in the metastore.
+                    # we know its filename and which server it's on based on the main file.
+                    self.encrypter.encrypt_file(
+                        src_file=thumb_filepath,
+                        dest_file=self.path(email, self.encrypter.hash(thumb_filename, iv=dek)),
+                        iv=dek
+                    )
+
+                if filename.endswith('.jpg'):
+                    # images also have their corresponding preview.
+                    # we give it a different hash than the original image
+                    # by appending ".preview" on it.
+                    self.encrypter.encrypt_file(
+                        src_file=self.path('previews', filename),
+                        dest_file=self.path(email, self.encrypter.hash(f'{filename}.preview', iv=dek)),
+                        iv=dek
+                    )
+
+                # the manifest mark goes in the same batch as the files row,
+                # so a crash can't leave one without the other
+                writer.add([{
+                    'filename': filename,
+                    'unix_timestamp': unix_timestamp(filename),
+                    'email': email,
+                    'dek': encrypted_dek
+                }], [(filepath, 'encrypted', email)])
+
+                counter += 1
+
+    def batch_ingest(self):
+        # now we have sanitized files, we can generate thumbnails from them.
+        # this step needs to be done here because we'll be breaking up
+        # the videos into chunks, and we only want one thumbnail per video.
+        logger.info('generating thumbnails...')
+        with self.metrics.span('thumbnail'):
+            results = generate_thumbnails(
+                src_dir=self.src_dir,
+                dest_dir=self.path('thumbnails'),
+                thumb_size=THUMB_SIZE,
+                workers=self.thumbnail_workers,
+                video_workers=self.thumbnail_video_workers,
+                skip=lambda filepath: self.manifest.done(filepath, 'thumbnail'),
+                # images get their preview from the same decode as the thumbnail
+                derived=[(PREVIEW, self.path('previews', '{filename}'))]
+            )
+        for result in results:
+            if not result.error:
+                self.metrics.record('thumbnail', nbytes=os.path.getsize(result.path), seconds=result.seconds)
+                self.manifest.mark(result.path, 'thumbnail')
+                if PREVIEW.name in result.derived:
+                    self.manifest.mark(result.path, 'preview')
+
+
+        # all images have a corresponding preview.
+        # we cache this alongisde the initial video chunk for each video.
+        # they're normally written with the thumbnails, this only catches up
+        # images whose thumbnail was made by an earlier run.
+        logger.info('generating previews...')
+        for filepath in glob.glob(self.path('sanitized', '*.jpg')):
+            if self.manifest.done(filepath, 'preview'):
+                continue
+
+            with self.metrics.stage('preview', os.path.getsize(filepath)):
+                img = derive(filepath, [PREVIEW])[PREVIEW.name]
+                filename = os.path.basename(filepath)
+                img.save(self.path('previews', filename), 'JPEG', quality=PREVIEW.quality, optimize=True)
+            self.manifest.mark(filepath, 'preview')
+
+
+        # enrypt and move the images first - videos need further processing
+        logger.info('encrypting images...')
+        self.encrypt_and_move(os.path.join(self.src_dir, '*.jpg'))
+
+
+
+        # chunk the videos, cutting on keyframes so the ui can seek by chunk
+        logger.info('chunking videos...')
+        with MetadataWriter(self.db_file, manifest=self.manifest, batch_size=self.metadata_batch) as writer:
+            for filepath in glob.glob(os.path.join(self.src_dir, '*.webm')):
+                # chunk sizes are random, so chunking again would produce chunks
+                # that don't match the ones already encrypted.
+                if self.manifest.done(filepath, 'chunked'):
+                    continue
+
+                with self.metrics.stage('chunk', os.path.getsize(filepath)):
+                    plan = chunk_video(filepath, self.path('video_chunks'))
+                # the seek index lands with the chunked mark, so a rerun never leaves chunks without one
+                writer.add([], [(filepath, 'chunked', None)], seek_index(os.path.basename(filepath), plan))
+
+
+        # keep the first chunk of each video for quick serving.
+        # video_chunks/ only holds chunks that haven't been encrypted yet (see below)
+        logger.info('copying preview video chunks...')
+        for filepath in glob.glob(os.path.join(self.path('video_chunks', '*_0000.webm'))):
+            shutil.copyfile(filepath, self.path('previews', os.path.basename(filepath)))
+
+        # now encrypt and move all the chunks to their upload directories
+        logger.info('encrypting video chunks...')
+        self.encrypt_and_move(os.path.join(self.path('video_chunks'), '*.webm'))
+
+        # the encrypted chunks are in the server directories and the first ones in previews/,
+        # so the next run doesn't copy and publish them again
+        for filepath in glob.glob(self.path('video_chunks', '*.webm')):
+            if self.manifest.done(filepath, 'encrypted'):
+                os.remove(filepath)
+
+    def ingest(self):
+        if self.pipeline_mode == 'streaming':
+            logger.info('streaming sanitized files into server directories...')
+            self.streaming.run(self.src_dir)
+        else:
+            self.batch_ingest()
+
+    def ingest_file(self, filepath, writer):
+        self.streaming.ingest(filepath, writer)
+
+    def pack_thumbnails(self):
+        # append the thumbnails to the ui's packed thumbnail store.
+        # this has to happen before the db backup so the backup includes the index.
+        logger.info('packing thumbnails...')
+        thumbnail_store = ThumbnailStore(os.path.join(self.ui_static_dir, 'thumbnails'))
+        filepaths = glob.glob(self.path('thumbnails', '*.jpg'))
+        with sqlite3.connect(self.db_file) as conn:
+            cursor = conn.cursor()
+            for filepath in filepaths:
+                with open(filepath, 'rb') as f:
+                    # thumbnails are named after the file they belong to, plus .jpg
+                    thumbnail_store.add(cursor, os.path.basename(filepath)[:-4], f.read())
+            # the segment has to be on disk before the rows pointing into it,
+            # and both before the jpgs go, or a crash in between loses thumbnails
+            thumbnail_store.sync()
+            conn.commit()
+        thumbnail_store.close()
+
+        for filepath in filepaths:
+            os.remove(filepath)
+
+    def backup_database(self):
+        # back up the db file in each of the remote storages.
+        # the db is in wal mode and the manifest holds a connection open all run, so recent
+        # commits may only be in the wal: copy a consistent snapshot rather than the raw file
+        with tempfile.TemporaryDirectory(dir=self.mega_root) as snapshot_dir:
+            snapshot = os.path.join(snapshot_dir, 'database.db')
+            source = sqlite3.connect(self.db_file)
+            dest = sqlite3.connect(snapshot)
+            try:
+                source.backup(dest)
+            finally:
+                dest.close()
+                source.close()
+
+            for server in self.servers:
+                self.encrypter.encrypt_file(
+                    src_file=snapshot,
+                    dest_file=self.path(server['email'], self.backup_name(server))
+                )
+
+    def backup_name(self, server):
+        return self.encrypter.hash(server['email'])
+
+    def upload(self):
+        # upload the server directories concurrently, one account per worker
+        summaries = upload_all(
+            self.servers,
+            storage=self.storage,
+            local_dir=lambda server: self.path(server['email']),
+            workers=self.upload_workers,
+            retries=self.upload_retries,
+            backoff=self.upload_backoff,
+            # the backup keeps its name, every other object is named after its content
+            replace=lambda server: {self.backup_name(server)}
+        )
+
+        pending_uploads = set()
+        for summary in summaries:
+            self.metrics.record('upload', nbytes=summary['bytes'], seconds=summary['seconds'])
+
+            if not summary['ok']:
+                # keep the directory, the next run uploads it again
+                logger.error(f"upload to {summary['email']} failed")
+                pending_uploads.add(summary['email'])
+                continue
+
+            logger.info('removing local directory ' + self.path(summary['email']))
+            shutil.rmtree(self.path(summary['email']))
+            # a long running pipeline keeps encrypting into it
+            os.makedirs(self.path(summary['email']))
+
+        self.manifest.mark_uploaded(pending_uploads)
+
+    def publish_previews(self):
+        # move the previews into the ui static directory, replacing any a rerun made again
+        previews_dir = os.path.join(self.ui_static_dir, 'previews')
+        os.makedirs(previews_dir, exist_ok=True)
+        for filepath in glob.glob(self.path('previews', '*.*')):
+            target = os.path.join(previews_dir, os.path.basename(filepath))
+            try:
+                os.replace(filepath, target)
+            except OSError as e:
+                # the ui's static directory is often another mount
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(filepath, target)
+
+    def run(self, *, sanitize: bool=False):
+        if sanitize:
+            self.sanitize()
+        self.ingest()
+        self.pack_thumbnails()
+        self.backup_database()
+        self.upload()
+        self.publish_previews()
+
+    def report(self, *, metrics_json: str=None, metrics_prom: str=None):
+        self.metrics.report()
+        for operation, histogram in self.storage.stats().items():
+            logger.info(f"storage {operation}: {histogram['count']} calls, {histogram['sum_ms'] / max(histogram['count'], 1):.0f}ms average")
+        self.write_metrics(metrics_json=metrics_json, metrics_prom=metrics_prom)
+
+    def write_metrics(self, *, metrics_json: str=None, metrics_prom: str=None):
+        self.metrics.write_json(metrics_json or self.path('metrics.json'))
+        self.metrics.write_prometheus(metrics_prom or self.path('metrics.prom'))
+
+    def close(self):
+        self.manifest.close()
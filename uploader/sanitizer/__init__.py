@@ -1 +1 @@
-from .sanitizer import sanitize
\ No newline at end of file
+from .sanitizer import sanitize, sanitize_file, SanitizeResult
\ No newline at end of file
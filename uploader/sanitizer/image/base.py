@@ -1,10 +1,14 @@
 import logging
 import os
-from PIL import Image
+from PIL import Image, ImageOps
+from thumbnail_generator.derivatives import derive
 
 logger = logging.getLogger('video_base')
 
 class Base:
+    # decoded pixels are held as 4 bytes each (RGB is padded to RGBX)
+    BYTES_PER_PIXEL = 4
+
     def __init__(self, filepath):
         self.path, self.filename = os.path.split(filepath)
 
@@ -12,17 +16,56 @@ class Base:
     def filepath(self):
         return os.path.join(self.path, self.filename)
 
-    def process(self, output_dir):
-        image = self.load_image()
-        image.save(
-            os.path.join(
-                output_dir, 
-                os.path.splitext(self.filename)[0] + '.jpg'
-            ), 
-            "JPEG"
-        )
+    def process(self, output_dir, derived=()):
+        """
+        Re-encode the image as jpg into output_dir, and write every rendition in derived
+        from the same decode so nothing downstream has to decode the jpg again.
+
+        Args:
+        output_dir (str): Where the sanitized jpg goes.
+        derived (list[tuple]): (Rendition, path pattern with a {filename} field) pairs,
+            filename being the sanitized jpg's name.
+
+        Returns:
+        tuple: The sanitized jpg's path and the names of the renditions written.
+        """
+        filename = os.path.splitext(self.filename)[0] + '.jpg'
+        output = os.path.join(output_dir, filename)
+
+        image = self.orient(self.load_image())
+        if image.mode not in ('RGB', 'L'):
+            # jpeg has no alpha or palette
+            image = image.convert('RGB')
+        image.save(output, "JPEG")
+
+        renditions = derive(image, [rendition for rendition, _ in derived]) if derived else {}
+        for rendition, pattern in derived:
+            renditions[rendition.name].save(
+                pattern.format(filename=filename),
+                format='JPEG',
+                quality=rendition.quality,
+                optimize=True
+            )
+        image.close()
 
         os.remove(self.filepath)
+        return output, tuple(renditions)
     
     def load_image(self):
-        return Image.open(self.filepath)
\ No newline at end of file
+        return Image.open(self.filepath)
+
+    def size(self):
+        # from the header, nothing is decoded
+        with Image.open(self.filepath) as image:
+            return image.size
+
+    def peak_bytes(self):
+        # roughly the most memory processing this image holds at once: the full decode,
+        # the renditions are small next to it
+        width, height = self.size()
+        return width * height * self.BYTES_PER_PIXEL
+
+    def orient(self, image):
+        # the sanitized jpg carries no exif, so this is the one place orientation is applied
+        ImageOps.exif_transpose(image, in_place=True)
+        return image
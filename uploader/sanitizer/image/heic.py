@@ -1,18 +1,32 @@
-from image.base import Base
+from .base import Base
 from PIL import Image
 import pyheif
 
 class Heic(Base):
+    # libheif's RGB buffer (3 bytes a pixel) is alive while Pillow's copy is made
+    BYTES_PER_PIXEL = 7
+
     def __init__(self, filepath):
         super().__init__(filepath)
     
     def load_image(self):
         heif_file = pyheif.read(self.filepath)
-        return Image.frombytes(
+        # frombuffer wraps libheif's buffer rather than copying it where Pillow's
+        # layout allows (RGBA); RGB still has to be unpacked to 4 bytes a pixel
+        return Image.frombuffer(
             heif_file.mode, 
             heif_file.size, 
             heif_file.data, 
             "raw", 
             heif_file.mode, 
             heif_file.stride,
-        )
\ No newline at end of file
+            1,
+        )
+
+    def size(self):
+        return pyheif.open(self.filepath).size
+
+    def orient(self, image):
+        # libheif has already applied the container's rotation and mirroring (irot/imir),
+        # which is what the exif orientation describes; applying it again would double rotate
+        return image
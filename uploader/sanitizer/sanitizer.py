@@ -1,20 +1,245 @@
 import os
+import time
 import logging
+import contextlib
+from collections import namedtuple
 
 import concurrent.futures
 
-from sanitizer_factory import SanitizerFactory
+from .sanitizer_factory import SanitizerFactory
+from .video.base import Base as VideoBase
 
 logger = logging.getLogger('sanitizer')
 
-def sanitize(src_dir, dest_dir):
-    factory = SanitizerFactory()
+# rough seconds of work per MiB on one core, only used to order the queue.
+# vp9 encodes are orders of magnitude slower than re-encoding a still
+COST_PER_MIB = {
+    'video': 30.0,
+    'heic': 0.3,
+    'image': 0.05,
+}
 
-    entries = [entry.path for entry in os.scandir(src_dir)]
+# memory: estimated peak bytes of the decode (0 for videos, ffmpeg's memory is its own)
+Job = namedtuple('Job', ['path', 'kind', 'nbytes', 'cost', 'memory'])
+# output: the sanitized file, derived: names of the renditions written from its decode,
+# peak_rss: the worker's peak resident memory during the job, None where it can't be measured
+SanitizeResult = namedtuple(
+    'SanitizeResult',
+    ['path', 'kind', 'nbytes', 'waited', 'seconds', 'threads', 'error', 'output', 'derived', 'peak_rss'],
+    defaults=[None, (), None]
+)
 
-    def process(path):
-        logger.info(f'processing: {path}')
-        factory.create(path).process(dest_dir)
+# one factory per worker process, libmagic handles can't be pickled
+factory = None
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
-        results = list(executor.map(process, entries))
+def _reset_peak_rss():
+    # linux only, writing 5 resets the process's peak rss (VmHWM) to its current rss
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def sanitize_file(path, dest_dir, threads=None, derived=()):
+    """
+    Sanitize one file, in whatever process calls it.
+
+    Args:
+    path (str): The unsanitized file, removed once it's sanitized.
+    dest_dir (str): Where the sanitized jpg/webm goes.
+    threads (int): The ffmpeg thread budget for a video, default is ffmpeg's own.
+    derived (list[tuple]): (Rendition, path pattern) pairs to write for an image.
+
+    Returns:
+    tuple: path, nbytes, seconds, the sanitized file, the renditions written and the peak rss.
+    """
+    global factory
+    if factory is None:
+        factory = SanitizerFactory()
+
+    logger.info(f'processing: {path}')
+    nbytes = os.path.getsize(path)
+    _reset_peak_rss()
+    start = time.perf_counter()
+    sanitizer = factory.create(path)
+    if isinstance(sanitizer, VideoBase):
+        output, renditions = sanitizer.process(dest_dir, threads=threads), ()
+    else:
+        # images hand their decode straight to the thumbnail/preview renditions
+        output, renditions = sanitizer.process(dest_dir, derived=derived)
+    return path, nbytes, time.perf_counter() - start, output, renditions, _peak_rss()
+
+def plan(paths: list[str]) -> list[Job]:
+    """
+    Classify files and estimate what each costs to sanitize, most expensive first.
+
+    Args:
+    paths (list[str]): The files to sanitize.
+
+    Returns:
+    list[Job]: The jobs, files that aren't images or videos are left out.
+    """
+    classifier = SanitizerFactory()
+    jobs = []
+    for path in paths:
+        kind = classifier.kind(path)
+        if kind is None:
+            logger.warning(f'{path} not image or video, skipping')
+            continue
+        nbytes = os.path.getsize(path)
+        # only reads the header
+        memory = 0 if kind == 'video' else classifier.create(path).peak_bytes()
+        jobs.append(Job(path, kind, nbytes, nbytes / 1024 / 1024 * COST_PER_MIB[kind], memory))
+
+    # longest first, so a big transcode never starts last and runs on alone
+    return sorted(jobs, key=lambda job: job.cost, reverse=True)
+
+def sanitize(
+    src_dir,
+    dest_dir,
+    metrics=None,
+    *,
+    cores: int | None=None,
+    video_threads: int=4,
+    memory_limit: int | None=None,
+    derived: list[tuple]=()
+) -> list[SanitizeResult]:
+    """
+    Sanitize every file in src_dir into dest_dir, keeping all cores busy.
+
+    Jobs are started most expensive first.  A video transcode holds video_threads cores
+    (passed to ffmpeg as its thread budget) and an image conversion holds one, and a job
+    only starts once the cores it needs are free, so the long multi-threaded encodes
+    start early and the short single-threaded conversions fill in around them.  While
+    images are waiting transcodes only get half the cores between them (one transcode
+    at least, on at most half the cores); once none are left, videos split the free
+    cores between them instead.
+
+    Images are decoded once: the renditions in derived (thumbnail, preview) are written
+    from the same decode as the sanitized jpg, in the same worker.  With memory_limit set,
+    an image only starts if the estimated peak of every decode running stays under it.
+
+    Args:
+    src_dir (str): The directory of unsanitized files.
+    dest_dir (str): Where the sanitized jpg/webm files go.
+    metrics (StageMetrics): Records each job under 'sanitize', optional.
+    cores (int): The number of cores to schedule, default is os.cpu_count().
+    video_threads (int): The ffmpeg thread budget per transcode while images are waiting, default is 4.
+    memory_limit (int): Bytes the running image decodes may take between them, default is no limit.
+    derived (list[tuple]): (Rendition, path pattern with a {filename} field) pairs to write for every image.
+
+    Returns:
+    list[SanitizeResult]: One result per job in the order they finished,
+        with the seconds it waited in the queue and ran for and the worker's peak memory.
+    """
+    cores = cores or os.cpu_count()
+    video_threads = max(1, min(video_threads, cores))
+    queue = plan([entry.path for entry in os.scandir(src_dir) if entry.is_file()])
+    total = len(queue)
+    logger.info(
+        f"sanitizing {total} files ({sum(job.kind == 'video' for job in queue)} videos) "
+        f"on {cores} cores, {video_threads} threads per transcode"
+    )
+
+    free = cores
+    video_cores = 0
+    memory = 0
+    running = {}
+    results = []
+    busy_core_seconds = 0.0
+    start = time.perf_counter()
+
+    with metrics.span('sanitize') if metrics else contextlib.nullcontext(), \
+            concurrent.futures.ProcessPoolExecutor(max_workers=cores) as executor:
+        while queue or running:
+            # start the most expensive job that fits in the free cores, until none does
+            started = True
+            while started:
+                started = False
+                images_waiting = any(job.kind != 'video' for job in queue)
+                videos_waiting = sum(job.kind == 'video' for job in queue)
+                for job in queue:
+                    if job.kind == 'video':
+                        if images_waiting:
+                            # leave the other half of the cores to the images, however many
+                            # threads a transcode would otherwise get
+                            threads = min(video_threads, max(1, cores // 2))
+                        else:
+                            threads = max(video_threads, free // videos_waiting)
+                        # a transcode never waits on more cores than there are
+                        threads = min(threads, cores)
+                        # leave room for the images, but always let one transcode run
+                        fits = threads <= free and (
+                            not images_waiting or not video_cores or video_cores + threads <= cores // 2
+                        )
+                    else:
+                        threads = 1
+                        # one decode always runs, however big
+                        fits = threads <= free and (
+                            not memory_limit or not memory or memory + job.memory <= memory_limit
+                        )
+
+                    if fits:
+                        queue.remove(job)
+                        future = executor.submit(
+                            sanitize_file, job.path, dest_dir, threads if job.kind == 'video' else None, derived
+                        )
+                        running[future] = (job, threads, time.perf_counter())
+                        free -= threads
+                        memory += job.memory
+                        if job.kind == 'video':
+                            video_cores += threads
+                        started = True
+                        break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job, threads, started_at = running.pop(future)
+                free += threads
+                memory -= job.memory
+                if job.kind == 'video':
+                    video_cores -= threads
+                seconds = time.perf_counter() - started_at
+                busy_core_seconds += seconds * threads
+
+                output, renditions, peak_rss = None, (), None
+                try:
+                    _, _, seconds, output, renditions, peak_rss = future.result()
+                    error = None
+                except Exception as e:
+                    logger.exception(f'failed to sanitize {job.path}')
+                    error = e
+
+                result = SanitizeResult(
+                    job.path, job.kind, job.nbytes, started_at - start, seconds, threads, error,
+                    output, renditions, peak_rss
+                )
+                results.append(result)
+                if metrics and not error:
+                    metrics.record('sanitize', nbytes=job.nbytes, seconds=seconds)
+
+                logger.info(
+                    f'{job.kind} {os.path.basename(job.path)}: {job.nbytes / 1024 / 1024:.1f} MiB in {seconds:.2f}s '
+                    f'on {threads} thread(s) after {result.waited:.2f}s queued, '
+                    f"peak rss {'?' if peak_rss is None else f'{peak_rss / 1024 / 1024:.0f} MiB'} "
+                    f"(decode estimate {job.memory / 1024 / 1024:.0f} MiB) "
+                    f'[{len(results)}/{total} done, {len(queue)} queued, {len(running)} running, {free} cores idle]'
+                )
+
+    wall = time.perf_counter() - start
+    if results:
+        logger.info(
+            f'sanitized {len(results)} files in {wall:.1f}s, '
+            f'{busy_core_seconds / (wall * cores):.0%} of {cores} cores scheduled'
+        )
+    return results
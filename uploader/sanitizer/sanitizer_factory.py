@@ -1,8 +1,8 @@
 import logging
 import magic
-from video.base import Base as VideoBase
-from image.heic import Heic as ImageHeic
-from image.base import Base as ImageBase
+from .video.base import Base as VideoBase
+from .image.heic import Heic as ImageHeic
+from .image.base import Base as ImageBase
 
 logger = logging.getLogger('sanitizer_factory')
 
@@ -10,19 +10,30 @@ class SanitizerFactory:
     def __init__(self):
         self.mime = magic.Magic(mime=True)
     
-    def create(self, filepath):
+    def kind(self, filepath):
+        # 'video', 'heic', 'image' or None, without creating a sanitizer
         mimetype = self.mime.from_file(filepath)
         _type, _subtype = mimetype.split('/')
         match _type:
+            case 'video':
+                return 'video'
+
+            case 'image':
+                return 'heic' if _subtype == 'heic' else 'image'
+
+            case _:
+                return None
+
+    def create(self, filepath):
+        match self.kind(filepath):
             case 'video':
                 return VideoBase(filepath)
             
+            case 'heic':
+                return ImageHeic(filepath)
+
             case 'image':
-                match _subtype:
-                    case 'heic':
-                        return ImageHeic(filepath)
-                    case _:
-                        return ImageBase(filepath)
+                return ImageBase(filepath)
 
             case _:
                 logger.warn(f'{filepath} not image or video.')
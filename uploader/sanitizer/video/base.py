@@ -8,15 +8,27 @@ class Base:
     def __init__(self, filepath):
         self.path, self.filename = os.path.split(filepath)
 
-    def process(self, output_dir):
+    def process(self, output_dir, threads=None):
+        # threads caps the encoder so the scheduler can fit other work around it,
+        # row-mt lets vp9 actually use them on a single tile column
+        thread_args = ['-threads', str(threads), '-row-mt', '1'] if threads else []
+        output = os.path.join(output_dir, '.'.join(self.filename.split('.')[:-1] + ['webm']))
         with subprocess.Popen([
             'ffmpeg',
             '-i', os.path.join(self.path, self.filename),
             '-c:v', "libvpx-vp9",
             '-crf', '30',
             '-b:v', '0',
-            os.path.join(output_dir, '.'.join(self.filename.split('.')[:-1] + ['webm']))
+            *thread_args,
+            output
         ]) as process:
             process.wait()
-        
-        os.remove(os.path.join(self.path, self.filename))
\ No newline at end of file
+
+        if process.returncode != 0:
+            # keep the original for another try, and don't leave a half-written webm to be ingested
+            if os.path.exists(output):
+                os.remove(output)
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+        os.remove(os.path.join(self.path, self.filename))
+        return output
\ No newline at end of file
@@ -0,0 +1,195 @@
+import io
+import os
+import time
+import logging
+
+from common.encrypt import Encrypter
+from thumbnail_generator import Rendition, PREVIEW, decode, render
+from thumbnail_generator.image_process import ImageProcess
+from thumbnail_generator.object_process_factory import ObjectProcessFactory
+from metadata import MetadataWriter
+from chunker import plan_chunks, read_chunks, chunk_filename, seek_index
+
+logger = logging.getLogger('streaming')
+
+class StreamingIngest:
+    """
+    Single-pass ingest of a sanitized directory straight into the server staging directories.
+
+    Every sanitized file is read exactly once.  Images are decoded once and the thumbnail
+    and preview are both derived from that decode; videos are cut into chunks as they are
+    read and each chunk is encrypted in memory, so no plaintext video_chunks/ copy is made.
+    The only plaintext written is what the ui serves from its static directory
+    (thumbnails, image previews and the first chunk of each video).
+
+    Methods:
+        __init__(...): Initialize with the encrypter, storage servers and output locations.
+        run(src_dir): Ingest every sanitized file in src_dir.
+        ingest(filepath, writer): Ingest one sanitized file.
+    """
+    def __init__(
+        self,
+        *,
+        encrypter: Encrypter,
+        servers: list,
+        path,
+        db_file: str,
+        timestamp,
+        metrics,
+        thumb_size: tuple=(128*2, 96*2),
+        manifest=None,
+        metadata_batch: int=500
+    ):
+        self.encrypter = encrypter
+        self.servers = servers
+        self.path = path
+        self.db_file = db_file
+        self.timestamp = timestamp
+        self.metrics = metrics
+        self.thumb_size = thumb_size
+        self.manifest = manifest
+        self.metadata_batch = metadata_batch
+        self.factory = ObjectProcessFactory()
+        self.counter = 0
+        # servers the current file was encrypted for, its files rows and seek index
+        self.emails = set()
+        self.rows = []
+        self.seek_index = []
+
+    def run(self, src_dir):
+        with MetadataWriter(self.db_file, manifest=self.manifest, batch_size=self.metadata_batch) as writer:
+            for entry in sorted(os.scandir(src_dir), key=lambda e: e.name):
+                if entry.is_file():
+                    self.ingest(entry.path, writer)
+
+    def ingest(self, filepath, writer):
+        """
+        Ingest one sanitized file, its metadata going through writer.
+
+        Args:
+        filepath (str): The sanitized jpg or webm.
+        writer (MetadataWriter): Where its files rows and manifest marks are buffered.
+        """
+        if self.manifest and self.manifest.done(filepath, 'encrypted'):
+            logger.debug(f'skipping {filepath}, already ingested')
+            return
+
+        logger.info(f'streaming {filepath}')
+        self.emails = set()
+        self.rows = []
+        self.seek_index = []
+        if filepath.endswith('.jpg'):
+            self._ingest_image(filepath)
+        elif filepath.endswith('.webm'):
+            self._ingest_video(filepath)
+        else:
+            logger.warning(f'skipping unsanitized file {filepath}')
+            return
+
+        # every stage happened in this one pass
+        stages = ['thumbnail', 'preview'] if filepath.endswith('.jpg') else ['thumbnail', 'chunked']
+        writer.add(self.rows, [
+            *((filepath, stage, None) for stage in stages),
+            (filepath, 'encrypted', ','.join(sorted(self.emails)))
+        ], self.seek_index)
+
+    def _ingest_image(self, filepath):
+        filename = os.path.basename(filepath)
+
+        thumb_file = self.path('thumbnails', f'{filename}.jpg')
+        preview_file = self.path('previews', filename)
+        if self.manifest and self.manifest.done(filepath, 'thumbnail') and self.manifest.done(filepath, 'preview') \
+                and os.path.exists(thumb_file) and os.path.exists(preview_file):
+            # the sanitizer already derived both from its own decode
+            with self.metrics.stage('read', os.path.getsize(filepath)):
+                data = self._read(filepath)
+                thumb_data = self._read(thumb_file)
+                preview_data = self._read(preview_file)
+            self._store(filename, data, thumb_data=thumb_data, preview_data=preview_data)
+            return
+
+        thumbnail = Rendition('thumbnail', self.thumb_size, crop=True, quality=40)
+
+        with self.metrics.stage('read', os.path.getsize(filepath)):
+            data = self._read(filepath)
+            # decoded once, no larger than the thumbnail and preview need
+            image = decode(io.BytesIO(data), [thumbnail, PREVIEW])
+
+        with self.metrics.stage('thumbnail', len(data)):
+            thumb = ImageProcess(filepath).create_thumbnail(thumbnail.size, image=image)
+            thumb_data = self._save_jpeg(thumb, thumb_file, quality=thumbnail.quality)
+
+        with self.metrics.stage('preview', len(data)):
+            preview_data = self._save_jpeg(render(image, PREVIEW), preview_file, quality=PREVIEW.quality)
+        image.close()
+
+        self._store(filename, data, thumb_data=thumb_data, preview_data=preview_data)
+
+    def _ingest_video(self, filepath):
+        filename = os.path.basename(filepath)
+
+        with self.metrics.stage('thumbnail', os.path.getsize(filepath)):
+            thumb = self.factory.create(filepath).create_thumbnail(self.thumb_size)
+            thumb_filename = f'{filename}.jpg'
+            thumb_data = self._save_jpeg(thumb, self.path('thumbnails', thumb_filename), quality=40)
+
+        # chunks are cut on keyframes, at random sizes so mega can't tell what they are
+        plan = plan_chunks(filepath)
+        self.seek_index = seek_index(filename, plan)
+
+        chunks = read_chunks(filepath, plan)
+        for chunk_number in range(len(plan)):
+            start = time.perf_counter()
+            chunk = next(chunks)
+            self.metrics.record('read', nbytes=len(chunk), seconds=time.perf_counter() - start)
+
+            chunk_name = chunk_filename(filename, chunk_number)
+            if chunk_number == 0:
+                # keep the first chunk of each video for quick serving
+                with open(self.path('previews', chunk_name), 'wb') as outfile:
+                    outfile.write(chunk)
+                self._store(chunk_name, chunk, thumb_data=thumb_data)
+            else:
+                self._store(chunk_name, chunk)
+
+    def _store(self, filename, data, *, thumb_data=None, preview_data=None):
+        dek = Encrypter.generate_iv()
+        email = self.servers[self.counter % len(self.servers)]['email']
+        self.counter += 1
+        self.emails.add(email)
+
+        with self.metrics.stage('encrypt', len(data)):
+            self._write_encrypted(data, self.path(email, self.encrypter.hash(filename, iv=dek)), dek)
+
+            # videos are chunked, and there's only one thumbnail for the whole set.
+            if thumb_data is not None:
+                thumb_filename = f"{filename.replace('_0000.webm', '.webm')}.jpg"
+                self._write_encrypted(thumb_data, self.path(email, self.encrypter.hash(thumb_filename, iv=dek)), dek)
+
+            if preview_data is not None:
+                self._write_encrypted(preview_data, self.path(email, self.encrypter.hash(f'{filename}.preview', iv=dek)), dek)
+
+        self.rows.append({
+            'filename': filename,
+            'unix_timestamp': self.timestamp(filename),
+            'email': email,
+            'dek': self.encrypter.encrypt(dek)
+        })
+
+    def _read(self, filepath):
+        with open(filepath, 'rb') as infile:
+            return infile.read()
+
+    def _write_encrypted(self, data, dest_file, dek):
+        encryptor = self.encrypter.cipher(dek).encryptor()
+        with open(dest_file, 'wb') as outfile:
+            outfile.write(encryptor.update(data))
+            outfile.write(encryptor.finalize())
+
+    def _save_jpeg(self, image, dest_file, *, quality):
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        data = buffer.getvalue()
+        with open(dest_file, 'wb') as outfile:
+            outfile.write(data)
+        return data
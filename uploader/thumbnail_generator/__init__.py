@@ -1 +1,3 @@
-from .thumbnail_generator import generate_thumbnails
\ No newline at end of file
+from .thumbnail_generator import generate_thumbnails, ThumbnailResult
+from .preview import create_preview
+from .derivatives import Rendition, PREVIEW, decode, derive, render
@@ -0,0 +1,132 @@
+import math
+from collections import namedtuple
+from PIL import Image
+
+# a derivative of a source image.
+# crop=True fills size exactly, centre cropping whatever doesn't fit (thumbnails);
+# crop=False fits inside size, keeping the aspect ratio and never upscaling (previews).
+Rendition = namedtuple('Rendition', ['name', 'size', 'crop', 'quality'], defaults=[False, 40])
+
+PREVIEW = Rendition('preview', (1080, 1920), crop=False, quality=20)
+
+# jpeg is decoded at the smallest 1/2, 1/4 or 1/8 scale that is still at least this many
+# times the largest rendition.  the scaled idct is already a filtered downscale, so unlike
+# Image.thumbnail (2.0) no extra margin is kept for LANCZOS
+DRAFT_GAP = 1.0
+
+# resize() first shrinks by an integer factor down to this many times the target size,
+# then resamples the rest properly, much cheaper on big sources and visually the same
+REDUCING_GAP = 3.0
+
+def _scale(source_size, rendition):
+    # how much of the source resolution a rendition actually uses
+    width, height = source_size
+    max_width, max_height = rendition.size
+
+    if rendition.crop:
+        return max(rendition.size) / min(width, height)
+
+    if width > max_width or height > max_height:
+        return max_width / width if width > height else max_height / height
+    return 1.0
+
+def decode_size(source_size: tuple, renditions: list[Rendition]) -> tuple:
+    """
+    The smallest decoded size every rendition can still be derived from.
+
+    Args:
+    source_size (tuple): The full size of the source as (width, height).
+    renditions (list[Rendition]): Everything that will be derived from the decode.
+
+    Returns:
+    tuple: (width, height), never larger than the source.
+    """
+    width, height = source_size
+    scale = min(1.0, max(_scale(source_size, rendition) for rendition in renditions) * DRAFT_GAP)
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+def decode(source, renditions: list[Rendition]) -> Image.Image:
+    """
+    Decode a source image once, at the smallest scale the renditions allow.
+
+    Jpeg can be decoded straight at 1/2, 1/4 or 1/8 scale (draft mode), so a 100
+    megapixel panorama headed for a 1080px preview never exists at full resolution
+    in memory.  Other formats decode at full size.
+
+    Args:
+    source (str | file | PIL.Image.Image): The image file, or an opened but not yet loaded image.
+    renditions (list[Rendition]): Everything that will be derived from the decode.
+
+    Returns:
+    PIL.Image.Image: The loaded image.
+    """
+    image = source if isinstance(source, Image.Image) else Image.open(source)
+    # draft is a no-op for anything that isn't an unloaded jpeg
+    image.draft(image.mode, decode_size(image.size, renditions))
+    image.load()
+    return image
+
+def render(image: Image.Image, rendition: Rendition) -> Image.Image:
+    """
+    Derive one rendition from a decoded image.
+
+    Args:
+    image (PIL.Image.Image): The decoded source.
+    rendition (Rendition): What to derive.
+
+    Returns:
+    PIL.Image.Image: A new image, the source is left untouched.
+    """
+    width, height = image.size
+
+    if rendition.crop:
+        # resize the centre square straight to the largest dimension of the rendition...
+        min_dimension = min(width, height)
+        left = (width - min_dimension) // 2
+        top = (height - min_dimension) // 2
+        max_dimension = max(rendition.size)
+        square = image.resize(
+            (max_dimension, max_dimension),
+            Image.LANCZOS,
+            box=(left, top, left + min_dimension, top + min_dimension),
+            reducing_gap=REDUCING_GAP
+        )
+
+        # ...then crop out the actual rendition
+        new_width, new_height = rendition.size
+        left = (max_dimension - new_width) // 2
+        top = (max_dimension - new_height) // 2
+        return square.crop((left, top, left + new_width, top + new_height))
+
+    max_width, max_height = rendition.size
+    if width > max_width or height > max_height:
+        if width > height:
+            new_width = max_width
+            new_height = int((max_width / width) * height)
+        else:
+            new_height = max_height
+            new_width = int((max_height / height) * width)
+        return image.resize((new_width, new_height), Image.LANCZOS, reducing_gap=REDUCING_GAP)
+
+    return image.copy()
+
+def derive(source, renditions: list[Rendition]) -> dict:
+    """
+    Decode a source once and derive every rendition from that one decode.
+
+    Only the reduced decode and the renditions themselves are ever held in memory.
+
+    Args:
+    source (str | file | PIL.Image.Image): The image file, or an opened but not yet loaded image.
+    renditions (list[Rendition]): What to derive.
+
+    Returns:
+    dict: rendition name -> PIL.Image.Image.
+    """
+    image = decode(source, renditions)
+    try:
+        return {rendition.name: render(image, rendition) for rendition in renditions}
+    finally:
+        # an image passed in belongs to the caller
+        if image is not source:
+            image.close()
@@ -0,0 +1,88 @@
+import io
+import json
+import logging
+import subprocess
+from collections import namedtuple
+from PIL import Image
+
+logger = logging.getLogger('frame_extractor')
+
+VideoInfo = namedtuple('VideoInfo', ['width', 'height', 'duration', 'rotation'])
+
+# display rotation (clockwise) to the transpose that applies it
+TRANSPOSE = {
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+
+def probe(filepath: str) -> VideoInfo:
+    """
+    Read the size, duration and display rotation of a video's first video stream.
+
+    Args:
+    filepath (str): The video file.
+
+    Returns:
+    VideoInfo: width and height as stored (before rotation), duration in seconds
+        and the clockwise display rotation in degrees.
+    """
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,duration:stream_tags=rotate:stream_side_data=rotation:format=duration',
+        '-of', 'json',
+        filepath
+    ], capture_output=True, check=True)
+    info = json.loads(result.stdout)
+    stream = info['streams'][0]
+
+    # webm usually only has the container duration
+    duration = float(stream.get('duration') or info.get('format', {}).get('duration') or 0)
+
+    # older files carry a rotate tag, newer ones a display matrix that rotates the other way
+    if 'rotate' in stream.get('tags', {}):
+        rotation = int(stream['tags']['rotate'])
+    else:
+        rotation = -int(next((data['rotation'] for data in stream.get('side_data_list', []) if 'rotation' in data), 0))
+
+    return VideoInfo(stream['width'], stream['height'], duration, rotation % 360)
+
+def extract_frame(filepath: str, timestamp: float, *, rotation: int=0, short_side: int=None) -> Image.Image:
+    """
+    Decode the frame at the keyframe nearest before timestamp.
+
+    Seeking happens on the input, so only the packets from that keyframe on are read,
+    and ffmpeg scales the frame down before it leaves the process, so the buffer
+    handed to Pillow is thumbnail sized rather than full resolution.
+
+    Args:
+    filepath (str): The video file.
+    timestamp (float): Where to take the frame from, in seconds.
+    rotation (int): Clockwise display rotation to apply, as returned by probe().
+    short_side (int): Scale so the shorter side is this many pixels, default is full size.
+
+    Returns:
+    PIL.Image.Image: The frame, in RGB.
+    """
+    filters = ['-vf', f'scale={short_side}:{short_side}:force_original_aspect_ratio=increase'] if short_side else []
+    result = subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-threads', '1',
+        '-noaccurate_seek', '-ss', f'{timestamp:.3f}',
+        # rotation is applied below, on the scaled frame
+        '-noautorotate',
+        '-i', filepath,
+        *filters,
+        '-frames:v', '1',
+        '-f', 'image2pipe', '-vcodec', 'ppm',
+        '-'
+    ], capture_output=True, check=True)
+
+    if not result.stdout:
+        raise ValueError(f'no frame at {timestamp:.3f}s in {filepath}')
+
+    frame = Image.open(io.BytesIO(result.stdout))
+    if rotation in TRANSPOSE:
+        frame = frame.transpose(TRANSPOSE[rotation])
+    return frame
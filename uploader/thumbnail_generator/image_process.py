@@ -1,4 +1,5 @@
 from .object_process import ObjectProcess
+from .derivatives import Rendition, decode, render
 
 class ImageProcess(ObjectProcess):
     """
@@ -6,6 +7,33 @@ class ImageProcess(ObjectProcess):
 
     Methods:
         __init__(input_path): Initialize with the path to the image file.
+        create_thumbnail(thumb_size, image): Create the thumbnail, decoding no larger than it needs.
+        create_renditions(renditions, image): Derive every rendition from one decode.
     """
     def __init__(self, input_path):
-        super().__init__(input_path)
\ No newline at end of file
+        super().__init__(input_path)
+
+    def create_thumbnail(self, thumb_size, image=None):
+        return self.create_renditions([Rendition('thumbnail', thumb_size, crop=True)], image=image)['thumbnail']
+
+    def create_renditions(self, renditions, image=None):
+        """
+        Args:
+        renditions (list[Rendition]): What to derive, crop renditions are thumbnails and get post-processed.
+        image (PIL.Image.Image): The source, if it has already been opened.
+
+        Returns:
+        dict: rendition name -> PIL.Image.Image.
+        """
+        source = decode(self.input_path if image is None else image, renditions)
+        source = self._pre_process(source)
+
+        derived = {}
+        for rendition in renditions:
+            derived[rendition.name] = render(source, rendition)
+            if rendition.crop:
+                derived[rendition.name] = self._post_process(derived[rendition.name])
+
+        if image is None:
+            source.close()
+        return derived
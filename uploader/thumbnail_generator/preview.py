@@ -0,0 +1,12 @@
+from .derivatives import Rendition, render
+
+def create_preview(image, max_size: tuple=(1080, 1920)):
+    """
+    Downscale an image so that it fits within max_size, preserving the aspect ratio.
+    Images that already fit are returned as a copy.
+
+    Args:
+    image (PIL.Image.Image): The decoded source image.
+    max_size (tuple): The bounding box as a tuple (max_width, max_height), default is (1080, 1920).
+    """
+    return render(image, Rendition('preview', max_size, crop=False))
@@ -1,27 +1,78 @@
 import os
+import time
 import logging
+import concurrent.futures
+from collections import namedtuple
 from .object_process_factory import ObjectProcessFactory
+from .video_process import VideoProcess
+from .image_process import ImageProcess
+from .derivatives import Rendition
 
 logger = logging.getLogger('thumbnail_generator')
 
+# derived: names of the extra renditions written alongside the thumbnail
+ThumbnailResult = namedtuple('ThumbnailResult', ['path', 'dest', 'seconds', 'error', 'derived'], defaults=[()])
+
+def _render_thumbnail(process, dest, thumb_size, quality, derived=()):
+    start = time.perf_counter()
+    if derived and isinstance(process, ImageProcess):
+        # one decode for the thumbnail and every other rendition
+        thumbnail = Rendition('thumbnail', thumb_size, crop=True, quality=quality)
+        renditions = process.create_renditions([thumbnail, *(rendition for rendition, _ in derived)])
+        filename = os.path.basename(process.input_path)
+        outputs = [(thumbnail, dest), *((rendition, pattern.format(filename=filename)) for rendition, pattern in derived)]
+    else:
+        renditions = {'thumbnail': process.create_thumbnail(thumb_size)}
+        outputs = [(Rendition('thumbnail', thumb_size, crop=True, quality=quality), dest)]
+
+    for rendition, output in outputs:
+        renditions[rendition.name].save(
+            output,
+            format='JPEG',
+            quality=rendition.quality,
+            optimize=True
+        )
+    return time.perf_counter() - start, tuple(rendition.name for rendition, _ in outputs[1:])
+
 def generate_thumbnails(
     *, 
     src_dir: str, 
     dest_dir: str, 
     thumb_size: tuple=(96, 128),
-    quality=40
-) -> None:
+    quality=40,
+    workers: int | None=None,
+    video_workers: int=1,
+    skip=None,
+    derived: list[tuple]=()
+) -> list[ThumbnailResult]:
     """
     Generate thumbnails for each file in the source directory and save them to the destination directory.
 
+    With workers > 1 the thumbnails are rendered in process pools.  Videos get a pool of their own
+    (video_workers processes, largest first) so that a long clip can't hold up the images behind it.
+    A file that fails is logged and reported in its result; the rest of the batch carries on.
+
+    Images also get every rendition in derived from the same decode as their thumbnail,
+    see derivatives.derive.
+
     Args:
     src_dir (str): The directory to scan for files.
     dest_dir (str): The directory where thumbnails will be saved.
     thumb_size (tuple): The size of the thumbnails as a tuple (width, height), default is (96, 128).
+    quality (int): The JPEG quality of the saved thumbnails, default is 40.
+    workers (int): The number of image worker processes, default is None (render in this process).
+    video_workers (int): The number of video worker processes when running in parallel, default is 1.
+    skip (callable): Called with each file's path, files it returns True for are left alone.
+    derived (list[tuple]): (Rendition, path pattern with a {filename} field) pairs to write
+        alongside image thumbnails, default is none.
+
+    Returns:
+    list[ThumbnailResult]: One result per processed file, in directory order.
     """
     
     factory = ObjectProcessFactory()
-    
+
+    jobs = []
     for entry in os.scandir(src_dir):
         logger.info(f'processing {entry.path}')
         
@@ -29,14 +80,40 @@ def generate_thumbnails(
             logger.debug(f'skipping non-file {entry.path}')
             continue
 
+        if skip and skip(entry.path):
+            logger.debug(f'skipping {entry.path}, thumbnail already generated')
+            continue
+
         process = factory.create(entry.path)
         if not process:
             continue
 
-        thumb = process.create_thumbnail(thumb_size)
-        thumb.save(
-            f'{dest_dir}/{entry.name}.jpg', 
-            format='JPEG', 
-            quality=quality, 
-            optimize=True
-        )
+        jobs.append((entry, process, f'{dest_dir}/{entry.name}.jpg'))
+
+    if not workers or workers <= 1:
+        return [_collect(entry, dest, lambda: _render_thumbnail(process, dest, thumb_size, quality, derived))
+                for entry, process, dest in jobs]
+
+    videos = sorted(
+        (job for job in jobs if isinstance(job[1], VideoProcess)),
+        key=lambda job: job[0].stat().st_size,
+        reverse=True
+    )
+    images = [job for job in jobs if not isinstance(job[1], VideoProcess)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as image_pool, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=video_workers) as video_pool:
+        futures = {}
+        for pool, batch in ((video_pool, videos), (image_pool, images)):
+            for entry, process, dest in batch:
+                futures[entry.path] = pool.submit(_render_thumbnail, process, dest, thumb_size, quality, derived)
+
+        return [_collect(entry, dest, futures[entry.path].result) for entry, _, dest in jobs]
+
+def _collect(entry, dest, render):
+    try:
+        seconds, derived = render()
+        return ThumbnailResult(entry.path, dest, seconds, None, derived)
+    except Exception as e:
+        logger.exception(f'failed to generate thumbnail for {entry.path}')
+        return ThumbnailResult(entry.path, None, None, e)
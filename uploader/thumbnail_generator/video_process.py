@@ -1,6 +1,12 @@
-from moviepy.editor import VideoFileClip
-from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+from PIL import ImageDraw, ImageFont
 from .object_process import ObjectProcess
+from .frame_extractor import probe, extract_frame
+
+@lru_cache(maxsize=None)
+def duration_font(size=25):
+    # loaded once per process rather than once per thumbnail
+    return ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', size)
 
 class VideoProcess(ObjectProcess):
     """
@@ -8,37 +14,46 @@ class VideoProcess(ObjectProcess):
 
     Methods:
         __init__(input_path): Initialize with the path to the video file.
-        _fetch_image(): Fetch a frame from the video file.
+        create_thumbnail(thumb_size, image, duration): Create the thumbnail, decoding the frame no larger than it needs.
+        _fetch_image(): Fetch a frame from the middle of the video.
         _post_process(thumb): Add duration text to the generated thumbnail.
     """
     def __init__(self, input_path):
         super().__init__(input_path)
-    
+        self.thumb_size = None
+        # known once the frame is fetched, or from the caller when it decoded the frame
+        self.duration = None
+
+    def create_thumbnail(self, thumb_size, image=None, duration=None):
+        # the frame only needs to be big enough for the thumbnail
+        self.thumb_size = thumb_size
+        if duration is not None:
+            self.duration = duration
+        return super().create_thumbnail(thumb_size, image=image)
+
     def _fetch_image(self):
-        with VideoFileClip(
-            self.input_path, 
-            audio=False, 
-        ) as clip:
-            if clip.rotation in [90, 270]:
-                # clips in portrait with rotation metadata
-                # are rotated to landscape but this causes
-                # image distortion.  This fixes it.
-                clip = clip.resize(clip.size[::-1])
-                clip.rotation = 0
-
-            self.duration = clip.duration
-            return Image.fromarray(clip.get_frame(clip.duration * 0.5))
-    
+        info = probe(self.input_path)
+        self.duration = info.duration
+        return extract_frame(
+            self.input_path,
+            info.duration * 0.5,
+            rotation=info.rotation,
+            short_side=max(self.thumb_size) if self.thumb_size else None
+        )
+
     def _post_process(self, thumb):
+        if self.duration is None:
+            self.duration = probe(self.input_path).duration
         text = f'{(int(self.duration) // 60):02}:{(int(self.duration) % 60):02}'
-                
+
         draw = ImageDraw.Draw(thumb)
-        font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', 25)
+        font = duration_font()
 
-        text_width, text_height = draw.textsize(text, font=font)
+        # same extent textsize() used to give, it's gone from newer Pillow
+        _, _, text_width, text_height = draw.textbbox((0, 0), text, font=font)
         thumb_width, thumb_height = thumb.size
         text_pos = ((thumb_width - text_width) // 2, (thumb_height - text_height) - 5)
-        
+
         draw.text(text_pos, text, font=font, fill="white", stroke_fill="black", stroke_width=3)
 
-        return thumb
\ No newline at end of file
+        return thumb
@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+import concurrent.futures
+
+from common.storage import StorageBackend, StorageError
+
+logger = logging.getLogger('upload')
+
+class UploadProgress:
+    """
+    Live progress of one server's upload, fed from the storage backend's progress reports.
+
+    Methods:
+        __init__(email, total_bytes, log_interval): Initialize with the size of the directory being uploaded.
+        update(progress): Fold in a progress report.
+        bytes_per_sec(): Current upload rate.
+        eta(): Seconds left at the current rate, None if unknown.
+    """
+    def __init__(self, email, total_bytes, log_interval=10.0):
+        self.email = email
+        self.total_bytes = total_bytes
+        self.log_interval = log_interval
+        self.last_log = 0.0
+        self.files = {}
+        self.speed = None
+        self.started = time.monotonic()
+
+    @property
+    def done_bytes(self):
+        return sum(self.files.values())
+
+    def update(self, progress):
+        self.files[progress['file']] = progress['done']
+        if progress['speed'] is not None:
+            self.speed = progress['speed']
+
+        if time.monotonic() - self.last_log >= self.log_interval:
+            self.last_log = time.monotonic()
+            eta = self.eta()
+            logger.info(
+                f"{self.email}: {self.done_bytes / 1024 / 1024:.1f}/"
+                f"{self.total_bytes / 1024 / 1024:.1f} MiB, {self.bytes_per_sec() / 1024:.0f} KiB/s, "
+                f"eta {'?' if eta is None else f'{eta:.0f}s'}"
+            )
+
+    def bytes_per_sec(self):
+        if self.speed is not None:
+            return self.speed
+        elapsed = time.monotonic() - self.started
+        return self.done_bytes / elapsed if elapsed else 0.0
+
+    def eta(self):
+        rate = self.bytes_per_sec()
+        return (self.total_bytes - self.done_bytes) / rate if rate else None
+
+def directory_bytes(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+def upload_all(
+    servers: list,
+    *,
+    storage: StorageBackend,
+    local_dir,
+    workers: int=4,
+    retries: int=3,
+    backoff: float=5.0,
+    log_interval: float=10.0,
+    replace=None
+) -> list[dict]:
+    """
+    Upload every server's staging directory concurrently.
+
+    Args:
+    servers (list): The storage servers to upload to.
+    storage (StorageBackend): The backend to upload with, one account per server.
+    local_dir (callable): The staging directory of a server.
+    workers (int): The maximum number of uploads running at once, default is 4.
+    retries (int): Extra attempts after a failed upload, default is 3.
+    backoff (float): Seconds to wait before the first retry, doubled for every later one, default is 5.
+    log_interval (float): Seconds between progress log lines per server, default is 10.
+    replace (callable): The names in a server's staging directory to upload over existing objects, default is none.
+
+    Returns:
+    list[dict]: One summary per server, in the order given: email, ok, attempts, bytes, seconds, bytes_per_sec.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload') as executor:
+        futures = [
+            executor.submit(
+                _upload_with_retries,
+                server, storage, local_dir(server), replace(server) if replace else (), retries, backoff, log_interval
+            )
+            for server in servers
+        ]
+        summaries = [future.result() for future in futures]
+
+    for summary in summaries:
+        logger.info(
+            f"{summary['email']}: {'ok' if summary['ok'] else 'FAILED'} after {summary['attempts']} attempt(s), "
+            f"{summary['bytes'] / 1024 / 1024:.1f} MiB in {summary['seconds']:.1f}s "
+            f"({summary['bytes_per_sec'] / 1024 / 1024:.2f} MiB/s)"
+        )
+    return summaries
+
+def _upload_with_retries(server, storage, directory, replace, retries, backoff, log_interval):
+    total_bytes = directory_bytes(directory)
+    filepaths = sorted(entry.path for entry in os.scandir(directory) if entry.is_file())
+    start = time.monotonic()
+
+    for attempt in range(1, retries + 2):
+        try:
+            # objects uploaded by an earlier attempt are skipped
+            storage.put_many(
+                server['email'],
+                filepaths,
+                progress=UploadProgress(server['email'], total_bytes, log_interval).update,
+                replace=replace
+            )
+            ok = True
+        except StorageError as e:
+            logger.warning(f"upload to {server['email']} failed (attempt {attempt}): {e}")
+            ok = False
+
+        if ok or attempt > retries:
+            break
+
+        delay = backoff * 2 ** (attempt - 1)
+        logger.info(f"retrying upload to {server['email']} in {delay:.0f}s")
+        time.sleep(delay)
+
+    seconds = time.monotonic() - start
+    return {
+        'email': server['email'],
+        'ok': ok,
+        'attempts': attempt,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'bytes_per_sec': total_bytes / seconds if ok and seconds else 0.0,
+    }
@@ -0,0 +1,161 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger('watcher')
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT = struct.Struct('iIII')
+
+def _inotify(directory):
+    # returns a non-blocking inotify fd watching directory, None where inotify isn't available
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    mask = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        logger.warning(f'inotify_add_watch failed: {os.strerror(ctypes.get_errno())}')
+        os.close(fd)
+        return None
+    return fd
+
+class Watcher:
+    """
+    Reports files dropped into a directory once they've stopped changing.
+
+    Uses inotify where it's available and falls back to polling the directory.  Either
+    way a file is only reported once its size and mtime have been unchanged for debounce
+    seconds, so files still being copied in aren't picked up half written.  Files already
+    there when the watcher starts are reported too, and dot files (partial rsync/scp
+    transfers) are ignored.
+
+    Methods:
+        __init__(directory, debounce, poll_interval, use_inotify): Start watching directory.
+        ready(timeout): Wait up to timeout seconds, then return the files that have settled.
+        close(): Stop watching.
+    """
+    def __init__(self, directory: str, *, debounce: float=2.0, poll_interval: float=1.0, use_inotify: bool=True):
+        self.directory = directory
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        # path -> (size, mtime_ns, when it last changed)
+        self.pending = {}
+        # path -> (size, mtime_ns) when it was reported, so a file that's still there
+        # (say it failed to process) isn't reported again until it changes
+        self.reported = {}
+
+        self.fd = _inotify(directory) if use_inotify else None
+        logger.info(f"watching {directory} with {'inotify' if self.fd is not None else 'polling'}")
+        self._scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _scan(self):
+        present = set()
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                present.add(entry.path)
+                self._touch(entry.path)
+        for path in set(self.reported) - present:
+            del self.reported[path]
+
+    def _touch(self, path):
+        if os.path.basename(path).startswith('.'):
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+            self.reported.pop(path, None)
+            return
+
+        key = (stat.st_size, stat.st_mtime_ns)
+        if self.reported.get(path) == key:
+            return
+        if path not in self.pending or self.pending[path][:2] != key:
+            self.pending[path] = (*key, time.monotonic())
+
+    def _read_events(self):
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, length = EVENT.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, rescanning')
+                self._scan()
+            elif name:
+                self._touch(os.path.join(self.directory, os.fsdecode(name)))
+
+    def ready(self, timeout: float=1.0) -> list[str]:
+        """
+        Args:
+        timeout (float): The longest to wait for something to happen, in seconds.
+
+        Returns:
+        list[str]: Files that haven't changed for debounce seconds, oldest first.
+            Each file is only reported once, until it changes again.
+        """
+        # don't sleep past the moment the next pending file settles
+        now = time.monotonic()
+        if self.pending:
+            settles = min(changed for _, _, changed in self.pending.values()) + self.debounce
+            timeout = min(timeout, max(0.0, settles - now))
+
+        if self.fd is not None:
+            if select.select([self.fd], [], [], timeout)[0]:
+                self._read_events()
+        else:
+            time.sleep(min(timeout, self.poll_interval))
+            self._scan()
+
+        # a writer that keeps the file open may not generate events we see, so check again
+        for path in list(self.pending):
+            self._touch(path)
+
+        now = time.monotonic()
+        settled = sorted(
+            (path for path, (_, _, changed) in self.pending.items() if now - changed >= self.debounce),
+            key=lambda path: self.pending[path][2]
+        )
+        for path in settled:
+            self.reported[path] = self.pending.pop(path)[:2]
+        return settled
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None